@@ -0,0 +1,285 @@
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, List, Tuple
+import json
+import math
+import os
+import re
+
+import numpy as np
+
+from GPTsettings import GPTsettings
+
+IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+# The words of camelCase, PascalCase, snake_case and SCREAMING_CASE identifiers
+SUBWORD = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+")
+
+
+@lru_cache(maxsize=100_000)
+def split_identifier(identifier: str) -> Tuple[str, ...]:
+    """
+    Gets the terms of an identifier: the whole identifier and its words, lowercased.
+
+    Args:
+        identifier (str): The identifier.
+
+    Returns:
+        Tuple[str, ...]: The terms of the identifier.
+    """
+    words = SUBWORD.findall(identifier)
+    if len(words) < 2:
+        return (identifier.lower(),)
+    return (identifier.lower(), *(word.lower() for word in words))
+
+
+def count_terms(text: str) -> Counter:
+    """
+    Counts the code-aware terms of a text, e.g. "getFileDelta" counts as "getfiledelta", "get",
+    "file" and "delta". Identifiers are counted first, so each distinct one is split once.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        Counter: The number of occurrences of every term.
+    """
+    counts = Counter()
+    for identifier, count in Counter(IDENTIFIER.findall(text)).items():
+        for term in split_identifier(identifier):
+            counts[term] += count
+    return counts
+
+
+class BM25Index:
+    """
+    An in-process BM25 index of documents, without any network call.
+
+    The term counts are kept document by document in CSR arrays (row pointers, term ids and
+    counts), so documents are appended and removed with a few array operations. The inverted
+    index used by queries is built from them on the first search after a change, and a query
+    only visits the postings of its own terms.
+    """
+
+    VOCABULARY_FILE = "bm25_vocabulary.json"
+    INDPTR_FILE = "bm25_indptr.npy"
+    TERMS_FILE = "bm25_terms.npy"
+    COUNTS_FILE = "bm25_counts.npy"
+
+    def __init__(
+        self, k1: float = GPTsettings.BM25_K1, b: float = GPTsettings.BM25_B
+    ) -> None:
+        """
+        Initializes a new, empty instance of the BM25Index class.
+
+        Args:
+            k1 (float, optional): The term frequency saturation. Defaults to GPTsettings.BM25_K1.
+            b (float, optional): The document length normalization. Defaults to GPTsettings.BM25_B.
+        """
+        self.k1 = k1
+        self.b = b
+        self.vocabulary: Dict[str, int] = {}
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.terms = np.zeros(0, dtype=np.int32)
+        self.counts = np.zeros(0, dtype=np.float32)
+        self.postings = None
+
+    def __len__(self) -> int:
+        return len(self.indptr) - 1
+
+    def add(self, docs: List[str]) -> None:
+        """
+        Appends documents to the index.
+
+        Args:
+            docs (List[str]): The documents.
+        """
+        if not docs:
+            return
+        terms, counts, lengths = [], [], []
+        for doc in docs:
+            doc_counts = count_terms(doc)
+            terms += [
+                self.vocabulary.setdefault(term, len(self.vocabulary))
+                for term in doc_counts
+            ]
+            counts += doc_counts.values()
+            lengths.append(len(doc_counts))
+        self.indptr = np.concatenate(
+            [self.indptr, self.indptr[-1] + np.cumsum(lengths, dtype=np.int64)]
+        )
+        self.terms = np.concatenate([self.terms, np.array(terms, dtype=np.int32)])
+        self.counts = np.concatenate([self.counts, np.array(counts, dtype=np.float32)])
+        self.postings = None
+
+    def select(self, keep: List[int]) -> None:
+        """
+        Keeps only some documents, renumbered in the given order.
+
+        Args:
+            keep (List[int]): The indices of the documents to keep.
+        """
+        keep = np.asarray(keep, dtype=np.int64)
+        starts = self.indptr[keep]
+        lengths = self.indptr[keep + 1] - starts
+        indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        # The position of every kept entry in the old arrays
+        entries = np.repeat(starts - indptr[:-1], lengths) + np.arange(indptr[-1])
+        self.indptr = indptr
+        self.terms = self.terms[entries]
+        self.counts = self.counts[entries]
+        self.postings = None
+        # Pruning renumbers every entry, so it waits until most terms are unused
+        used = np.unique(self.terms)
+        if 2 * len(used) < len(self.vocabulary):
+            self.prune(used)
+
+    def prune(self, used: np.ndarray) -> None:
+        """
+        Drops the terms that no document contains anymore from the vocabulary, renumbering the others.
+
+        Args:
+            used (np.ndarray): The sorted ids of the terms that documents still contain.
+        """
+        terms = list(self.vocabulary)
+        self.vocabulary = {terms[term_id]: i for i, term_id in enumerate(used.tolist())}
+        new_ids = np.zeros(len(terms), dtype=np.int32)
+        new_ids[used] = np.arange(len(used), dtype=np.int32)
+        self.terms = new_ids[self.terms]
+        self.postings = None
+
+    def copy(self) -> "BM25Index":
+        """
+        Copies the index. The arrays are shared, as they are replaced rather than modified.
+
+        Returns:
+            BM25Index: The copy of the index.
+        """
+        index = BM25Index(self.k1, self.b)
+        index.vocabulary = dict(self.vocabulary)
+        index.indptr = self.indptr
+        index.terms = self.terms
+        index.counts = self.counts
+        index.postings = self.postings
+        return index
+
+    def get_postings(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Gets the inverted index, building it if the documents changed since the last search.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: The start of the postings of every term id,
+                then the document, length normalization k1 * (1 - b + b * dl / avgdl) and term count of every posting.
+        """
+        postings = self.postings
+        if postings is None:
+            docs = np.repeat(np.arange(len(self), dtype=np.int32), np.diff(self.indptr))
+            lengths = np.bincount(docs, weights=self.counts, minlength=len(self))
+            average_length = lengths.mean() if len(self) else 1.0
+            norms = self.k1 * (1 - self.b + self.b * lengths / (average_length or 1.0))
+            order = np.argsort(self.terms, kind="stable")
+            starts = np.searchsorted(
+                self.terms[order], np.arange(len(self.vocabulary) + 1)
+            )
+            postings = self.postings = (
+                starts,
+                docs[order],
+                norms[docs[order]].astype(np.float32),
+                self.counts[order],
+            )
+        return postings
+
+    def score(self, queries: List[str]) -> np.ndarray:
+        """
+        Scores every document against every query with BM25.
+
+        Args:
+            queries (List[str]): The queries.
+
+        Returns:
+            np.ndarray: The scores, one row per query and one column per document.
+        """
+        scores = np.zeros((len(queries), len(self)), dtype=np.float32)
+        if not len(self):
+            return scores
+        starts, docs, norms, counts = self.get_postings()
+        for row, query in enumerate(queries):
+            for term in count_terms(query):
+                term_id = self.vocabulary.get(term)
+                if term_id is None or term_id + 1 >= len(starts):
+                    continue
+                start, end = starts[term_id], starts[term_id + 1]
+                if start == end:
+                    continue  # Only in removed documents
+                idf = math.log(
+                    1 + (len(self) - (end - start) + 0.5) / (end - start + 0.5)
+                )
+                term_counts = counts[start:end]
+                scores[row, docs[start:end]] += (
+                    idf * term_counts * (self.k1 + 1) / (term_counts + norms[start:end])
+                )
+        return scores
+
+    def save(self, path: str) -> None:
+        """
+        Writes the index to a directory.
+
+        Args:
+            path (str): The directory.
+        """
+        os.makedirs(path, exist_ok=True)
+        for filename, array in (
+            (self.INDPTR_FILE, self.indptr),
+            (self.TERMS_FILE, self.terms),
+            (self.COUNTS_FILE, self.counts),
+        ):
+            with open(os.path.join(path, filename + ".tmp"), "wb") as file:
+                np.save(file, array)
+            os.replace(
+                os.path.join(path, filename + ".tmp"), os.path.join(path, filename)
+            )
+        with open(os.path.join(path, self.VOCABULARY_FILE + ".tmp"), "w") as file:
+            json.dump(list(self.vocabulary), file)
+        os.replace(
+            os.path.join(path, self.VOCABULARY_FILE + ".tmp"),
+            os.path.join(path, self.VOCABULARY_FILE),
+        )
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        """
+        Checks whether an index was written to a directory.
+
+        Args:
+            path (str): The directory.
+
+        Returns:
+            bool: True if every file of the index exists.
+        """
+        return all(
+            os.path.exists(os.path.join(path, filename))
+            for filename in (
+                BM25Index.VOCABULARY_FILE,
+                BM25Index.INDPTR_FILE,
+                BM25Index.TERMS_FILE,
+                BM25Index.COUNTS_FILE,
+            )
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        """
+        Reads an index written with save.
+
+        Args:
+            path (str): The directory.
+
+        Returns:
+            BM25Index: The index.
+        """
+        index = cls()
+        with open(os.path.join(path, cls.VOCABULARY_FILE)) as file:
+            index.vocabulary = {term: i for i, term in enumerate(json.load(file))}
+        index.indptr = np.load(os.path.join(path, cls.INDPTR_FILE))
+        index.terms = np.load(os.path.join(path, cls.TERMS_FILE))
+        index.counts = np.load(os.path.join(path, cls.COUNTS_FILE))
+        return index
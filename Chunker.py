@@ -0,0 +1,335 @@
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from itertools import accumulate
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional, Tuple
+import ast
+import re
+
+from GPTsettings import GPTsettings
+
+if TYPE_CHECKING:
+    import tiktoken
+
+# The language of every chunked file extension
+LANGUAGES = {
+    "py": "python",
+    "js": "js",
+    "jsx": "js",
+    "ts": "ts",
+    "tsx": "ts",
+    "java": "java",
+    "html": "html",
+    "md": "markdown",
+    "css": "css",
+    "scss": "css",
+    "sass": "css",
+    "sql": "sql",
+    "gql": "graphql",
+    "graphql": "graphql",
+}
+
+_JS_DECLARATION = r"(?:export\s+)?(?:default\s+)?(?:declare\s+)?(?:abstract\s+)?(?:async\s+)?(?:function\b|class\b|interface\b|type\b|enum\b|namespace\b|const\b|let\b|var\b)"
+# Indentation matched atomically, so lines are not retried with a shorter indentation
+_INDENT = r"(?=(?P<indent>[ \t]+))(?P=indent)"
+_JS_MEMBER = r"(?:(?:public|private|protected|static|readonly|override|abstract|async|get|set)[ \t]+)*[A-Za-z_$][\w$]*[ \t]*(?:<[^>\n]*>)?\([^\n]*\{[ \t]*$"
+# The lines where a chunk can start, by language, from the strongest boundary to the weakest.
+# Blank lines are the last boundary of every language, then single lines.
+BOUNDARIES: Dict[str, Tuple[re.Pattern, ...]] = {
+    language: tuple(re.compile(pattern, re.MULTILINE) for pattern in patterns)
+    for language, patterns in {
+        # Only used when the file can't be parsed
+        "python": (
+            r"^(?:@|def\s|async\s+def\s|class\s)",
+            rf"^{_INDENT}(?:@|def\s|async\s+def\s|class\s)",
+        ),
+        "js": (
+            rf"^{_JS_DECLARATION}",
+            rf"^{_INDENT}(?:{_JS_DECLARATION}|{_JS_MEMBER})",
+        ),
+        "ts": (
+            rf"^{_JS_DECLARATION}",
+            rf"^{_INDENT}(?:{_JS_DECLARATION}|{_JS_MEMBER})",
+        ),
+        "java": (
+            r"^(?:(?:public|private|protected|abstract|final|static|sealed)\s+)*(?:class|interface|enum|record|@interface)\b",
+            rf"^{_INDENT}(?:@\w+|(?:(?:public|private|protected|static|final|abstract|synchronized|default)[ \t]+)+[\w<>\[\], ?]+[ \t]+\w+[ \t]*\()",
+        ),
+        "html": (
+            r"^[ \t]*<(?:head|body|header|footer|main|nav|section|article|aside|form|table|script|style|template)\b",
+            r"^[ \t]*<(?:div|ul|ol|p|h[1-6])\b",
+        ),
+        "markdown": (r"^#{1,2}\s", r"^#{3,6}\s"),
+        "css": (r"^@", r"^[^\s}/@][^\n{]*\{"),
+        "sql": (
+            r"^(?i:create|alter|drop|insert|update|delete|select|with|grant|begin)\b",
+        ),
+        "graphql": (
+            r"^(?:extend\s+)?(?:type|input|interface|enum|union|scalar|schema|query|mutation|subscription|fragment|directive)\b",
+        ),
+    }.items()
+}
+
+
+class Chunk(NamedTuple):
+    """
+    A chunk of a file and the lines it spans, 1-based and inclusive.
+    """
+
+    text: str
+    start_line: int
+    end_line: int
+
+
+class Chunker:
+    """
+    Splits files into chunks of at most max_tokens tokens along the structure of their language.
+
+    Chunks start at the strongest boundaries first: top-level definitions (found with ast for
+    Python and with precompiled patterns for other languages), then nested definitions, then
+    blank lines, then single lines. Adjacent pieces are merged back together while they fit, so
+    small definitions share a chunk and large ones are split at their own members.
+    """
+
+    def __init__(
+        self,
+        encoding: "tiktoken.Encoding",
+        max_tokens: int = GPTsettings.CHUNK_MAX_TOKENS,
+    ) -> None:
+        """
+        Initializes a new instance of the Chunker class.
+
+        Args:
+            encoding (tiktoken.Encoding): The encoding used to count tokens.
+            max_tokens (int, optional): The maximum number of tokens in a chunk. Defaults to GPTsettings.CHUNK_MAX_TOKENS.
+        """
+        self.encoding = encoding
+        self.max_tokens = max_tokens
+
+    def chunk(self, text: str, file_extension: str) -> List[Chunk]:
+        """
+        Splits a file into chunks.
+
+        Args:
+            text (str): The content of the file.
+            file_extension (str): The extension of the file, without the dot.
+
+        Returns:
+            List[Chunk]: The chunks, in order. Blank lines between chunks are left out.
+        """
+        lines = text.splitlines(keepends=True)
+        if not lines:
+            return []
+        # Lines are counted apart in one batch, so the tokens of any range are a difference of sums
+        token_sums = [
+            0,
+            *accumulate(
+                len(tokens) for tokens in self.encoding.encode_ordinary_batch(lines)
+            ),
+        ]
+        # Files that fit in a chunk are not parsed
+        if token_sums[-1] > self.max_tokens:
+            boundaries = self.get_boundaries(text, lines, LANGUAGES.get(file_extension))
+        else:
+            boundaries = []
+        chunks = []
+        for start, end in self.split(0, len(lines), boundaries, 0, token_sums):
+            tokens = token_sums[end] - token_sums[start]
+            if end - start == 1 and tokens > self.max_tokens:
+                chunks += self.split_line(lines[start], start + 1)
+                continue
+            chunk = self.make_chunk(lines, start, end)
+            if chunk is not None:
+                chunks.append(chunk)
+        return chunks
+
+    def get_boundaries(
+        self, text: str, lines: List[str], language: Optional[str]
+    ) -> List[List[int]]:
+        """
+        Finds the lines where chunks can start.
+
+        Args:
+            text (str): The content of the file.
+            lines (List[str]): The lines of the file.
+            language (Optional[str]): The language of the file, None for plain text.
+
+        Returns:
+            List[List[int]]: The sorted 0-based line numbers of every boundary level, strongest first.
+        """
+        boundaries = None
+        if language == "python":
+            boundaries = get_python_boundaries(text, lines)
+        if boundaries is None:
+            line_starts = [0, *accumulate(len(line) for line in lines)]
+            boundaries = [
+                sorted(
+                    {
+                        bisect_right(line_starts, match.start()) - 1
+                        for match in pattern.finditer(text)
+                    }
+                )
+                for pattern in BOUNDARIES.get(language, ())
+            ]
+        boundaries.append([i for i, line in enumerate(lines) if not line.strip()])
+        return boundaries
+
+    def split(
+        self,
+        start: int,
+        end: int,
+        boundaries: List[List[int]],
+        level: int,
+        token_sums: List[int],
+    ) -> List[Tuple[int, int]]:
+        """
+        Splits a range of lines at its strongest boundaries and merges the pieces that fit together.
+
+        Args:
+            start (int): The first line of the range.
+            end (int): The line after the range.
+            boundaries (List[List[int]]): The boundaries of every level, as returned by get_boundaries.
+            level (int): The first boundary level to split at.
+            token_sums (List[int]): The cumulative token counts of the lines.
+
+        Returns:
+            List[Tuple[int, int]]: The (start, end) line ranges of the chunks.
+        """
+        if token_sums[end] - token_sums[start] <= self.max_tokens or end - start == 1:
+            return [(start, end)]
+
+        cuts = []
+        while level < len(boundaries) and not cuts:
+            level_boundaries = boundaries[level]
+            cuts = level_boundaries[
+                bisect_right(level_boundaries, start) : bisect_left(
+                    level_boundaries, end
+                )
+            ]
+            level += 1
+        if not cuts:
+            cuts = range(start + 1, end)
+
+        ranges = []
+        current_start = current_end = start
+        for piece_start, piece_end in zip([start, *cuts], [*cuts, end]):
+            if token_sums[piece_end] - token_sums[current_start] <= self.max_tokens:
+                current_end = piece_end
+                continue
+            if token_sums[piece_end] - token_sums[piece_start] <= self.max_tokens:
+                if current_end > current_start:
+                    ranges.append((current_start, current_end))
+                current_start, current_end = piece_start, piece_end
+                continue
+
+            pieces = self.split(piece_start, piece_end, boundaries, level, token_sums)
+            if current_end > current_start:
+                # What precedes a split piece, e.g. a class header, joins its first chunk if it fits
+                first_end = pieces[0][1]
+                if token_sums[first_end] - token_sums[current_start] <= self.max_tokens:
+                    pieces[0] = (current_start, first_end)
+                else:
+                    ranges.append((current_start, current_end))
+            ranges += pieces
+            current_start = current_end = piece_end
+        if current_end > current_start:
+            ranges.append((current_start, current_end))
+        return ranges
+
+    def split_line(self, line: str, line_number: int) -> List[Chunk]:
+        """
+        Splits a line longer than max_tokens, e.g. minified code, into even pieces cut at token
+        boundaries, so every piece fits in a chunk.
+
+        Args:
+            line (str): The line.
+            line_number (int): The 1-based number of the line.
+
+        Returns:
+            List[Chunk]: The pieces of the line.
+        """
+        tokens = self.encoding.encode_ordinary(line.rstrip())
+        n_pieces = -(-len(tokens) // self.max_tokens)
+        size = -(-len(tokens) // n_pieces)
+        return [
+            Chunk(self.encoding.decode(tokens[i : i + size]), line_number, line_number)
+            for i in range(0, len(tokens), size)
+        ]
+
+    @staticmethod
+    def make_chunk(lines: List[str], start: int, end: int) -> Optional[Chunk]:
+        """
+        Builds a chunk from a range of lines, without its leading and trailing blank lines.
+
+        Args:
+            lines (List[str]): The lines of the file.
+            start (int): The first line of the range.
+            end (int): The line after the range.
+
+        Returns:
+            Optional[Chunk]: The chunk, or None if the range is blank.
+        """
+        while start < end and not lines[start].strip():
+            start += 1
+        while end > start and not lines[end - 1].strip():
+            end -= 1
+        if start == end:
+            return None
+        return Chunk("".join(lines[start:end]).rstrip(), start + 1, end)
+
+
+def get_python_boundaries(text: str, lines: List[str]) -> Optional[List[List[int]]]:
+    """
+    Finds the boundaries of a Python file with ast: top-level statements, then the statements
+    of top-level definitions, e.g. methods. Decorators and the comments right above a statement
+    stay with it.
+
+    Args:
+        text (str): The content of the file.
+        lines (List[str]): The lines of the file.
+
+    Returns:
+        Optional[List[List[int]]]: The sorted 0-based line numbers of both levels, or None if the file can't be parsed.
+    """
+    tree = parse_python(text)
+    if tree is None:
+        return None
+
+    def first_line(node: ast.stmt) -> int:
+        line = min(
+            [node.lineno]
+            + [decorator.lineno for decorator in getattr(node, "decorator_list", ())]
+        )
+        line -= 1
+        while line > 0 and lines[line - 1].lstrip().startswith("#"):
+            line -= 1
+        return line
+
+    definitions = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+    return [
+        sorted({first_line(node) for node in tree.body}),
+        sorted(
+            {
+                first_line(child)
+                for node in tree.body
+                if isinstance(node, definitions)
+                for child in node.body
+            }
+        ),
+    ]
+
+
+@lru_cache(maxsize=16)
+def parse_python(text: str) -> Optional[ast.Module]:
+    """
+    Parses a Python file, caching the last trees so the chunker and the symbol index parse a file once.
+
+    Args:
+        text (str): The content of the file.
+
+    Returns:
+        Optional[ast.Module]: The tree of the file, or None if it can't be parsed.
+    """
+    try:
+        return ast.parse(text)
+    except (SyntaxError, ValueError):
+        return None
@@ -1,13 +1,22 @@
+import asyncio
 import github
+import json
 import re
 import traceback
-from typing import List
+from typing import TYPE_CHECKING, List, Optional, Tuple
 import logging
 
 # Local Imports
+from DiffPositionIndex import DiffPositionIndex
 from GPTsettings import GPTsettings
 from GithubHandlers import GithubHandler
+from PRSnapshot import PRSnapshot
 from GPTutils import GPTWrapper
+from PromptPacker import FileDelta, PackedPrompt, PromptPacker
+from RequestScheduler import scheduler
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
 
 
 class ParsingError(Exception):
@@ -20,27 +29,39 @@ class ParsingError(Exception):
 
 class ResponseParser:
     """
-    A class used to parse a response and extract a Python code block.
+    A class used to parse and validate a review answered as a JSON object.
+
+    Common mistakes are repaired locally instead of asking for a new answer: the JSON object
+    is extracted from surrounding text, trailing commas are removed, unknown events become
+    "COMMENT", invalid sides become "RIGHT", lines given as strings are converted, invalid
+    multi-line ranges are reduced to single-line comments and comments without path, line or
+    body are dropped.
 
     Attributes
     ----------
-    python_code : str
-        The Python code block extracted from the response.
+    review : dict
+        The JSON object of the response.
 
     Methods
     -------
-    parse_python_code(llm_answer):
-        Extracts the Python code block from the response using a regex pattern.
+    parse_json(llm_answer):
+        Extracts the JSON object from the response.
+    remove_trailing_commas(text):
+        Removes the commas closing JSON objects and arrays.
     get_body_event_and_comments():
-        Executes the Python code block and returns the values of 'body', 'event', and 'comments'.
+        Returns the validated values of 'body', 'event', and 'comments'.
     """
 
+    EVENTS = ("COMMENT", "REQUEST_CHANGES", "APPROVE")
+    SIDES = ("LEFT", "RIGHT")
+    CLOSING_BRACKET = re.compile(r"\s*[}\]]")
+
     def __init__(self, response):
-        self.python_code = self.parse_python_code(response)
+        self.review = self.parse_json(response)
 
-    def parse_python_code(self, llm_answer):
+    def parse_json(self, llm_answer):
         """
-        Extracts the Python code block from the response using a regex pattern.
+        Extracts the JSON object from the response.
 
         Parameters
         ----------
@@ -49,73 +70,155 @@ class ResponseParser:
 
         Returns
         -------
-        str
-            The Python code block extracted from the response.
+        dict
+            The JSON object of the response.
 
         Raises
         ------
-        Exception
-            If no Python code block is found in the response.
-        """
-        pattern = r"```python\n([\s\S]*?)\n```"
-        match = re.search(pattern, llm_answer)
-        if match:
-            python_code_block = match.group(1)
-            print("Found Python Block: ", python_code_block)
-            return python_code_block
-        else:
+        ParsingError
+            If the response has no valid JSON object.
+        """
+        try:
+            review = json.loads(llm_answer)
+        except json.JSONDecodeError as error:
+            # e.g. an object wrapped in a markdown block, or with trailing commas
+            start, end = llm_answer.find("{"), llm_answer.rfind("}")
+            if start == -1 or end < start:
+                raise ParsingError(f"Invalid JSON: {error}")
+            candidate = llm_answer[start : end + 1]
+            try:
+                review = json.loads(candidate)
+            except json.JSONDecodeError:
+                try:
+                    review = json.loads(self.remove_trailing_commas(candidate))
+                except json.JSONDecodeError as error:
+                    raise ParsingError(f"Invalid JSON: {error}")
+        if not isinstance(review, dict):
             raise ParsingError(
-                "No python snippet provided. Please include a python code block using the markdown format ```python ... ``` for clarity and proper parsing."
+                "The answer must be a JSON object with 'body', 'event' and 'comments' keys"
             )
+        return review
+
+    @classmethod
+    def remove_trailing_commas(cls, text: str) -> str:
+        """
+        Removes the commas closing JSON objects and arrays, outside of strings.
+
+        Parameters
+        ----------
+        text : str
+            The JSON text.
+
+        Returns
+        -------
+        str
+            The text without trailing commas.
+        """
+        kept = []
+        in_string = escaped = False
+        for i, char in enumerate(text):
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == "\\":
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char == "," and cls.CLOSING_BRACKET.match(text, i + 1):
+                continue
+            kept.append(char)
+        return "".join(kept)
 
     def get_body_event_and_comments(self):
         """
-        Executes the Python code block and returns the values of 'body', 'event', and 'comments'.
+        Returns the validated values of 'body', 'event', and 'comments'.
 
         Returns
         -------
         tuple
             A tuple containing the values of 'body', 'event', and 'comments'.
+
+        Raises
+        ------
+        ParsingError
+            If the review has no body.
         """
-        locals_dict = {}
-        try:
-            exec(self.python_code, locals_dict)
-        except Exception:
-            raise ParsingError("Error executing python code")
-
-        return (
-            locals_dict["body"],
-            locals_dict["event"],
-            self.verify_comments_comply(locals_dict["comments"]),
-        )
+        body = self.review.get("body")
+        if not isinstance(body, str) or not body.strip():
+            raise ParsingError("The 'body' key is missing or empty")
+
+        event = str(self.review.get("event") or "").upper().replace(" ", "_")
+        if event not in self.EVENTS:
+            event = "COMMENT"
+
+        comments = self.review.get("comments") or []
+        if not isinstance(comments, list):
+            logging.warning("Ignoring 'comments', not a list: %s", comments)
+            comments = []
+        return body, event, self.verify_comments_comply(comments)
+
+    @staticmethod
+    def to_line(value) -> Optional[int]:
+        """
+        Converts a line number given as an integer or a string.
+
+        Parameters
+        ----------
+        value : Any
+            The line number.
+
+        Returns
+        -------
+        Optional[int]
+            The line number, or None if it is not a positive integer.
+        """
+        if isinstance(value, bool):
+            return None
+        if isinstance(value, str) and value.strip().isdigit():
+            value = int(value)
+        return value if isinstance(value, int) and value > 0 else None
 
     def verify_comments_comply(self, comments: List[dict]):
-        """Verifies comment dicts comply with the expected format
+        """Verifies comment dicts comply with the expected format, repairing them when possible
 
         Args:
             comments (List[dict]): A list of comment dicts
         """
         new_comments = []
         for comment in comments:
-            # Remove keys that are not needed for the review
-            new_comment = comment.copy()
-            if new_comment["side"] not in ["LEFT", "RIGHT"]:
-                new_comment.pop(new_comment["side"])
-            if "start_line" in new_comment:
-                if new_comment["start_line"] is None:
-                    new_comment.pop("start_line")
-            if "start_side" in new_comment:
-                if new_comment["start_side"] is None:
-                    new_comment.pop("start_side")
+            if not isinstance(comment, dict):
+                logging.warning("Dropping inline comment, not an object: %s", comment)
+                continue
+            path, body = comment.get("path"), comment.get("body")
+            line = self.to_line(comment.get("line"))
+            if not isinstance(path, str) or not isinstance(body, str) or line is None:
+                logging.warning(
+                    "Dropping inline comment without path, line or body: %s", comment
+                )
+                continue
+
+            side = str(comment.get("side") or "").upper()
+            if side not in self.SIDES:
+                side = "RIGHT"
+            # Keys that are not needed for the review are left out
+            new_comment = {"path": path.lstrip("/"), "line": line, "side": side}
+            start_line = self.to_line(comment.get("start_line"))
+            if start_line is not None and start_line < line:
+                start_side = str(comment.get("start_side") or side).upper()
+                new_comment["start_line"] = start_line
+                new_comment["start_side"] = (
+                    start_side if start_side in self.SIDES else side
+                )
 
             # Remove leading spaces from comment body
-            comment_body = new_comment["body"]
-            comment_lines = comment_body.split("\n")
+            comment_lines = body.split("\n")
             new_lines = []
-            for line in comment_lines:
-                if "```suggestion" in line or "```" in line:
-                    line = line.lstrip()
-                new_lines.append(line)
+            for body_line in comment_lines:
+                if "```suggestion" in body_line or "```" in body_line:
+                    body_line = body_line.lstrip()
+                new_lines.append(body_line)
             new_comment["body"] = "\n".join(new_lines)
             new_comments.append(new_comment)
         return new_comments
@@ -133,6 +236,25 @@ class CommentAgent:
         An instance of the GithubHandler class.
     pr : github.PullRequest.PullRequest
         An instance of the PullRequest class representing the pull request.
+    snapshot : PRSnapshot
+        The files, patches and comments of the pull request, fetched once.
+    diff_positions : DiffPositionIndex
+        The lines of the pull request diff that review comments can be attached to.
+    review_snapshot : PRSnapshot
+        The files to review: all the pull request files, or only the changes made after the last review.
+    previous_review : Optional[Tuple[str, str]]
+        The head SHA and body of the last review, when only the changes made after it are reviewed.
+    up_to_date : bool
+        Whether the head of the pull request was already reviewed.
+    delta_items : List[FileDelta]
+        The deltas of the pull request files with their retrieved context.
+    dropped_prompt_material : List[str]
+        The deltas, context chunks and comments left out of the prompts to fit the token budget.
+    custom_instructions : Optional[str]
+        The custom instructions of the repository, fetched on first use and shared by every prompt.
+    pr_messages : Optional[List[Tuple[str, str]]]
+        The (role, content) messages describing the pull request, built once and reused by every conversation.
+        Map-reduce reviews pack their own messages per shard and only build them for a fallback comment.
     GPT : GPTWrapper
         An instance of the GPTWrapper class.
     """
@@ -144,6 +266,7 @@ class CommentAgent:
         comment_only: bool = False,
         main_branch="main",
         github_auth_token: str = None,
+        github_handler: GithubHandler = None,
     ) -> None:
         """
         Initializes a CommentAgent instance.
@@ -160,15 +283,32 @@ class CommentAgent:
             The name of the main branch.
         github_auth_token : str, optional
             The GitHub authentication token.
+        github_handler : GithubHandler, optional
+            A handler shared with other agents, with its client, embeddings cache and repository indexes.
+            By default a new one is created from repo_name, main_branch and github_auth_token.
         """
         self.comment_only = comment_only
         self.main_branch = main_branch
-        self.GH = GithubHandler(
+        self.GH = github_handler or GithubHandler(
             repo_name=repo_name, main_branch=main_branch, auth_token=github_auth_token
         )
         self.GH.FILE_EXTENSIONS = GPTsettings.FILE_EXTENSIONS
         self.pr = self.get_pr(branch_or_prnum)
-        self.init_GPT()
+        self.snapshot: PRSnapshot = self.GH.get_pr_snapshot(self.pr)
+        self.diff_positions = DiffPositionIndex.from_snapshot(self.snapshot)
+        self.review_snapshot = self.snapshot
+        self.previous_review: Optional[Tuple[str, str]] = None
+        self.up_to_date = False
+        if GPTsettings.INCREMENTAL_REVIEW and not comment_only:
+            self.init_incremental_review()
+        self.custom_instructions: Optional[str] = None
+        self.pr_messages: Optional[List[Tuple[str, str]]] = None
+        self.delta_items: List[FileDelta] = []
+        self.dropped_prompt_material: List[str] = []
+        if not self.up_to_date:
+            self.delta_items = self.GH.get_pr_delta_items(self.review_snapshot)
+            if comment_only or not self.use_map_reduce():
+                self.init_GPT()
 
     @staticmethod
     def is_branch(branch_or_prnum: str) -> bool:
@@ -191,6 +331,36 @@ class CommentAgent:
         except ValueError:
             return True
 
+    def init_incremental_review(self) -> None:
+        """
+        Narrows the review to the changes made after the last review of the agent, if any. Pull
+        requests whose history was rewritten since are reviewed in full.
+        """
+        last_review = self.GH.get_last_review(self.pr)
+        if last_review is None:
+            return
+        reviewed_sha, _ = last_review
+        if reviewed_sha == self.snapshot.head_sha:
+            self.up_to_date = True
+            return
+
+        snapshot = self.GH.get_incremental_snapshot(self.snapshot, reviewed_sha)
+        if snapshot is None:
+            logging.info(
+                "Commit %s is not an ancestor of the head, reviewing the whole PR",
+                reviewed_sha,
+            )
+        elif not snapshot.files:
+            self.up_to_date = True
+        else:
+            logging.info(
+                "Reviewing %s files changed since commit %s",
+                len(snapshot.files),
+                reviewed_sha,
+            )
+            self.review_snapshot = snapshot
+            self.previous_review = last_review
+
     def init_GPT(self) -> None:
         """
         Initializes the GPTWrapper instance.
@@ -200,13 +370,16 @@ class CommentAgent:
         self.add_pr_messages()
 
     def get_custom_instructions(self) -> str:
-        """Retrieves custom instructions for the repository from a markdown file if it exists."""
+        """Retrieves custom instructions for the repository from a markdown file if it exists, once."""
+        if self.custom_instructions is not None:
+            return self.custom_instructions
         file_contents = self.GH.get_file_contents("agent-settings/README.md")
         if file_contents != "Could not retrieve file contents.":
             custom_instructions_prompt = f"""The Repository has some prdefined rules for reviewers:\n{file_contents}"""
-            return custom_instructions_prompt
+            self.custom_instructions = custom_instructions_prompt
         else:
-            return ""
+            self.custom_instructions = ""
+        return self.custom_instructions
 
     def get_pr(self, branch_or_prnum: str) -> github.PullRequest.PullRequest:
         """
@@ -229,78 +402,524 @@ class CommentAgent:
 
     def add_pr_messages(self) -> None:
         """
-        Adds messages to the GPTWrapper instance related to the pull request.
+        Adds messages to the GPTWrapper instance related to the pull request. They are built on
+        the first call only, later conversations (e.g. the fallback comment) reuse them.
         """
-        repo_instructions = self.get_custom_instructions()
-        pr_deltas = self.GH.get_pr_deltas(self.pr)
-        self.GPT.add_message(
-            "user",
-            GPTsettings.USER_INSTRUCTIONS.format(
-                repo_instructions=repo_instructions,
+        if self.pr_messages is None:
+            self.pr_messages = self.build_pr_messages()
+        for role, content in self.pr_messages:
+            self.GPT.add_message(role, content)
+
+    def build_pr_messages(self) -> List[Tuple[str, str]]:
+        """
+        Builds the messages related to the pull request from all its file deltas.
+
+        Returns:
+        --------
+        List[Tuple[str, str]]
+            The (role, content) messages.
+        """
+        messages, packed = self.pack_pr_messages(
+            self.delta_items, self.get_custom_instructions()
+        )
+        self.dropped_prompt_material = packed.dropped
+        return messages
+
+    def pack_pr_messages(
+        self, deltas: List[FileDelta], repo_instructions: str
+    ) -> Tuple[List[Tuple[str, str]], PackedPrompt]:
+        """
+        Builds the messages describing file deltas of the pull request: packs the deltas and their
+        context with the custom instructions and the comments into the token budget.
+
+        Parameters:
+        -----------
+        deltas : List[FileDelta]
+            The file deltas to review, with their retrieved context.
+        repo_instructions : str
+            The custom instructions of the repository.
+
+        Returns:
+        --------
+        Tuple[List[Tuple[str, str]], PackedPrompt]
+            The (role, content) messages, and the packed material with what was left out.
+        """
+        packer = PromptPacker()
+        incremental_messages = self.get_incremental_messages()
+        prompt_overhead = (
+            "".join(content for _, content in incremental_messages)
+            + GPTsettings.SYSTEM_PROMPT
+            + GPTsettings.USER_INSTRUCTIONS.format(
+                repo_instructions="",
                 pr_title=self.pr.title,
                 pr_user=self.pr.user,
-                pr_deltas=pr_deltas,
-            ),
+                pr_deltas="",
+            )
+            + GPTsettings.COMMENTS_PROMPT.format(comments="")
+            + GPTsettings.MESSAGE_FORMAT
         )
-        comments = self.GH.get_pr_comments(self.pr)
-        self.GPT.add_message(
-            "user", GPTsettings.COMMENTS_PROMPT.format(comments=comments)
+        packed = packer.pack(
+            deltas,
+            repo_instructions=repo_instructions,
+            comments=[f"{c.user}: {c.body}\n" for c in self.snapshot.comments],
+            reserved_tokens=packer.count_tokens(prompt_overhead)
+            + GPTsettings.REVIEW_MAX_TOKENS,
         )
 
+        comments = "".join(packed.comments)
+        messages = [
+            (
+                "user",
+                GPTsettings.USER_INSTRUCTIONS.format(
+                    repo_instructions=packed.repo_instructions,
+                    pr_title=self.pr.title,
+                    pr_user=self.pr.user,
+                    pr_deltas=self.GH.format_pr_deltas(packed.deltas),
+                ),
+            ),
+            *incremental_messages,
+            ("user", GPTsettings.COMMENTS_PROMPT.format(comments=comments)),
+        ]
+        return messages, packed
+
+    def get_incremental_messages(self) -> List[Tuple[str, str]]:
+        """
+        Builds the message telling that only the changes made after the last review are reviewed,
+        with the body of that review. It follows the message of the deltas.
+
+        Returns:
+        --------
+        List[Tuple[str, str]]
+            The (role, content) message, or no message if the whole pull request is reviewed.
+        """
+        if self.previous_review is None:
+            return []
+        reviewed_sha, previous_review = self.previous_review
+        return [
+            (
+                "user",
+                GPTsettings.INCREMENTAL_PROMPT.format(
+                    reviewed_sha=reviewed_sha, previous_review=previous_review
+                ),
+            )
+        ]
+
+    @staticmethod
+    def add_repair_messages(
+        GPT: GPTWrapper, base_length: int, answer: str, error: Exception
+    ) -> None:
+        """
+        Replaces the previous failed attempt of a conversation with a compact repair prompt: the
+        failed answer and a short summary of the error, so retries don't grow the conversation.
+
+        Parameters:
+        -----------
+        GPT : GPTWrapper
+            The conversation.
+        base_length : int
+            The number of messages of the conversation before the first attempt.
+        answer : str
+            The failed answer.
+        error : Exception
+            The error raised while using the answer.
+        """
+        summary = f"{type(error).__name__}: {error}"
+        if len(summary) > GPTsettings.REPAIR_ERROR_MAX_CHARS:
+            summary = summary[: GPTsettings.REPAIR_ERROR_MAX_CHARS] + "..."
+        GPT.truncate(base_length)
+        GPT.add_message("assistant", answer)
+        GPT.add_message("user", GPTsettings.REPAIR_PROMPT.format(error=summary))
+
+    def prepare_review(self, body: str, comments: List[dict]) -> Tuple[str, List[dict]]:
+        """
+        Prepares a review to be posted. The comments are checked against the diff, so the review
+        isn't rejected by GitHub: they are snapped to the nearest valid line, or added to the body.
+        The body is marked with the reviewed head SHA, for incremental re-reviews.
+
+        In incremental reviews the LEFT lines the model sees are lines of the last reviewed commit,
+        not of the base the diff is checked against: LEFT comments are added to the body, and ranges
+        starting on the LEFT side are reduced to their last line.
+
+        Parameters:
+        -----------
+        body : str
+            The main comment of the review.
+        comments : List[dict]
+            The inline comments of the review.
+
+        Returns:
+        --------
+        Tuple[str, List[dict]]
+            The main comment and the inline comments to post.
+        """
+        left, kept = [], []
+        for comment in comments:
+            if self.previous_review is None:
+                kept.append(comment)
+            elif comment["side"] == "LEFT":
+                left.append(comment)
+            elif comment.get("start_side") == "LEFT":
+                kept.append(
+                    {
+                        key: value
+                        for key, value in comment.items()
+                        if key not in ("start_line", "start_side")
+                    }
+                )
+            else:
+                kept.append(comment)
+        placed, demoted = self.diff_positions.place_comments(kept)
+        demoted = left + demoted
+        if demoted:
+            logging.warning(
+                "%s comments are outside the diff, adding them to the review body",
+                len(demoted),
+            )
+        body += self.diff_positions.format_demoted_comments(demoted)
+        return self.GH.add_review_marker(body, self.snapshot.head_sha), placed
+
     def comment_on_pr(self) -> None:
         """
         Comments on the pull request with the response from the GPTWrapper instance.
         """
         message_response = self.GPT.get_response(max_tokens=1000)
         logging.info("Commenting on PR with response...")
-        self.pr.create_issue_comment(message_response)
+        self.GH.request(
+            self.pr.create_issue_comment, message_response, endpoint="github.write"
+        )
 
-    def review_pr(self) -> bool:
+    def review_pr(self) -> str:
         """
-        Reviews the pull request with the response from the GPTWrapper instance.
+        Reviews the pull request with the response from the GPTWrapper instance. Answers that
+        can't be parsed or whose comments GitHub rejects (422) are repaired and asked again. Other
+        GitHub errors are not retried, as the review may have been created.
 
         Returns:
         --------
-        bool
-            True if the review was successful, False otherwise.
+        str
+            "reviewed" if the review was posted, "failed" if nothing was posted, or "unconfirmed"
+            if posting it failed in a way that may have created it.
         """
+        if self.use_map_reduce():
+            return self.review_pr_map_reduce()
+
+        self.GPT.add_message("user", GPTsettings.MESSAGE_FORMAT)
+        base_length = len(self.GPT.conversation)
         for _ in range(3):
-            message_format = GPTsettings.MESSAGE_FORMAT
-            self.GPT.add_message("user", message_format)
             message_response = self.GPT.get_response(
-                max_tokens=4096
-            )  # Max length of response is 4096 (max allowed for responses by openai)
+                max_tokens=GPTsettings.REVIEW_MAX_TOKENS,
+                response_format=GPTsettings.REVIEW_RESPONSE_FORMAT,
+            )
             try:
                 logging.info(message_response)
                 response_parser = ResponseParser(message_response)
                 body, event, comments = response_parser.get_body_event_and_comments()
-                self.pr.create_review(body=body, event=event, comments=comments)
-                print(self.GPT)
-                return True
-            except ParsingError:
-                error = traceback.format_exc()
-                logging.error(error)
-                self.GPT.add_message(
-                    "user", f"Your code failed with exception {error} try again"
+                body, comments = self.prepare_review(body, comments)
+                self.GH.request(
+                    self.pr.create_review,
+                    body=body,
+                    event=event,
+                    comments=comments,
+                    endpoint="github.write",
                 )
+                print(self.GPT)
+                return "reviewed"
+            except ParsingError as error:
+                logging.error(traceback.format_exc())
                 logging.error("Error parsing response, try again")
+                self.add_repair_messages(self.GPT, base_length, message_response, error)
+            except github.GithubException as error:
+                logging.error(f"Github Exception:\n{traceback.format_exc()}")
+                if error.status != 422:
+                    return "unconfirmed"
+                self.add_repair_messages(self.GPT, base_length, message_response, error)
+        return "failed"
+
+    def use_map_reduce(self) -> bool:
+        """
+        Decides whether the pull request is reviewed in shards, according to GPTsettings.REVIEW_MODE.
+
+        Returns:
+        --------
+        bool
+            True for map-reduce reviews, False for single-request reviews.
+        """
+        if GPTsettings.REVIEW_MODE == "auto":
+            packer = PromptPacker()
+            delta_tokens = sum(
+                packer.count_tokens(file_delta.delta) for file_delta in self.delta_items
+            )
+            return delta_tokens > GPTsettings.MAP_REDUCE_MIN_TOKENS
+        return GPTsettings.REVIEW_MODE == "map_reduce"
+
+    def get_review_shards(self) -> List[List[FileDelta]]:
+        """
+        Groups the file deltas of the pull request into shards of at most GPTsettings.SHARD_TOKEN_BUDGET
+        tokens, counted as the deltas are rendered in the prompt: with their line prefixes and their
+        context. Files too large for a shard are split into groups of hunks, each one with the
+        context of the whole file.
+
+        Returns:
+        --------
+        List[List[FileDelta]]
+            The shards, each one a list of file deltas with their context.
+        """
+        packer = PromptPacker()
+        budget = GPTsettings.SHARD_TOKEN_BUDGET
+
+        def count_tokens(file_delta: FileDelta) -> int:
+            return packer.count_tokens(self.GH.format_pr_deltas([file_delta]))
+
+        def render(hunks: List[str], file_delta: FileDelta) -> Tuple[int, FileDelta]:
+            delta = self.GH.get_file_delta("\n".join(hunks), file_delta.filename)
+            piece = file_delta._replace(delta=delta)
+            return count_tokens(piece), piece
+
+        pieces = []
+        for file_delta in self.delta_items:
+            tokens = count_tokens(file_delta)
+            file = self.review_snapshot.get_file(file_delta.filename)
+            if tokens <= budget or file is None or file.patch is None:
+                pieces.append((tokens, file_delta))
                 continue
-            except github.GithubException:
-                error = traceback.format_exc()
-                logging.error(f"Github Exception:\n{error}")
-                self.GPT.add_message(
-                    "user", f"Your code failed with exception {error} try again"
+
+            # A hunk too large for a shard on its own gets a shard of its own
+            hunk_group, group_piece = [], None
+            for hunk in self.GH.split_patch(file.patch):
+                piece = render(hunk_group + [hunk], file_delta)
+                if hunk_group and piece[0] > budget:
+                    pieces.append(group_piece)
+                    hunk_group = []
+                    piece = render([hunk], file_delta)
+                hunk_group.append(hunk)
+                group_piece = piece
+            pieces.append(group_piece)
+
+        shards = []
+        shard_tokens = 0
+        for tokens, file_delta in pieces:
+            if not shards or shard_tokens + tokens > budget:
+                shards.append([])
+                shard_tokens = 0
+            shards[-1].append(file_delta)
+            shard_tokens += tokens
+        return shards
+
+    async def areview_shard(
+        self,
+        shard: List[FileDelta],
+        repo_instructions: str,
+        semaphore: asyncio.Semaphore,
+        async_client: "AsyncOpenAI",
+    ) -> Optional[Tuple[str, str, List[dict]]]:
+        """
+        Reviews a shard of the pull request in its own conversation, with the same instructions,
+        incremental context and comments as a single-request review.
+
+        Parameters:
+        -----------
+        shard : List[FileDelta]
+            The file deltas to review.
+        repo_instructions : str
+            The custom instructions of the repository.
+        semaphore : asyncio.Semaphore
+            Limits the number of requests in flight.
+        async_client : AsyncOpenAI
+            The client shared by the shard conversations.
+
+        Returns:
+        --------
+        Optional[Tuple[str, str, List[dict]]]
+            The body, event and inline comments of the shard review, or None if no valid answer was given.
+        """
+        messages, packed = self.pack_pr_messages(shard, repo_instructions)
+        self.dropped_prompt_material += packed.dropped
+        GPT = GPTWrapper(async_client=async_client)
+        GPT.add_message("system", GPTsettings.SYSTEM_PROMPT)
+        for role, content in messages:
+            GPT.add_message(role, content)
+        GPT.add_message("user", GPTsettings.MESSAGE_FORMAT)
+        base_length = len(GPT.conversation)
+        for _ in range(3):
+            async with semaphore:
+                message_response = await GPT.aget_response(
+                    max_tokens=GPTsettings.REVIEW_MAX_TOKENS,
+                    response_format=GPTsettings.REVIEW_RESPONSE_FORMAT,
+                )
+            try:
+                response_parser = ResponseParser(message_response)
+                return response_parser.get_body_event_and_comments()
+            except ParsingError as error:
+                logging.error(traceback.format_exc())
+                self.add_repair_messages(GPT, base_length, message_response, error)
+        return None
+
+    async def areview_shards(
+        self, shards: List[List[FileDelta]], repo_instructions: str
+    ) -> List[Optional[Tuple[str, str, List[dict]]]]:
+        """
+        Reviews the shards concurrently on the running event loop, with at most
+        GPTsettings.REVIEW_MAX_WORKERS requests in flight.
+
+        Parameters:
+        -----------
+        shards : List[List[FileDelta]]
+            The shards to review.
+        repo_instructions : str
+            The custom instructions of the repository.
+
+        Returns:
+        --------
+        List[Optional[Tuple[str, str, List[dict]]]]
+            The review of every shard, in the same order as `shards`.
+        """
+        from openai import AsyncOpenAI
+
+        semaphore = asyncio.Semaphore(GPTsettings.REVIEW_MAX_WORKERS)
+        async with AsyncOpenAI(max_retries=0) as async_client:
+            return await asyncio.gather(
+                *(
+                    self.areview_shard(
+                        shard, repo_instructions, semaphore, async_client
+                    )
+                    for shard in shards
                 )
-        return False
+            )
+
+    def review_pr_map_reduce(self) -> str:
+        """
+        Reviews the pull request in shards reviewed concurrently, then merges their inline comments
+        into a single review whose body and event come from a final summarization request. If no
+        valid summary is given, the partial reviews are posted as the body.
+
+        Returns:
+        --------
+        str
+            "reviewed", "failed" or "unconfirmed", like review_pr.
+        """
+        shards = self.get_review_shards()
+        repo_instructions = self.get_custom_instructions()
+        shard_reviews = [
+            review
+            for review in asyncio.run(self.areview_shards(shards, repo_instructions))
+            if review is not None
+        ]
+        if not shard_reviews:
+            return "failed"
+
+        comments = [
+            comment
+            for _, _, shard_comments in shard_reviews
+            for comment in shard_comments
+        ]
+        partial_reviews = "\n\n".join(
+            f"Partial review {i + 1} ({event}):\n{body}"
+            for i, (body, event, _) in enumerate(shard_reviews)
+        )
+        GPT = GPTWrapper()
+        GPT.add_message("system", GPTsettings.SYSTEM_PROMPT)
+        GPT.add_message(
+            "user",
+            GPTsettings.SUMMARY_PROMPT.format(
+                pr_title=self.pr.title, partial_reviews=partial_reviews
+            ),
+        )
+        GPT.add_message("user", GPTsettings.SUMMARY_FORMAT)
+        base_length = len(GPT.conversation)
+        for _ in range(3):
+            message_response = GPT.get_response(
+                max_tokens=1000, response_format=GPTsettings.REVIEW_RESPONSE_FORMAT
+            )
+            try:
+                response_parser = ResponseParser(message_response)
+                body, event, _ = response_parser.get_body_event_and_comments()
+                break
+            except ParsingError as error:
+                logging.error(traceback.format_exc())
+                self.add_repair_messages(GPT, base_length, message_response, error)
+        else:
+            logging.error("No valid summary of the shard reviews, posting them as is")
+            body, event = partial_reviews, "COMMENT"
+        return self.post_review(body, event, comments)
+
+    def post_review(self, body: str, event: str, comments: List[dict]) -> str:
+        """
+        Posts a review built from its parts. If GitHub rejects its inline comments (422), the
+        review is posted again with every comment in the body. Other errors are not retried, as
+        the review may have been created.
+
+        Parameters:
+        -----------
+        body : str
+            The main comment of the review.
+        event : str
+            The review event.
+        comments : List[dict]
+            The inline comments of the review.
+
+        Returns:
+        --------
+        str
+            "reviewed", "failed" or "unconfirmed", like review_pr.
+        """
+        marked_body, placed = self.prepare_review(body, comments)
+        try:
+            self.GH.request(
+                self.pr.create_review,
+                body=marked_body,
+                event=event,
+                comments=placed,
+                endpoint="github.write",
+            )
+            return "reviewed"
+        except github.GithubException as error:
+            logging.error(f"Github Exception:\n{traceback.format_exc()}")
+            if error.status != 422:
+                return "unconfirmed"
+            if not placed:
+                return "failed"
+
+        logging.warning("Posting the review again with its comments in the body")
+        marked_body, _ = self.prepare_review(
+            body + self.diff_positions.format_demoted_comments(placed), []
+        )
+        try:
+            self.GH.request(
+                self.pr.create_review,
+                body=marked_body,
+                event=event,
+                comments=[],
+                endpoint="github.write",
+            )
+            return "reviewed"
+        except github.GithubException as error:
+            logging.error(f"Github Exception:\n{traceback.format_exc()}")
+            return "failed" if error.status == 422 else "unconfirmed"
 
-    def run(self) -> None:
+    def run(self) -> str:
         """
         Runs the CommentAgent instance.
+
+        Returns:
+        --------
+        str
+            What was done: "up_to_date", "commented", "reviewed", or "unconfirmed" if posting the
+            review failed in a way that may have created it.
         """
-        if self.comment_only:
+        if self.up_to_date:
+            logging.info("The head of the PR was already reviewed, nothing to do")
+            outcome = "up_to_date"
+        elif self.comment_only:
             self.comment_on_pr()
+            outcome = "commented"
         else:
-            success = self.review_pr()
-            if not success:
+            outcome = self.review_pr()
+            if outcome == "unconfirmed":
+                # A fallback comment could come on top of the review
+                logging.warning("The review may not have been posted, not commenting")
+            elif outcome == "failed":
                 self.init_GPT()
                 self.comment_on_pr()
+                outcome = "commented"
+        logging.info("Request scheduler metrics: %s", scheduler.get_metrics())
+        return outcome
@@ -0,0 +1,216 @@
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Tuple
+import re
+
+from GPTsettings import GPTsettings
+from PRSnapshot import PRSnapshot
+
+HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,\d+)? \+(\d+)(?:,\d+)? @@")
+# Suggested changes replace the commented lines when applied, so they are never moved
+SUGGESTION = re.compile(r"^[ \t]*```suggestion\b", re.MULTILINE)
+
+
+class DiffPositionIndex:
+    """
+    The lines of a pull request diff that review comments can be attached to.
+
+    Every valid (path, line, side) position is mapped to the hunk it belongs to, so a comment
+    is checked with a dict lookup and a multi-line range is valid when both of its ends are in
+    the same hunk. The sorted lines of every (path, side) are kept to snap comments to the
+    nearest valid line.
+    """
+
+    def __init__(self, patches: Dict[str, Optional[str]]) -> None:
+        """
+        Initializes a new instance of the DiffPositionIndex class.
+
+        Args:
+            patches (Dict[str, Optional[str]]): The patch of every changed file. {Filename: Patch}
+        """
+        self.hunks: Dict[Tuple[str, int, str], int] = {}
+        self.lines: Dict[Tuple[str, str], List[int]] = {}
+        for path, patch in patches.items():
+            if patch:
+                self.add_patch(path, patch)
+        for lines in self.lines.values():
+            lines.sort()
+
+    @classmethod
+    def from_snapshot(cls, snapshot: PRSnapshot) -> "DiffPositionIndex":
+        """
+        Builds the index of the diff of a pull request.
+
+        Args:
+            snapshot (PRSnapshot): The pull request.
+
+        Returns:
+            DiffPositionIndex: The index of the pull request diff.
+        """
+        return cls({file.filename: file.patch for file in snapshot.files})
+
+    def add_patch(self, path: str, patch: str) -> None:
+        """
+        Adds the positions of the hunks of a file patch.
+
+        Args:
+            path (str): The path to the file.
+            patch (str): The patch of the file.
+        """
+        hunk = -1
+        left_line = right_line = 0
+        for line in patch.split("\n"):
+            match = HUNK_HEADER.match(line)
+            if match:
+                hunk += 1
+                left_line, right_line = int(match.group(1)), int(match.group(2))
+            elif hunk < 0 or line.startswith("\\"):
+                continue  # "\ No newline at end of file"
+            elif line.startswith("-"):
+                self.add_position(path, left_line, "LEFT", hunk)
+                left_line += 1
+            elif line.startswith("+"):
+                self.add_position(path, right_line, "RIGHT", hunk)
+                right_line += 1
+            else:
+                # Context lines can be commented on both sides
+                self.add_position(path, left_line, "LEFT", hunk)
+                self.add_position(path, right_line, "RIGHT", hunk)
+                left_line += 1
+                right_line += 1
+
+    def add_position(self, path: str, line: int, side: str, hunk: int) -> None:
+        """
+        Adds a valid position.
+
+        Args:
+            path (str): The path to the file.
+            line (int): The line number on the side of the diff.
+            side (str): LEFT or RIGHT.
+            hunk (int): The index of the hunk in the file patch.
+        """
+        self.hunks[(path, line, side)] = hunk
+        self.lines.setdefault((path, side), []).append(line)
+
+    def is_valid(self, path: str, line: int, side: str) -> bool:
+        """
+        Checks whether a comment can be attached to a position.
+
+        Args:
+            path (str): The path to the file.
+            line (int): The line number on the side of the diff.
+            side (str): LEFT or RIGHT.
+
+        Returns:
+            bool: True if the position is in the diff.
+        """
+        return (path, line, side) in self.hunks
+
+    def is_valid_range(
+        self, path: str, start_line: int, start_side: str, line: int, side: str
+    ) -> bool:
+        """
+        Checks whether a multi-line comment can be attached to a range.
+
+        Args:
+            path (str): The path to the file.
+            start_line (int): The first line of the range.
+            start_side (str): The side of the first line.
+            line (int): The last line of the range.
+            side (str): The side of the last line.
+
+        Returns:
+            bool: True if both ends are in the same hunk of the diff.
+        """
+        start_hunk = self.hunks.get((path, start_line, start_side))
+        return start_hunk is not None and start_hunk == self.hunks.get(
+            (path, line, side)
+        )
+
+    def snap(self, path: str, line: int, side: str, max_distance: int) -> Optional[int]:
+        """
+        Finds the valid line nearest to a line, on the same side: the line numbers of the two
+        sides refer to different versions of the file.
+
+        Args:
+            path (str): The path to the file.
+            line (int): The line number.
+            side (str): LEFT or RIGHT.
+            max_distance (int): The maximum number of lines to move the position by.
+
+        Returns:
+            Optional[int]: The nearest valid line, or None if there is none within max_distance lines.
+        """
+        lines = self.lines.get((path, side), [])
+        i = bisect_left(lines, line)
+        candidates = [
+            candidate
+            for candidate in lines[max(i - 1, 0) : i + 1]
+            if abs(candidate - line) <= max_distance
+        ]
+        return min(
+            candidates, key=lambda candidate: abs(candidate - line), default=None
+        )
+
+    def place_comments(
+        self,
+        comments: Iterable[dict],
+        max_distance: int = GPTsettings.DIFF_SNAP_MAX_DISTANCE,
+    ) -> Tuple[List[dict], List[dict]]:
+        """
+        Checks review comments against the diff before they are posted. Comments outside the
+        diff are moved to the nearest valid line of their side, and invalid ranges are reduced to
+        their last line; comments that can't be placed are returned apart, to be added to the
+        review body. Comments suggesting changes are only posted where they were written.
+
+        Args:
+            comments (Iterable[dict]): The review comments.
+            max_distance (int, optional): The maximum number of lines a comment is moved by. Defaults to GPTsettings.DIFF_SNAP_MAX_DISTANCE.
+
+        Returns:
+            Tuple[List[dict], List[dict]]: The comments that can be posted, and the ones that can't.
+        """
+        placed, demoted = [], []
+        for comment in comments:
+            path, line, side = comment["path"], comment["line"], comment["side"]
+            suggestion = SUGGESTION.search(comment["body"]) is not None
+            if not self.is_valid(path, line, side):
+                line = None if suggestion else self.snap(path, line, side, max_distance)
+                if line is None:
+                    demoted.append(comment)
+                    continue
+                comment = {**comment, "line": line}
+
+            if "start_line" in comment and not (
+                comment["start_line"] < line
+                and self.is_valid_range(
+                    path, comment["start_line"], comment["start_side"], line, side
+                )
+            ):
+                if suggestion:
+                    demoted.append(comment)
+                    continue
+                comment = {
+                    key: value
+                    for key, value in comment.items()
+                    if key not in ("start_line", "start_side")
+                }
+            placed.append(comment)
+        return placed, demoted
+
+    @staticmethod
+    def format_demoted_comments(comments: List[dict]) -> str:
+        """
+        Formats the comments that couldn't be placed on the diff, to be added to the review body.
+
+        Args:
+            comments (List[dict]): The comments.
+
+        Returns:
+            str: The comments with their intended position, or "" if there are none.
+        """
+        if not comments:
+            return ""
+        return "\n\n---\n" + "\n\n".join(
+            f"**{comment['path']}** (line {comment['line']}):\n{comment['body']}"
+            for comment in comments
+        )
@@ -0,0 +1,224 @@
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import hashlib
+import re
+
+import numpy as np
+
+from GPTsettings import GPTsettings
+from VectorStore import chunk_hash
+
+# Words and runs of operators or punctuation, so "a < b" and "a > b" have different features
+TOKEN = re.compile(r"\w+|[^\w\s]+")
+BITS = np.arange(64, dtype=np.uint64)
+# A fingerprint is split in BANDS bands of 16 bits: two fingerprints at most 3 bits apart share
+# at least one band, so near duplicates are only searched among the groups sharing a band
+BANDS = 4
+BAND_BITS = 64 // BANDS
+
+
+def hash_feature(feature: str) -> int:
+    """
+    Hashes a SimHash feature to 64 independent bits. The hash is stable across processes, unlike
+    the salted hash().
+
+    Args:
+        feature (str): The feature.
+
+    Returns:
+        int: The 64 bits hash.
+    """
+    return int.from_bytes(
+        hashlib.blake2b(feature.encode(), digest_size=8).digest(), "little"
+    )
+
+
+def simhash(text: str) -> int:
+    """
+    Computes the SimHash fingerprint of a text from its token pairs, so texts differing by a few
+    tokens have fingerprints differing by a few bits. Texts without any token, e.g. blank
+    chunks, are fingerprinted as a whole.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        int: The 64 bits fingerprint.
+    """
+    tokens = TOKEN.findall(text)
+    features = {" ".join(pair) for pair in zip(tokens, tokens[1:])} or set(tokens)
+    if not features:
+        return hash_feature(text)
+    hashes = np.array([hash_feature(feature) for feature in features], dtype=np.uint64)
+    bit_counts = ((hashes[:, None] >> BITS) & np.uint64(1)).sum(axis=0)
+    return int((np.uint64(1) << BITS)[bit_counts * 2 > len(hashes)].sum())
+
+
+class DuplicateIndex:
+    """
+    Assigns the chunks of an index to groups of duplicates: chunks with the same content, found
+    with a content hash, and near duplicates (vendored copies, generated code, license headers),
+    whose SimHash fingerprints are at most max_distance bits apart.
+
+    Every group keeps the fingerprint of its first chunk. The buckets of the bands hold tuples
+    that are replaced rather than modified, so copies only copy the dicts.
+    """
+
+    def __init__(
+        self, max_distance: int = GPTsettings.NEAR_DUPLICATE_MAX_DISTANCE
+    ) -> None:
+        """
+        Initializes a new, empty instance of the DuplicateIndex class.
+
+        Args:
+            max_distance (int, optional): The maximum number of different bits between near duplicates, at most 3,
+                or -1 to only group identical chunks. Defaults to GPTsettings.NEAR_DUPLICATE_MAX_DISTANCE.
+        """
+        self.max_distance = min(max_distance, BANDS - 1)
+        self.groups_by_hash: Dict[bytes, int] = {}
+        self.simhashes: Dict[int, int] = {}
+        self.bands: List[Dict[int, Tuple[int, ...]]] = [{} for _ in range(BANDS)]
+        self.next_group = 0
+
+    def assign(self, text: str) -> int:
+        """
+        Finds the group of a chunk, creating a new group if it duplicates no other chunk.
+
+        Args:
+            text (str): The chunk content.
+
+        Returns:
+            int: The group of the chunk.
+        """
+        digest = chunk_hash(text)
+        group = self.groups_by_hash.get(digest)
+        if group is not None:
+            return group
+
+        fingerprint = simhash(text)
+        group = self.find_near_duplicate(fingerprint)
+        if group is None:
+            group = self.next_group
+            self.add_group(group, fingerprint)
+        self.groups_by_hash[digest] = group
+        return group
+
+    def find_near_duplicate(self, fingerprint: int) -> Optional[int]:
+        """
+        Finds a group whose fingerprint is at most max_distance bits away.
+
+        Args:
+            fingerprint (int): The fingerprint of a chunk.
+
+        Returns:
+            Optional[int]: The group, or None if there is none.
+        """
+        if self.max_distance < 0:
+            return None
+        for band, buckets in zip(self.get_bands(fingerprint), self.bands):
+            for group in buckets.get(band, ()):
+                if bin(fingerprint ^ self.simhashes[group]).count("1") <= (
+                    self.max_distance
+                ):
+                    return group
+        return None
+
+    def add_group(self, group: int, fingerprint: int) -> None:
+        """
+        Adds a group and its fingerprint.
+
+        Args:
+            group (int): The group.
+            fingerprint (int): The fingerprint of its first chunk.
+        """
+        self.simhashes[group] = fingerprint
+        self.next_group = max(self.next_group, group + 1)
+        if self.max_distance >= 0:
+            for band, buckets in zip(self.get_bands(fingerprint), self.bands):
+                buckets[band] = buckets.get(band, ()) + (group,)
+
+    def add_chunk(self, digest: bytes, group: int, fingerprint: int) -> None:
+        """
+        Adds a chunk whose group is already known, e.g. when loading an index.
+
+        Args:
+            digest (bytes): The content hash of the chunk.
+            group (int): The group of the chunk.
+            fingerprint (int): The fingerprint of the group.
+        """
+        self.groups_by_hash[digest] = group
+        if group not in self.simhashes:
+            self.add_group(group, fingerprint)
+
+    @classmethod
+    def from_chunks(cls, chunks: np.ndarray) -> "DuplicateIndex":
+        """
+        Rebuilds the index of the chunks of a vector store.
+
+        Args:
+            chunks (np.ndarray): The chunks side table of the store, with CHUNK_DTYPE rows.
+
+        Returns:
+            DuplicateIndex: The index.
+        """
+        index = cls()
+        for digest, group, fingerprint in zip(
+            chunks["hash"].tolist(),
+            chunks["group"].tolist(),
+            chunks["simhash"].tolist(),
+        ):
+            # Trailing null bytes are stripped from numpy bytes
+            index.add_chunk(digest.ljust(16, b"\0"), group, fingerprint)
+        return index
+
+    def retain(self, groups: Set[int]) -> None:
+        """
+        Forgets the groups that have no chunk left.
+
+        Args:
+            groups (Set[int]): The groups of the remaining chunks.
+        """
+        removed = self.simhashes.keys() - groups
+        if not removed:
+            return
+        self.groups_by_hash = {
+            digest: group
+            for digest, group in self.groups_by_hash.items()
+            if group not in removed
+        }
+        for group in removed:
+            for band, buckets in zip(
+                self.get_bands(self.simhashes.pop(group)), self.bands
+            ):
+                kept = tuple(other for other in buckets.get(band, ()) if other != group)
+                if kept:
+                    buckets[band] = kept
+                else:
+                    buckets.pop(band, None)
+
+    def copy(self) -> "DuplicateIndex":
+        """
+        Copies the index so chunks can be added to or removed from the copy without changing this one.
+
+        Returns:
+            DuplicateIndex: The copy of the index.
+        """
+        index = DuplicateIndex(self.max_distance)
+        index.groups_by_hash = dict(self.groups_by_hash)
+        index.simhashes = dict(self.simhashes)
+        index.bands = [dict(buckets) for buckets in self.bands]
+        index.next_group = self.next_group
+        return index
+
+    @staticmethod
+    def get_bands(fingerprint: int) -> Iterable[int]:
+        """
+        Splits a fingerprint in bands.
+
+        Args:
+            fingerprint (int): The fingerprint.
+
+        Returns:
+            Iterable[int]: The value of every band.
+        """
+        mask = (1 << BAND_BITS) - 1
+        return ((fingerprint >> (band * BAND_BITS)) & mask for band in range(BANDS))
@@ -0,0 +1,146 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List
+
+import numpy as np
+from GPTsettings import GPTsettings
+
+
+class EmbeddingCache:
+    """
+    Disk-backed cache of chunk embeddings, keyed by embedding model and chunk content hash.
+
+    Entries live in a SQLite database so they survive between workflow runs, and the
+    least recently used entries are evicted once the cache grows past `max_entries`.
+    """
+
+    # SQLite limits the number of host parameters in a single statement
+    QUERY_BATCH_SIZE = 500
+
+    def __init__(
+        self,
+        path: str = GPTsettings.EMBEDDINGS_CACHE_PATH,
+        max_entries: int = GPTsettings.EMBEDDINGS_CACHE_MAX_ENTRIES,
+    ) -> None:
+        """
+        Initializes a new instance of the EmbeddingCache class.
+
+        Args:
+            path (str, optional): Path of the SQLite database file. Defaults to GPTsettings.EMBEDDINGS_CACHE_PATH.
+            max_entries (int, optional): Maximum number of embeddings kept on disk. Defaults to GPTsettings.EMBEDDINGS_CACHE_MAX_ENTRIES.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+            )
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        """
+        Builds the cache key of a chunk.
+
+        Args:
+            model (str): The name of the embedding model.
+            text (str): The chunk content.
+
+        Returns:
+            str: A sha256 hex digest of the model name and the chunk content.
+        """
+        return hashlib.sha256(f"{model}\0{text}".encode()).hexdigest()
+
+    def get_many(self, model: str, texts: List[str]) -> Dict[str, List[float]]:
+        """
+        Looks up the embeddings of several chunks and refreshes their last use time.
+
+        Args:
+            model (str): The name of the embedding model.
+            texts (List[str]): The chunks to look up.
+
+        Returns:
+            Dict[str, List[float]]: The cached embeddings, keyed by chunk content. Misses are left out.
+        """
+        keys = {self.make_key(model, text): text for text in texts}
+        found = {}
+        key_list = list(keys)
+        with self.lock:
+            for start in range(0, len(key_list), self.QUERY_BATCH_SIZE):
+                batch = key_list[start : start + self.QUERY_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                rows = self.conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    batch,
+                ).fetchall()
+                for key, vector in rows:
+                    found[keys[key]] = np.frombuffer(vector, dtype=np.float32).tolist()
+                if rows:
+                    now = time.time()
+                    with self.conn:
+                        self.conn.executemany(
+                            "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                            [(now, key) for key, _ in rows],
+                        )
+        return found
+
+    def put_many(
+        self, model: str, texts: List[str], vectors: List[List[float]]
+    ) -> None:
+        """
+        Stores the embeddings of several chunks and evicts old entries if needed.
+
+        Args:
+            model (str): The name of the embedding model.
+            texts (List[str]): The chunks that were embedded.
+            vectors (List[List[float]]): The embeddings, in the same order as `texts`.
+        """
+        now = time.time()
+        rows = [
+            (
+                self.make_key(model, text),
+                np.asarray(vector, dtype=np.float32).tobytes(),
+                now,
+            )
+            for text, vector in zip(texts, vectors)
+        ]
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                    rows,
+                )
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        Deletes the least recently used entries until the cache fits in `max_entries`.
+        """
+        (count,) = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        overflow = count - self.max_entries
+        if overflow <= 0:
+            return
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                (overflow,),
+            )
+
+    def __len__(self) -> int:
+        """
+        Returns the number of cached embeddings.
+        """
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
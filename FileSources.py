@@ -0,0 +1,469 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional
+import base64
+import os
+import subprocess
+import threading
+import traceback
+
+from github import GithubException
+from GPTsettings import GPTsettings
+from RequestScheduler import scheduler
+
+
+class DiffFile(NamedTuple):
+    """
+    A file changed between two commits, with the same fields as the files of a GitHub pull request.
+    """
+
+    filename: str
+    status: str
+    sha: Optional[str]
+    patch: Optional[str]
+    previous_filename: Optional[str] = None
+
+
+class FileSource(ABC):
+    """
+    Base class of the backends GithubHandler reads repository files from.
+    """
+
+    @abstractmethod
+    def get_file_contents(self, filepath: str, ref=None) -> str:
+        """
+        Gets the contents of a file in the repository.
+
+        Args:
+            filepath (str): The path to the file.
+            ref (str, optional): The reference to the commit. Defaults to None.
+
+        Returns:
+            str: The contents of the file, or "Could not retrieve file contents." if it can't be read.
+        """
+
+    @abstractmethod
+    def get_blob_contents(self, sha: str) -> str:
+        """
+        Gets the contents of a blob.
+
+        Args:
+            sha (str): The SHA of the blob.
+
+        Returns:
+            str: The contents of the blob.
+        """
+
+    def list_files(self, ref=None) -> List[str]:
+        """
+        Lists the paths of all files in the repository.
+
+        Args:
+            ref (str, optional): The reference to the commit. Defaults to None.
+
+        Returns:
+            List[str]: The paths of the files.
+        """
+        return list(self.list_blobs(ref=ref))
+
+    @abstractmethod
+    def list_blobs(self, ref=None) -> Dict[str, str]:
+        """
+        Lists the files in the repository with the SHAs of their blobs.
+
+        Args:
+            ref (str, optional): The reference to the commit. Defaults to None.
+
+        Returns:
+            Dict[str, str]: The blob SHAs keyed by file path.
+        """
+
+    @abstractmethod
+    def get_pr_files(self, pr) -> List:
+        """
+        Gets the files changed in a pull request, with their patches.
+
+        Args:
+            pr (PullRequest): The pull request.
+
+        Returns:
+            List: The changed files, each with `filename`, `status`, `sha` and `patch` attributes.
+        """
+
+    def get_pr_file_contents(self, file, ref=None) -> str:
+        """
+        Gets the contents of a file changed in a pull request, by blob SHA when it is known.
+
+        Args:
+            file (File): The pull request file.
+            ref (str, optional): The reference to the commit, used when the blob can't be fetched. Defaults to None.
+
+        Returns:
+            str: The contents of the file.
+        """
+        if file.sha and file.status != "removed":
+            try:
+                return self.get_blob_contents(file.sha)
+            except (GithubException, LookupError, UnicodeDecodeError):
+                traceback.print_exc()
+        return self.get_file_contents(file.filename, ref=ref)
+
+    def fetch_pr_files(self, files: List, ref=None) -> Dict[str, str]:
+        """
+        Gets the contents of several pull request files.
+
+        Args:
+            files (List[File]): The pull request files.
+            ref (str, optional): The reference to the commit. Defaults to None.
+
+        Returns:
+            Dict[str, str]: The contents of the files keyed by filename, in the same order as `files`.
+        """
+        return {
+            file.filename: self.get_pr_file_contents(file, ref=ref) for file in files
+        }
+
+
+class GithubAPIFileSource(FileSource):
+    """
+    Reads repository files through the GitHub REST API.
+    """
+
+    def __init__(self, repo, credential: str = None) -> None:
+        """
+        Initializes a new instance of the GithubAPIFileSource class.
+
+        Args:
+            repo (Repository): The repository to read files from.
+            credential (str, optional): The GitHub token, used to rate limit the requests. Defaults to None.
+        """
+        self.repo = repo
+        self.credential = credential
+
+    def request(self, function, *args, **kwargs):
+        """
+        Makes a GitHub request through the request scheduler.
+
+        Args:
+            function (Callable): The function making the request.
+            *args: The positional arguments of the function.
+            **kwargs: The keyword arguments of the function.
+
+        Returns:
+            Any: The result of the function.
+        """
+        return scheduler.call("github", self.credential, function, *args, **kwargs)
+
+    def get_file_contents(self, filepath: str, ref=None) -> str:
+        try:
+            file_contents = self.request(self.repo.get_contents, filepath, ref=ref)
+            if file_contents.encoding != "base64":
+                # The contents API leaves out the content of files over 1 MB
+                return self.get_blob_contents(file_contents.sha)
+            return file_contents.decoded_content.decode()
+        except:
+            traceback.print_exc()
+            return "Could not retrieve file contents."
+
+    def get_blob_contents(self, sha: str) -> str:
+        # The git blobs endpoint supports files up to 100 MB
+        blob = self.request(self.repo.get_git_blob, sha)
+        if blob.encoding == "base64":
+            return base64.b64decode(blob.content).decode()
+        return blob.content
+
+    def list_blobs(self, ref=None) -> Dict[str, str]:
+        tree = self.request(
+            self.repo.get_git_tree, ref or self.repo.default_branch, recursive=True
+        )
+        if not tree.truncated:
+            return {
+                element.path: element.sha
+                for element in tree.tree
+                if element.type == "blob"
+            }
+
+        # Recursive listings stop at 100,000 entries or 7 MB, the tree is then listed one
+        # directory level at a time
+        blobs = {}
+        trees = {"": tree.sha}
+        while trees:
+            with ThreadPoolExecutor(
+                max_workers=GPTsettings.GITHUB_MAX_WORKERS
+            ) as executor:
+                listings = list(
+                    executor.map(
+                        lambda sha: self.request(self.repo.get_git_tree, sha),
+                        trees.values(),
+                    )
+                )
+            subtrees = {}
+            for prefix, listing in zip(trees, listings):
+                if listing.truncated:
+                    raise RuntimeError(
+                        f"The listing of tree {prefix or '/'} is truncated"
+                    )
+                for element in listing.tree:
+                    if element.type == "blob":
+                        blobs[prefix + element.path] = element.sha
+                    elif element.type == "tree":
+                        subtrees[f"{prefix}{element.path}/"] = element.sha
+            trees = subtrees
+        return blobs
+
+    def get_pr_files(self, pr) -> List:
+        return list(scheduler.paginate("github", self.credential, pr.get_files()))
+
+    def fetch_pr_files(self, files: List, ref=None) -> Dict[str, str]:
+        with ThreadPoolExecutor(max_workers=GPTsettings.GITHUB_MAX_WORKERS) as executor:
+            contents = executor.map(
+                lambda file: self.get_pr_file_contents(file, ref=ref), files
+            )
+            return {file.filename: content for file, content in zip(files, contents)}
+
+
+class LocalGitFileSource(FileSource):
+    """
+    Reads repository files from a local git checkout, using a single `git cat-file --batch`
+    process for blobs. Objects missing from the checkout (e.g. in shallow clones) are read
+    from the fallback source.
+    """
+
+    STATUSES = {
+        "A": "added",
+        "M": "modified",
+        "D": "removed",
+        "R": "renamed",
+        "C": "copied",
+        "T": "changed",
+    }
+
+    def __init__(self, repo_path: str, fallback: FileSource = None) -> None:
+        """
+        Initializes a new instance of the LocalGitFileSource class.
+
+        Args:
+            repo_path (str): The path to the git checkout.
+            fallback (FileSource, optional): The source used for objects missing from the checkout. Defaults to None.
+        """
+        self.repo_path = repo_path
+        self.fallback = fallback
+        self.lock = threading.Lock()
+        self.cat_file_process = None
+
+    def run_git(self, *args: str) -> bytes:
+        """
+        Runs a git command in the checkout. The output is left undecoded: paths and file contents
+        are not necessarily UTF-8, and patches keep their CRLF line endings.
+
+        Args:
+            *args (str): The arguments of the git command.
+
+        Returns:
+            bytes: The standard output of the command.
+
+        Raises:
+            subprocess.CalledProcessError: If the command fails.
+        """
+        return subprocess.run(
+            ["git", "-C", self.repo_path, *args],
+            capture_output=True,
+            check=True,
+        ).stdout
+
+    @staticmethod
+    def decode_paths(output: bytes) -> List[str]:
+        """
+        Splits the output of a git command run with `-z` into paths. Bytes that are not UTF-8 are
+        kept as surrogates, like `os.fsdecode` does, so the paths can still be read from the checkout.
+
+        Args:
+            output (bytes): The NUL separated output.
+
+        Returns:
+            List[str]: The fields of the output, the empty last one included.
+        """
+        return [field.decode(errors="surrogateescape") for field in output.split(b"\0")]
+
+    def cat_file(self, object_name: str) -> Optional[bytes]:
+        """
+        Reads a blob from the object database.
+
+        Args:
+            object_name (str): A blob SHA or a `<ref>:<path>` object name.
+
+        Returns:
+            Optional[bytes]: The contents of the blob, or None if it is not in the checkout.
+        """
+        with self.lock:
+            process = self.cat_file_process
+            if process is None or process.poll() is not None:
+                process = self.cat_file_process = subprocess.Popen(
+                    ["git", "-C", self.repo_path, "cat-file", "--batch"],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                )
+            process.stdin.write(object_name.encode(errors="surrogateescape") + b"\n")
+            process.stdin.flush()
+            header = process.stdout.readline().decode().split()
+            if not header or header[-1] in ("missing", "ambiguous"):
+                # "<object> missing" or "<object> ambiguous", the object name may contain spaces
+                return None
+            _, object_type, size = header
+            data = process.stdout.read(int(size))
+            process.stdout.read(1)  # Trailing newline
+            return data if object_type == "blob" else None
+
+    def get_file_contents(self, filepath: str, ref=None) -> str:
+        if ref is None:
+            try:
+                with open(os.path.join(self.repo_path, filepath)) as file:
+                    return file.read()
+            except (OSError, UnicodeDecodeError):
+                pass
+        else:
+            data = self.cat_file(f"{ref}:{filepath}")
+            if data is not None:
+                try:
+                    return data.decode()
+                except UnicodeDecodeError:
+                    traceback.print_exc()
+                    return "Could not retrieve file contents."
+
+        if self.fallback is not None:
+            return self.fallback.get_file_contents(filepath, ref=ref)
+        return "Could not retrieve file contents."
+
+    def get_blob_contents(self, sha: str) -> str:
+        data = self.cat_file(sha)
+        if data is not None:
+            return data.decode()
+        if self.fallback is not None:
+            return self.fallback.get_blob_contents(sha)
+        raise LookupError(f"Blob {sha} is not in the local checkout.")
+
+    def list_files(self, ref=None) -> List[str]:
+        try:
+            if ref is None:
+                output = self.run_git("ls-files", "-z")
+            else:
+                output = self.run_git("ls-tree", "-r", "--name-only", "-z", ref)
+        except subprocess.CalledProcessError:
+            if self.fallback is None:
+                raise
+            return self.fallback.list_files(ref=ref)
+        return [path for path in self.decode_paths(output) if path]
+
+    def list_blobs(self, ref=None) -> Dict[str, str]:
+        try:
+            output = self.run_git("ls-tree", "-r", "-z", ref or "HEAD")
+        except subprocess.CalledProcessError:
+            if self.fallback is None:
+                raise
+            return self.fallback.list_blobs(ref=ref)
+
+        blobs = {}
+        for entry in self.decode_paths(output):
+            if not entry:
+                continue
+            info, path = entry.split("\t", 1)
+            _, object_type, sha = info.split(" ")
+            if object_type == "blob":
+                blobs[path] = sha
+        return blobs
+
+    def get_pr_files(self, pr) -> List:
+        try:
+            return self.get_diff_files(pr.base.sha, pr.head.sha)
+        except subprocess.CalledProcessError:
+            # The commits are not in the checkout, e.g. with a shallow clone
+            if self.fallback is None:
+                raise
+            return self.fallback.get_pr_files(pr)
+
+    def get_diff_files(self, base: str, head: str) -> List[DiffFile]:
+        """
+        Computes the files changed between the merge base of two commits and the second one,
+        like the files of a pull request.
+
+        Args:
+            base (str): The base commit.
+            head (str): The head commit.
+
+        Returns:
+            List[DiffFile]: The changed files with their patches.
+        """
+        diff_args = [
+            "--no-color",
+            "--no-ext-diff",
+            "--find-renames",
+            f"{base}...{head}",
+        ]
+        raw = self.run_git("diff", "--raw", "-z", "--no-abbrev", *diff_args)
+        # Files that are not UTF-8 must not fail the whole review, their bytes are replaced
+        patch = self.run_git("diff", "--patch", *diff_args).decode(errors="replace")
+
+        # Patches come in the same order as the raw entries, one "diff --git" section each
+        sections = []
+        for line in patch.split("\n"):
+            if line.startswith("diff --git "):
+                sections.append([])
+            elif sections:
+                sections[-1].append(line)
+
+        files = []
+        fields = self.decode_paths(raw)
+        i = 0
+        while i < len(fields) - 1:
+            _, _, _, new_sha, status = fields[i].split(" ")
+            status = status[0]
+            if status in ("R", "C"):
+                previous_filename, filename = fields[i + 1], fields[i + 2]
+                i += 3
+            else:
+                previous_filename, filename = None, fields[i + 1]
+                i += 2
+            files.append(
+                DiffFile(
+                    filename=filename,
+                    status=self.STATUSES.get(status, "modified"),
+                    sha=None if status == "D" else new_sha,
+                    patch=self.get_section_patch(sections[len(files)]),
+                    previous_filename=previous_filename,
+                )
+            )
+        return files
+
+    @staticmethod
+    def get_section_patch(section: List[str]) -> Optional[str]:
+        """
+        Extracts the hunks of a `git diff` file section, in the format GitHub uses for patches.
+
+        Args:
+            section (List[str]): The lines of the section after its "diff --git" header.
+
+        Returns:
+            Optional[str]: The hunks of the section, or None if it has none (binary files, pure renames).
+        """
+        for i, line in enumerate(section):
+            if line.startswith("@@"):
+                return "\n".join(section[i:]).rstrip("\n")
+        return None
+
+
+def get_file_source(repo, credential: str = None) -> FileSource:
+    """
+    Builds the file source selected by `GPTsettings.FILE_SOURCE`.
+
+    Args:
+        repo (Repository): The GitHub repository, used by the API source and as fallback of the local one.
+        credential (str, optional): The GitHub token, used to rate limit the requests. Defaults to None.
+
+    Returns:
+        FileSource: The file source.
+    """
+    api_source = GithubAPIFileSource(repo, credential=credential)
+    if GPTsettings.FILE_SOURCE == "local":
+        return LocalGitFileSource(GPTsettings.LOCAL_REPO_PATH, fallback=api_source)
+    return api_source
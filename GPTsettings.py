@@ -1,3 +1,6 @@
+import os
+
+
 class GPTsettings:
     MODEL = "gpt-4-1106-preview"
     SYSTEM_PROMPT = "You are a senior developer and will provide the best and more concise code reviews. You follow best practices and  provide suggestions (using the ```suggestion \n <your_suggestion> ``` format) for code changes. "
@@ -18,48 +21,59 @@ class GPTsettings:
     """
     COMMENTS_PROMPT = "Here are comments from the PR:\n{comments}"
 
-    MESSAGE_FORMAT = """Return your comments in the following format, it needs to be python code!
-```python
-body = # Your main comment here
-event = # One of the following: "COMMENT", "REQUEST_CHANGES", "PENDING", "APPROVE"
-comments = [
-{
-    'path': 'my_file.py',         # adjust according to your files. USE THE FULL PATH
-    'side': 'your_side',                 # In a split diff view, the side of the diff that the pull request's changes appear on. 
-                                    # Can be LEFT or RIGHT. Use LEFT for deletions that appear in red (-). 
-                                    # Use RIGHT for additions that appear in green (+) or unchanged lines that appear in white and are shown for context.
-                                    # For a multi-line comment, side represents whether the last line of the comment range is a deletion or addition. 
-
-    'line': 'your_line',                 # The line of the blob in the pull request diff that the comment applies to.
-                                    # For a multi-line comment, the last line of the range that your comment applies to.
-
-    'start_line': 'your_start_line',     # The start_line is the first line in the pull request diff that your multi-line comment applies to. 
-                                    # Optional, only needed for multi-line comments, If not needed just don't add the parameter to the dict. 
-                                    # If used it needs to be strictly smaller than line
-                                    # DONT USE NONE, 
-
-    'start_side': 'your_start_side',     # The start_side is the starting side of the diff that the comment applies to. Can be LEFT or RIGHT.
-                                    # Optional, only needed for multi-line comments, If not needed just don't add the parameter to the dict
-                                    # DONT USE NONE 
-
-    'body': '''You should consider refactoring this piece of code, for example you could try:
-    ```suggestion
-    def a_func(a:int, b:int):
-        # func content
-        return # something
-    ```
-    ''' # You should follow best style practices for the code language that you are working with, But the body string should be a valid python multiline string
-},
+    MESSAGE_FORMAT = """Return your review as a JSON object with the following keys:
+- "body": your main comment.
+- "event": one of "COMMENT", "REQUEST_CHANGES" or "APPROVE".
+- "comments": a list of inline comments, each one an object with the keys:
+    - "path": the full path of the file.
+    - "line": the line of the blob in the pull request diff that the comment applies to (an integer).
+      For a multi-line comment, the last line of the range that your comment applies to.
+    - "side": "LEFT" or "RIGHT", the side of the diff the line appears on. Use LEFT for deletions that
+      appear in red (-), RIGHT for additions that appear in green (+) or unchanged lines shown for context.
+      For a multi-line comment, the side of the last line of the range.
+    - "start_line": optional, only for multi-line comments. The first line of the range, strictly smaller than "line".
+    - "start_side": optional, only for multi-line comments. "LEFT" or "RIGHT", the side of "start_line".
+    - "body": the comment. Code suggestions use the format ```suggestion\\n<suggested_change>\\n```, following
+      the best style practices for the language of the file.
+
+Example:
 {
-    'path': 'another_file.py',    # adjust according to your files. USE THE FULL PATH
-    ...
-},
-...
-]
-```
-
-ONLY RETURN THE CODE and use ```python\n<valid_python_code>\n```"
-"""
+    "body": "Overall looks good, a few suggestions below.",
+    "event": "COMMENT",
+    "comments": [
+        {
+            "path": "src/my_file.py",
+            "line": 12,
+            "side": "RIGHT",
+            "start_line": 10,
+            "start_side": "RIGHT",
+            "body": "You could simplify this:\\n```suggestion\\ndef a_func(a: int, b: int) -> int:\\n    return a + b\\n```"
+        }
+    ]
+}
+
+ONLY RETURN THE JSON OBJECT."""
+    SUMMARY_PROMPT = """The Pull Request titled '{pr_title}' was reviewed in parts. Here are the partial reviews:
+
+{partial_reviews}
+
+Write the main comment of the review of the whole Pull Request, summarizing the partial reviews, and choose its event."""
+
+    SUMMARY_FORMAT = """Return your summary as a JSON object with the following keys:
+- "body": your main comment.
+- "event": one of "COMMENT", "REQUEST_CHANGES" or "APPROVE".
+
+ONLY RETURN THE JSON OBJECT."""
+    # Review answers are requested in JSON mode
+    REVIEW_RESPONSE_FORMAT = {"type": "json_object"}
+    INCREMENTAL_PROMPT = """This Pull Request was already reviewed up to commit {reviewed_sha}, the deltas above only contain the changes made after it.
+Focus on these changes and don't repeat the previous review:
+{previous_review}"""
+    # Sent with the failed answer when retrying, instead of the whole traceback
+    REPAIR_PROMPT = """Your previous answer could not be used: {error}
+Return the corrected answer, following the same format."""
+    REPAIR_ERROR_MAX_CHARS = 500
+
     FILE_EXTENSIONS = {
         ".py",
         ".java",
@@ -76,3 +90,121 @@ ONLY RETURN THE CODE and use ```python\n<valid_python_code>\n```"
         ".jsx",
         ".tsx"
     }
+
+    # Embeddings of already seen chunks are kept on disk between runs, set to "" to disable
+    EMBEDDINGS_CACHE_PATH = os.environ.get(
+        "EMBEDDINGS_CACHE_PATH", ".cache/embeddings.sqlite3"
+    )
+    EMBEDDINGS_CACHE_MAX_ENTRIES = int(
+        os.environ.get("EMBEDDINGS_CACHE_MAX_ENTRIES", 100_000)
+    )
+
+    # Files are split into chunks of at most CHUNK_MAX_TOKENS tokens, counted with the encoding of EMBEDDINGS_MODEL
+    CHUNK_MAX_TOKENS = int(os.environ.get("CHUNK_MAX_TOKENS", 256))
+    EMBEDDINGS_MODEL = os.environ.get("EMBEDDINGS_MODEL", "text-embedding-ada-002")
+
+    # The context of a file delta starts with the definitions of the symbols it uses and the callers of the symbols
+    # it changes, found in a symbol index, and is completed with embedding search. Names defined in more than
+    # SYMBOL_MAX_DEFINITIONS places are not looked up.
+    SYMBOL_CONTEXT = os.environ.get("SYMBOL_CONTEXT", "true").lower() in ("1", "true")
+    SYMBOL_MAX_DEFINITIONS = int(os.environ.get("SYMBOL_MAX_DEFINITIONS", 3))
+
+    # How context chunks are retrieved: "vector" (embeddings), "bm25" (lexical, in process, without any embeddings
+    # call) or "hybrid" (both scores min-max normalized per query, then blended with HYBRID_VECTOR_WEIGHT)
+    RETRIEVAL_BACKEND = os.environ.get("RETRIEVAL_BACKEND", "vector")
+    HYBRID_VECTOR_WEIGHT = float(os.environ.get("HYBRID_VECTOR_WEIGHT", 0.5))
+    BM25_K1 = float(os.environ.get("BM25_K1", 1.2))
+    BM25_B = float(os.environ.get("BM25_B", 0.75))
+
+    # Duplicate chunks are embedded once and retrieved once: identical chunks, and near duplicates whose SimHash
+    # fingerprints are at most NEAR_DUPLICATE_MAX_DISTANCE bits apart (0 to 3, -1 for identical chunks only)
+    NEAR_DUPLICATE_MAX_DISTANCE = int(os.environ.get("NEAR_DUPLICATE_MAX_DISTANCE", 3))
+
+    # Chunks are embedded in batches of at most this many tokens, several batches at a time
+    EMBEDDINGS_BATCH_TOKENS = int(os.environ.get("EMBEDDINGS_BATCH_TOKENS", 50_000))
+    EMBEDDINGS_MAX_CONCURRENCY = int(os.environ.get("EMBEDDINGS_MAX_CONCURRENCY", 4))
+
+    # Maximum number of concurrent requests used to fetch files from GitHub
+    GITHUB_MAX_WORKERS = int(os.environ.get("GITHUB_MAX_WORKERS", 8))
+
+    # Where repository files are read from: "api" (GitHub REST API) or "local" (git checkout at LOCAL_REPO_PATH)
+    FILE_SOURCE = os.environ.get("FILE_SOURCE", "api")
+    LOCAL_REPO_PATH = os.environ.get("LOCAL_REPO_PATH", "..")
+
+    # Maximum number of pull request objects kept in memory by GithubHandler
+    PR_CACHE_SIZE = int(os.environ.get("PR_CACHE_SIZE", 32))
+
+    # Index the whole repository at the base commit (stored in REPO_INDEX_DIR and updated incrementally)
+    # instead of only the files changed by the pull request
+    REPO_INDEX = os.environ.get("REPO_INDEX", "false").lower() in ("1", "true")
+    REPO_INDEX_DIR = os.environ.get("REPO_INDEX_DIR", ".cache/repo-index")
+
+    # Max length of a review response, 4096 is the max allowed for responses by openai
+    REVIEW_MAX_TOKENS = 4096
+    # Tokens available for the whole review prompt plus its response (the model context is 128k tokens)
+    PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", 100_000))
+
+    # "single" reviews the whole PR in one request, "map_reduce" reviews it in shards of SHARD_TOKEN_BUDGET
+    # tokens of deltas and their context (REVIEW_MAX_WORKERS at a time), "auto" uses map_reduce above
+    # MAP_REDUCE_MIN_TOKENS delta tokens
+    REVIEW_MODE = os.environ.get("REVIEW_MODE", "auto")
+    MAP_REDUCE_MIN_TOKENS = int(os.environ.get("MAP_REDUCE_MIN_TOKENS", 30_000))
+    SHARD_TOKEN_BUDGET = int(os.environ.get("SHARD_TOKEN_BUDGET", 8_000))
+    REVIEW_MAX_WORKERS = int(os.environ.get("REVIEW_MAX_WORKERS", 4))
+
+    # Requests per second and burst allowed per credential (GitHub allows 5000 requests per hour and
+    # about 900 points per minute before secondary rate limits)
+    RATE_LIMITS = {
+        "github": (float(os.environ.get("GITHUB_RATE_LIMIT", 10)), 20),
+        "openai": (float(os.environ.get("OPENAI_RATE_LIMIT", 8)), 16),
+    }
+    # Maximum requests in flight per endpoint, GitHub asks for content-creating requests to be serial
+    ENDPOINT_CONCURRENCY = {
+        "github": 8,
+        "github.write": 1,
+        "openai.chat": 8,
+        "openai.embeddings": 4,
+    }
+    # Failed requests are retried after a jittered exponential backoff, or when the rate limit headers say so
+    REQUEST_MAX_RETRIES = int(os.environ.get("REQUEST_MAX_RETRIES", 5))
+    REQUEST_BACKOFF_BASE = 1.0
+    REQUEST_BACKOFF_MAX = 60.0
+
+    # Review comments outside the diff are moved to a valid line at most this many lines away,
+    # or added to the review body when there is none
+    DIFF_SNAP_MAX_DISTANCE = int(os.environ.get("DIFF_SNAP_MAX_DISTANCE", 3))
+
+    # Pull requests already reviewed by the agent are re-reviewed from the last reviewed commit only
+    INCREMENTAL_REVIEW = os.environ.get("INCREMENTAL_REVIEW", "true").lower() in (
+        "1",
+        "true",
+    )
+
+    # Login of the account posting the reviews, only its reviews mark commits as reviewed. Found with
+    # the token when empty, set it for tokens that can't read their own user, e.g. "github-actions[bot]"
+    BOT_LOGIN = os.environ.get("BOT_LOGIN", "")
+
+    # Number of pull requests reviewed at a time in batch mode (PR_NUMBERS)
+    BATCH_MAX_WORKERS = int(os.environ.get("BATCH_MAX_WORKERS", 4))
+
+    # GitHub API URL, e.g. of a GitHub Enterprise server or a local stand-in for testing
+    GITHUB_BASE_URL = os.environ.get("GITHUB_BASE_URL", "https://api.github.com")
+    # Items per page of GitHub listings, every page is one scheduled request
+    GITHUB_PER_PAGE = 100
+
+    # Webhook server (server.py): secret of the webhook, port, and reviews running at a time per repository
+    WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+    # Accepting unsigned deliveries without a secret must be asked for explicitly
+    WEBHOOK_INSECURE = os.environ.get("WEBHOOK_INSECURE", "false").lower() in (
+        "1",
+        "true",
+    )
+    # Comma-separated full names of the repositories the server reviews, e.g. "owner/repo"
+    SERVER_REPOS = [
+        name.strip()
+        for name in os.environ.get("SERVER_REPOS", "").split(",")
+        if name.strip()
+    ]
+    SERVER_HOST = os.environ.get("SERVER_HOST", "0.0.0.0")
+    SERVER_PORT = int(os.environ.get("SERVER_PORT", 8080))
+    SERVER_REPO_CONCURRENCY = int(os.environ.get("SERVER_REPO_CONCURRENCY", 2))
@@ -1,42 +1,52 @@
-from typing import List, Dict, Tuple, Union
-import asyncio
-
-from openai import OpenAI
-import openai
-import langchain
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.callbacks.streaming_aiter_final_only import (
-    AsyncFinalIteratorCallbackHandler,
-)
-from langchain.text_splitter import (
-    RecursiveCharacterTextSplitter,
-    CharacterTextSplitter,
+from typing import (
+    TYPE_CHECKING,
+    AsyncIterator,
+    Callable,
+    Iterator,
+    List,
+    Dict,
+    Optional,
+    Tuple,
+    Union,
 )
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import copy
+
+# openai, langchain and tiktoken are slow to import, they are imported on first use
 import numpy as np
 from numpy.linalg import norm
 from GPTsettings import GPTsettings
+from EmbeddingCache import EmbeddingCache
+from VectorStore import ChunkTexts, VectorStore
+from RequestScheduler import scheduler
+from Chunker import Chunk, Chunker
+from SymbolIndex import CALLER_SCORE, DEFINITION_SCORE, UNVERIFIED_SCORE, SymbolIndex
+from RetrievalBackend import RetrievalBackend, create_backend
+from DuplicateIndex import DuplicateIndex
 
-mapper = {
-    "py": "python",
-    "js": "js",
-    "jsx": "js",
-    "ts": "ts",
-    "java": "java",
-    "html": "html",
-    "md": "markdown",
-    "tsx": "ts",
-}
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+    import tiktoken
 
 
 class GPTWrapper:
-    def __init__(self, model: str = GPTsettings.MODEL) -> None:
+    def __init__(
+        self, model: str = GPTsettings.MODEL, async_client: "AsyncOpenAI" = None
+    ) -> None:
         """
         Initializes a new instance of the GPTWrapper class.
 
         Args:
             model (str, optional): The name of the GPT model to use. Defaults to "text-davinci-002".
+            async_client (AsyncOpenAI, optional): The client used by the async methods, share one between
+                the wrappers running on an event loop. Defaults to a client created on first use.
         """
-        self.client = OpenAI()
+        from openai import OpenAI
+
+        # Retries are done by the request scheduler
+        self.client = OpenAI(max_retries=0)
+        self._async_client = async_client
         self.model: str = model
         self.conversation: list[
             dict[str, str]
@@ -69,22 +79,130 @@ class GPTWrapper:
         else:
             raise IndexError("Message index out of range")
 
-    def get_response(self, max_tokens: int = 1000) -> str:
+    def truncate(self, length: int) -> None:
+        """
+        Removes the messages after the first `length` ones from the conversation.
+
+        Args:
+            length (int): The number of messages to keep.
+        """
+        del self.conversation[length:]
+
+    def get_response(self, max_tokens: int = 1000, response_format: dict = None) -> str:
         """
         Gets a response from the API based on the current conversation.
 
         Args:
             max_tokens (int, optional): The maximum number of tokens to generate in the response. Defaults to 1000.
+            response_format (dict, optional): The format of the response, e.g. {"type": "json_object"}. Defaults to text.
+
+        Returns:
+            str: The generated response.
+        """
+        response = scheduler.call(
+            "openai.chat",
+            self.client.api_key,
+            self.client.chat.completions.create,
+            **self.get_request_params(max_tokens, response_format),
+        )
+
+        return response.choices[0].message.content
+
+    def stream_response(self, max_tokens: int = 1000) -> Iterator[str]:
+        """
+        Streams a response from the API based on the current conversation.
+
+        Args:
+            max_tokens (int, optional): The maximum number of tokens to generate in the response. Defaults to 1000.
+
+        Yields:
+            str: The pieces of the response as they are generated.
+        """
+        stream = scheduler.call(
+            "openai.chat",
+            self.client.api_key,
+            self.client.chat.completions.create,
+            **self.get_request_params(max_tokens),
+            stream=True,
+        )
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    @property
+    def async_client(self) -> "AsyncOpenAI":
+        """
+        The client used by the async methods, created on first use.
+        """
+        if self._async_client is None:
+            from openai import AsyncOpenAI
+
+            self._async_client = AsyncOpenAI(max_retries=0)
+        return self._async_client
+
+    async def aget_response(
+        self, max_tokens: int = 1000, response_format: dict = None
+    ) -> str:
+        """
+        Gets a response from the API based on the current conversation without blocking the event loop.
+
+        Args:
+            max_tokens (int, optional): The maximum number of tokens to generate in the response. Defaults to 1000.
+            response_format (dict, optional): The format of the response, e.g. {"type": "json_object"}. Defaults to text.
 
         Returns:
             str: The generated response.
         """
-        response = self.client.chat.completions.create(
-            model=self.model, messages=self.conversation, max_tokens=max_tokens
+        response = await scheduler.acall(
+            "openai.chat",
+            self.async_client.api_key,
+            self.async_client.chat.completions.create,
+            **self.get_request_params(max_tokens, response_format),
         )
 
         return response.choices[0].message.content
 
+    async def astream_response(self, max_tokens: int = 1000) -> AsyncIterator[str]:
+        """
+        Streams a response from the API based on the current conversation without blocking the event loop.
+
+        Args:
+            max_tokens (int, optional): The maximum number of tokens to generate in the response. Defaults to 1000.
+
+        Yields:
+            str: The pieces of the response as they are generated.
+        """
+        stream = await scheduler.acall(
+            "openai.chat",
+            self.async_client.api_key,
+            self.async_client.chat.completions.create,
+            **self.get_request_params(max_tokens),
+            stream=True,
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    def get_request_params(self, max_tokens: int, response_format: dict = None) -> dict:
+        """
+        Builds the parameters of a chat completion request for the current conversation.
+
+        Args:
+            max_tokens (int): The maximum number of tokens to generate in the response.
+            response_format (dict, optional): The format of the response. Defaults to text.
+
+        Returns:
+            dict: The request parameters.
+        """
+        params = {
+            "model": self.model,
+            "messages": list(self.conversation),
+            "max_tokens": max_tokens,
+        }
+        if response_format is not None:
+            params["response_format"] = response_format
+        return params
+
     def __getitem__(self, index: int) -> dict[str, str]:
         """
         Gets a message from the conversation by index.
@@ -131,24 +249,84 @@ def to_docs(text: str, file_extension: str) -> List[str]:
     Returns:
     List[str]: A list of documents resulting from the split.
     """
+    return [chunk.text for chunk in to_chunks(text, file_extension)]
 
-    if file_extension in mapper:
-        language = mapper[file_extension]
-        python_splitter = RecursiveCharacterTextSplitter.from_language(
-            language=language, chunk_size=500, chunk_overlap=0
-        )
-        docs = python_splitter.create_documents([text])
-        docs = [doc.page_content for doc in docs]
-    else:
-        text_splitter = CharacterTextSplitter(
-            separator="\n\n",
-            chunk_size=500,
-            chunk_overlap=0,
-            length_function=len,
-            is_separator_regex=False,
-        )
-        docs = text_splitter.split_text(text)
-    return docs
+
+def to_chunks(text: str, file_extension: str) -> List[Chunk]:
+    """
+    Splits the input text into chunks with the lines they span, based on the file extension.
+
+    Args:
+    text (str): The input text to be split.
+    file_extension (str): The file extension of the input text.
+
+    Returns:
+    List[Chunk]: The chunks resulting from the split.
+    """
+    return get_chunker().chunk(text, file_extension)
+
+
+@lru_cache(maxsize=None)
+def get_chunker() -> Chunker:
+    """
+    Gets the chunker shared by every index, counting tokens with the encoding of the embeddings model.
+
+    Returns:
+    Chunker: The chunker.
+    """
+    return Chunker(get_encoding(GPTsettings.EMBEDDINGS_MODEL))
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> "tiktoken.Encoding":
+    """
+    Gets the tiktoken encoding used by a model, falling back to cl100k_base for unknown models.
+
+    Args:
+    model (str): The name of the model.
+
+    Returns:
+    tiktoken.Encoding: The encoding of the model.
+    """
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def batch_by_tokens(
+    docs: List[str], model: str, max_tokens: int, max_docs: int
+) -> List[List[str]]:
+    """
+    Packs documents, in order, into batches that fit a token budget.
+
+    Args:
+    docs (List[str]): The documents to pack.
+    model (str): The name of the model used to count tokens.
+    max_tokens (int): The maximum number of tokens in a batch. A single larger document gets a batch of its own.
+    max_docs (int): The maximum number of documents in a batch.
+
+    Returns:
+    List[List[str]]: The batches of documents.
+    """
+    token_counts = [
+        len(tokens) for tokens in get_encoding(model).encode_ordinary_batch(docs)
+    ]
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for doc, n_tokens in zip(docs, token_counts):
+        if batch and (batch_tokens + n_tokens > max_tokens or len(batch) >= max_docs):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(doc)
+        batch_tokens += n_tokens
+    if batch:
+        batches.append(batch)
+    return batches
 
 
 def cosim(a, b):
@@ -185,79 +363,534 @@ def cosim_matrix(a, b):
     return np.dot(a, b.T) / (norm(a) * norm(b, axis=1))
 
 
+def normalize_rows(a) -> np.ndarray:
+    """
+    Scales every row of a matrix to unit length, so cosine similarities become dot products.
+    The norms are computed in float64 and the result is stored as float32.
+
+    Args:
+    a (numpy.ndarray): A matrix of shape (k, n). Rows with a norm of 0 are left as is.
+
+    Returns:
+    numpy.ndarray: A float32 matrix of shape (k, n) with unit-length rows.
+    """
+    a = np.asarray(a, dtype=np.float64)
+    if a.size == 0:
+        return a.astype(np.float32)
+    norms = norm(a, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return (a / norms).astype(np.float32)
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Gets the indices of the k highest scores, sorted by decreasing score, using a partial sort.
+    The result is the same as np.argsort(scores, kind="stable")[::-1][:k]: tied scores are
+    ordered by decreasing index.
+
+    Args:
+    scores (numpy.ndarray): An array of shape (n).
+    k (int): The number of indices to return.
+
+    Returns:
+    numpy.ndarray: The indices of the k highest scores.
+
+    Examples:
+    >>> top_k_indices(np.array([0.1, 0.9, 0.5, 0.7]), 2)
+    array([1, 3])
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.array([], dtype=int)
+    if k < len(scores):
+        kth = np.partition(scores, -k)[-k]
+        above = np.flatnonzero(scores > kth)
+        # The ties with the k-th score that are kept are the last ones
+        tied = np.flatnonzero(scores == kth)[len(above) - k :]
+        idxs = np.concatenate([above, tied])
+    else:
+        idxs = np.arange(len(scores))
+    return idxs[np.lexsort((-idxs, -scores[idxs]))]
+
+
 class FilesIndex:
-    def __init__(self, files: dict[str, str]) -> None:
+    def __init__(
+        self,
+        files: dict[str, str],
+        embeddings_cache: EmbeddingCache = None,
+        backend: str = GPTsettings.RETRIEVAL_BACKEND,
+    ) -> None:
         """
         Initializes a new instance of the FilesIndex class.
 
         Args:
             files (dict[str, str]): A dictionary containing the files to be indexed.
             {Filename: FileContent}
+            embeddings_cache (EmbeddingCache, optional): A cache of already computed chunk embeddings. Defaults to None.
+            backend (str, optional): How documents are retrieved, one of RETRIEVAL_BACKENDS. Defaults to GPTsettings.RETRIEVAL_BACKEND.
         """
+        self.backend = backend
+        self.retriever: RetrievalBackend = create_backend(
+            backend, self.embed_texts, GPTsettings.HYBRID_VECTOR_WEIGHT
+        )
         self.files = files
         self.index: Dict[str, List[int]] = {}
         self.idx_to_filename = {}
-        self.embeddings_model = OpenAIEmbeddings()
+        self._embeddings_model = None
+        self.embeddings_cache = embeddings_cache
         self.docs: List[str] = []
-        self.embeddings: np.ndarray = None
+        # The (start_line, end_line) of every doc
+        self.doc_lines: List[Tuple[int, int]] = []
+        # The duplicate group of every doc, a group is embedded once and retrieved once
+        self.groups: List[int] = []
+        self.duplicates = DuplicateIndex()
+        self.symbols = SymbolIndex()
         self.index_files()
 
+    @property
+    def embeddings_model(self):
+        """
+        The OpenAI embeddings model, created on first use so langchain is only imported when embedding.
+        """
+        if self._embeddings_model is None:
+            from langchain.embeddings import OpenAIEmbeddings
+
+            # Retries are done by the request scheduler
+            self._embeddings_model = OpenAIEmbeddings(
+                model=GPTsettings.EMBEDDINGS_MODEL, max_retries=0
+            )
+        return self._embeddings_model
+
     def index_files(self) -> None:
         """
         Indexes the files in the `files` dictionary by creating a mapping between each file name and a list of document
-        indices in the `docs` list. Also computes embeddings for each document and stores them in the `embeddings` array.
+        indices in the `docs` list. Also adds each document to the retrieval backend.
         """
-        embeddings = []
-        last_index = 0
-        for filename, content in self.files.items():
+        self.add_files(self.files)
+
+    def add_files(self, files: dict[str, str]) -> None:
+        """
+        Chunks, embeds and appends files to the index. Files that are already indexed are replaced.
+
+        Args:
+            files (dict[str, str]): The files to add. {Filename: FileContent}
+        """
+        self.remove_files([filename for filename in files if filename in self.index])
+
+        new_index = {}
+        new_docs = []
+        new_lines = []
+        last_index = len(self.docs)
+        for filename, content in files.items():
             extension = filename.split(".")[-1]
-            docs = to_docs(content, extension)
-            idxs = list(range(last_index, last_index + len(docs)))
-            last_index += len(docs)
-            self.index[filename] = idxs
-            self.docs += docs
-            embeddings += self.embeddings_model.embed_documents(docs)
-        self.embeddings = np.array(embeddings)
-        for filename, idxs in self.index.items():
+            chunks = to_chunks(content, extension)
+            self.symbols.add_files({filename: content})
+            new_index[filename] = list(range(last_index, last_index + len(chunks)))
+            last_index += len(chunks)
+            new_docs += [chunk.text for chunk in chunks]
+            new_lines += [(chunk.start_line, chunk.end_line) for chunk in chunks]
+        new_groups = [self.duplicates.assign(doc) for doc in new_docs]
+        self.retriever.add(new_docs, new_groups)
+
+        self.docs = self.docs + new_docs
+        self.doc_lines = self.doc_lines + new_lines
+        self.groups = self.groups + new_groups
+        self.files.update(files)
+        self.index.update(new_index)
+        for filename, idxs in new_index.items():
             for idx in idxs:
                 self.idx_to_filename[idx] = filename
 
+    def remove_files(self, filenames: List[str]) -> None:
+        """
+        Drops the chunks of files from the index, renumbering the remaining chunks.
+
+        Args:
+            filenames (List[str]): The files to remove. Files that are not indexed are ignored.
+        """
+        filenames = [filename for filename in filenames if filename in self.index]
+        if not filenames:
+            return
+
+        removed = {idx for filename in filenames for idx in self.index[filename]}
+        keep = [idx for idx in range(len(self.docs)) if idx not in removed]
+        new_positions = {idx: position for position, idx in enumerate(keep)}
+        if isinstance(self.docs, ChunkTexts):
+            self.docs = self.docs.take(keep)  # Memory-mapped chunks stay undecoded
+        else:
+            self.docs = [self.docs[idx] for idx in keep]
+        self.doc_lines = [self.doc_lines[idx] for idx in keep]
+        self.groups = [self.groups[idx] for idx in keep]
+        self.retriever.select(keep)
+        self.files = {
+            filename: content
+            for filename, content in self.files.items()
+            if filename not in filenames
+        }
+        self.index = {
+            filename: [new_positions[idx] for idx in idxs]
+            for filename, idxs in self.index.items()
+            if filename not in filenames
+        }
+        self.idx_to_filename = {
+            idx: filename for filename, idxs in self.index.items() for idx in idxs
+        }
+        self.symbols.remove_files(filenames)
+        self.duplicates.retain(set(self.groups))
+
+    def copy(self) -> "FilesIndex":
+        """
+        Copies the index so files can be added to or removed from the copy without changing this one.
+        The chunk lists are shared, as they are replaced rather than modified by add_files and
+        remove_files, so memory-mapped chunks are not decoded.
+
+        Returns:
+            FilesIndex: The copy of the index.
+        """
+        index = copy.copy(self)
+        index.files = dict(self.files)
+        index.index = {filename: list(idxs) for filename, idxs in self.index.items()}
+        index.idx_to_filename = dict(self.idx_to_filename)
+        index.duplicates = self.duplicates.copy()
+        index.symbols = self.symbols.copy()
+        index.retriever = self.retriever.copy()
+        return index
+
+    def save_vector_store(
+        self, path: str, write_files: Callable[[str], None] = None
+    ) -> None:
+        """
+        Writes the chunks and embeddings of the index to a vector store directory. The other files
+        of the retrieval backend are written to the same generation of the store.
+
+        Args:
+            path (str): The directory of the vector store.
+            write_files (Callable[[str], None], optional): Writes more files to the generation directory of the store. Defaults to None.
+        """
+
+        def write_generation(directory: str) -> None:
+            self.retriever.save(directory)
+            if write_files is not None:
+                write_files(directory)
+
+        VectorStore.write(
+            path,
+            self.docs,
+            self.retriever.embeddings,
+            self.idx_to_filename,
+            self.doc_lines,
+            self.groups,
+            self.duplicates.simhashes,
+            write_generation,
+        )
+
+    def load_vector_store(self, path: Union[str, VectorStore]) -> None:
+        """
+        Replaces the contents of the index with a vector store. The embedding matrix and the chunk
+        contents stay memory-mapped until they are modified. The BM25 index of the retrieval
+        backend is rebuilt if it wasn't saved with the store.
+
+        Args:
+            path (str | VectorStore): The directory of the vector store, or the already opened store.
+        """
+        store = VectorStore(path) if isinstance(path, str) else path
+        self.files = {}
+        self.docs = store.docs
+        self.doc_lines = store.doc_lines
+        self.groups = store.groups
+        self.duplicates = DuplicateIndex.from_chunks(store.chunks)
+        self.idx_to_filename = store.idx_to_filename
+        self.index = store.index
+        self.retriever.load(store)
+
+    @classmethod
+    def from_vector_store(
+        cls,
+        path: str,
+        embeddings_cache: EmbeddingCache = None,
+        backend: str = GPTsettings.RETRIEVAL_BACKEND,
+    ) -> "FilesIndex":
+        """
+        Opens an index saved with save_vector_store.
+
+        Args:
+            path (str): The directory of the vector store.
+            embeddings_cache (EmbeddingCache, optional): A cache of already computed chunk embeddings. Defaults to None.
+            backend (str, optional): How documents are retrieved, one of RETRIEVAL_BACKENDS. Defaults to GPTsettings.RETRIEVAL_BACKEND.
+
+        Returns:
+            FilesIndex: The index.
+        """
+        index = cls({}, embeddings_cache=embeddings_cache, backend=backend)
+        index.load_vector_store(path)
+        return index
+
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        """
+        Computes the unit-length embeddings of texts, for the retrieval backend.
+
+        Args:
+            texts (List[str]): The documents or queries to embed.
+
+        Returns:
+            np.ndarray: The unit-length embeddings of the texts, in the same order.
+        """
+        return normalize_rows(self.embed_documents(texts))
+
+    def embed_documents(self, docs: List[str]) -> List[List[float]]:
+        """
+        Computes the embeddings of a list of documents, only calling the embeddings model
+        for documents that are not in the embeddings cache.
+
+        Args:
+            docs (List[str]): The documents to embed.
+
+        Returns:
+            List[List[float]]: The embeddings of the documents, in the same order.
+        """
+        if not docs:
+            return []
+        if self.embeddings_cache is None:
+            return self.embed_in_batches(docs)
+
+        model = self.embeddings_model.model
+        embeddings = self.embeddings_cache.get_many(model, docs)
+        missing = list(dict.fromkeys(doc for doc in docs if doc not in embeddings))
+        if missing:
+            new_embeddings = self.embed_in_batches(missing)
+            self.embeddings_cache.put_many(model, missing, new_embeddings)
+            embeddings.update(zip(missing, new_embeddings))
+        return [embeddings[doc] for doc in docs]
+
+    def embed_in_batches(self, docs: List[str]) -> List[List[float]]:
+        """
+        Calls the embeddings model on batches of documents sized by token count, keeping at most
+        `GPTsettings.EMBEDDINGS_MAX_CONCURRENCY` batches in flight.
+
+        Args:
+            docs (List[str]): The documents to embed.
+
+        Returns:
+            List[List[float]]: The embeddings of the documents, in the same order.
+        """
+        batches = batch_by_tokens(
+            docs,
+            self.embeddings_model.model,
+            max_tokens=GPTsettings.EMBEDDINGS_BATCH_TOKENS,
+            max_docs=self.embeddings_model.chunk_size,
+        )
+        if len(batches) == 1:
+            return self.embed_batch(batches[0])
+
+        with ThreadPoolExecutor(
+            max_workers=GPTsettings.EMBEDDINGS_MAX_CONCURRENCY
+        ) as executor:
+            results = executor.map(self.embed_batch, batches)
+            return [embedding for batch in results for embedding in batch]
+
+    def embed_batch(self, docs: List[str]) -> List[List[float]]:
+        """
+        Embeds a batch of documents in one request, through the request scheduler.
+
+        Args:
+            docs (List[str]): The documents to embed.
+
+        Returns:
+            List[List[float]]: The embeddings of the documents, in the same order.
+        """
+        return scheduler.call(
+            "openai.embeddings",
+            self.embeddings_model.openai_api_key,
+            self.embeddings_model.embed_documents,
+            docs,
+        )
+
     def search_docs(
         self, queries: Union[str, List[str]], top_k: int = 5, sorted_by="score"
     ) -> Tuple[List[int], List[str]]:
         """
         Searches for the top k documents that are most similar to the given queries.
-
+        When several queries are given their similarities are added up.
 
         Args:
-            query (str): The query to search for.
+            queries (Union[str, List[str]]): The query or queries to search for.
             top_k (int, optional): The number of top documents to return. Defaults to 5.
             sorted_by (str, optional)
         Returns:
             List[str]: A list of the top k documents that are most similar to the given query.
         """
-        if isinstance(queries, list):
-            query_embeddings = []
-            for query in queries:
-                query_embeddings.append(
-                    np.array(self.embeddings_model.embed_query(query))
-                )
+        if isinstance(queries, str):
+            queries = [queries]
+        if not queries or not self.docs:
+            return [], []
+
+        scores = self.score_docs(queries).sum(axis=0)
+        return self.select_top_k(scores, top_k, sorted_by)
+
+    def search_docs_batch(
+        self,
+        queries: List[str],
+        top_k: int = 5,
+        sorted_by="score",
+        with_scores: bool = False,
+    ) -> List[Tuple[List[int], List[str]]]:
+        """
+        Searches for the top k documents that are most similar to each query, scoring all the
+        queries at once.
 
-            scores = cosim_matrix(query_embeddings[0], self.embeddings)
-            for query_embedding in query_embeddings[1:]:
-                scores += cosim_matrix(query_embedding, self.embeddings)
+        Args:
+            queries (List[str]): The queries to search for.
+            top_k (int, optional): The number of top documents to return per query. Defaults to 5.
+            sorted_by (str, optional): "score" to sort the results by similarity or "file" to sort them
+                by position in the index. Defaults to "score".
+            with_scores (bool, optional): Whether to also return the similarity of each document. Defaults to False.
 
-        elif isinstance(queries, str):
-            query = queries  # signaling that queries is a string
-            query_embedding = np.array(self.embeddings_model.embed_query(query))
-            scores = cosim_matrix(query_embedding, self.embeddings)
+        Returns:
+            List[Tuple[List[int], List[str]]]: The indices and contents (and scores if requested) of the top k
+                documents of each query.
+        """
+        if not queries:
+            return []
+        if not self.docs:
+            return [([], [], []) if with_scores else ([], []) for _ in queries]
+
+        scores = self.score_docs(queries)
+        return [
+            self.select_top_k(query_scores, top_k, sorted_by, with_scores)
+            for query_scores in scores
+        ]
+
+    def score_docs(self, queries: List[str]) -> np.ndarray:
+        """
+        Scores every document against every query with the retrieval backend: the cosine
+        similarity of the embeddings, the BM25 score scaled to the best document of the query,
+        or a blend of both weighted by GPTsettings.HYBRID_VECTOR_WEIGHT. Queries are embedded in
+        a single call, and not at all by the bm25 backend.
+
+        Args:
+            queries (List[str]): The queries.
 
-        top_k_idxs = np.argsort(scores)[::-1][:top_k]
+        Returns:
+            np.ndarray: The scores, at most 1, one row per query and one column per document.
+        """
+        return self.retriever.score(queries)
+
+    def select_top_k(
+        self,
+        scores: np.ndarray,
+        top_k: int,
+        sorted_by="score",
+        with_scores: bool = False,
+    ) -> Tuple[List[int], List[str]]:
+        """
+        Selects the top k documents given their scores.
+
+        Args:
+            scores (np.ndarray): The score of every document in the index.
+            top_k (int): The number of top documents to return.
+            sorted_by (str, optional): "score" or "file". Defaults to "score".
+            with_scores (bool, optional): Whether to also return the scores of the top k documents. Defaults to False.
+
+        Returns:
+            Tuple[List[int], List[str]]: The indices and contents (and scores if requested) of the top k documents.
+        """
+        top_k_idxs = self.top_k_groups(scores, top_k)
 
         if sorted_by == "file":
             top_k_idxs = sorted(top_k_idxs)
 
-        return top_k_idxs, [self.docs[idx] for idx in top_k_idxs]
+        docs = [self.docs[idx] for idx in top_k_idxs]
+        if with_scores:
+            return top_k_idxs, docs, [float(scores[idx]) for idx in top_k_idxs]
+        return top_k_idxs, docs
+
+    def get_symbol_context(
+        self, filename: str, patch: str, top_k: int = 5
+    ) -> List[Tuple[int, float]]:
+        """
+        Finds the documents holding the definitions of the symbols used by the changes of a file,
+        then the documents calling the symbols it changes, with symbol lookups only. Matches that
+        only share a name come last, with UNVERIFIED_SCORE.
+
+        Args:
+            filename (str): The path to the changed file.
+            patch (str): The patch of the file.
+            top_k (int, optional): The maximum number of documents to return. Defaults to 5.
+
+        Returns:
+            List[Tuple[int, float]]: The indices and scores of the documents, definitions first.
+        """
+        hunk = self.symbols.get_hunk_symbols(filename, patch)
+        context = {}
+        for path, line, score in [
+            *((s.path, s.start_line, DEFINITION_SCORE) for s in hunk.definitions),
+            *((r.path, r.line, CALLER_SCORE) for r in hunk.callers),
+            *(
+                (s.path, s.start_line, UNVERIFIED_SCORE)
+                for s in hunk.unverified_definitions
+            ),
+            *((r.path, r.line, UNVERIFIED_SCORE) for r in hunk.unverified_callers),
+        ]:
+            if len(context) >= top_k:
+                break
+            idx = self.get_doc_at(path, line)
+            if idx is not None:
+                context.setdefault(idx, score)
+        return list(context.items())
+
+    def get_doc_at(self, filename: str, line: int) -> Optional[int]:
+        """
+        Gets the document of a file spanning a line, or the first one after it.
+
+        Args:
+            filename (str): The path to the file.
+            line (int): The 1-based line number.
+
+        Returns:
+            Optional[int]: The index of the document, or None if the file has no document there.
+        """
+        for idx in self.index.get(filename, []):
+            if self.doc_lines[idx][1] >= line:
+                return idx
+        return None
+
+    def top_k_groups(self, scores: np.ndarray, top_k: int) -> np.ndarray:
+        """
+        Gets the documents with the highest scores, keeping only the best document of each
+        duplicate group.
+
+        Args:
+            scores (np.ndarray): The score of every document in the index.
+            top_k (int): The number of documents to return.
+
+        Returns:
+            np.ndarray: The indices of the documents, sorted by descending score.
+        """
+        n_candidates = top_k
+        while True:
+            idxs = []
+            groups = set()
+            for idx in top_k_indices(scores, n_candidates):
+                if self.groups[idx] not in groups:
+                    groups.add(self.groups[idx])
+                    idxs.append(idx)
+                    if len(idxs) == top_k:
+                        break
+            if len(idxs) >= top_k or n_candidates >= len(scores):
+                return np.array(idxs, dtype=int)
+            n_candidates *= 4
 
     def get_filename(self, idx: int):
         return self.idx_to_filename[idx]
+
+    def get_lines(self, idx: int) -> Tuple[int, int]:
+        """
+        Gets the lines of its file spanned by a document.
+
+        Args:
+            idx (int): The index of the document.
+
+        Returns:
+            Tuple[int, int]: The first and last line, 1-based and inclusive.
+        """
+        return self.doc_lines[idx]
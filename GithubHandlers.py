@@ -1,8 +1,24 @@
-from github import Auth, Github
-import traceback
+from github import Auth, Github, GithubException
+from collections import OrderedDict
+from functools import cached_property
+from typing import Optional, Tuple
+import logging
+import os
 import re
+import threading
 from GPTutils import FilesIndex
 from GPTsettings import GPTsettings
+from EmbeddingCache import EmbeddingCache
+from FileSources import DiffFile, FileSource, get_file_source
+from PRSnapshot import PRSnapshot
+from PromptPacker import ContextChunk, FileDelta
+from RepositoryIndex import RepositoryIndex
+from RequestScheduler import scheduler
+from SymbolIndex import UNVERIFIED_SCORE
+
+# Hidden in the body of the agent reviews, to find the last reviewed commit
+REVIEW_MARKER = "<!-- repo-agent:reviewed-sha={sha} -->"
+REVIEW_MARKER_PATTERN = re.compile(r"<!-- repo-agent:reviewed-sha=([0-9a-f]+) -->")
 
 
 class GithubHandler:
@@ -18,6 +34,7 @@ class GithubHandler:
         main_branch: str = "main",
         auth_token: str = None,
         file_extensions: list = None,
+        file_source: FileSource = None,
     ):
         """
         Initializes a new instance of the GithubHandler class.
@@ -26,27 +43,250 @@ class GithubHandler:
             repo_name (str): The name of the repository to interact with.
             main_branch (str): The name of the main branch of the repository. Defaults to "main".
             auth_token (str): The authentication token to use for interacting with the repository. Defaults to None.
+            file_source (FileSource, optional): The backend used to read repository files. Defaults to the one selected by GPTsettings.FILE_SOURCE.
         """
         if file_extensions:
             self.FILE_EXTENSIONS = file_extensions
 
         self.repo_name = repo_name
+        self.embeddings_cache = (
+            EmbeddingCache() if GPTsettings.EMBEDDINGS_CACHE_PATH else None
+        )
         self.authenticate(auth_token=auth_token)
-        self.repo = self.g.get_repo(self.repo_name)
-        self.prs = self.repo.get_pulls(state="open", sort="created", base=main_branch)
-        self.prs_nums = [pr.number for pr in self.prs]
-        self.prs_dict = {k: v for k, v in zip(self.prs_nums, self.prs)}
-
-    def index_pr(self, pr):
-        file_contents = {}
-        file_changes = pr.get_files()
-        for file in file_changes:
-            if not any([file.filename.endswith(ext) for ext in self.FILE_EXTENSIONS]):
+        self.repo = self.request(self.g.get_repo, self.repo_name)
+        self.file_source = file_source or get_file_source(
+            self.repo, credential=self.auth_token
+        )
+        self.main_branch = main_branch
+        self.pr_cache = OrderedDict()
+        self.pr_cache_lock = threading.Lock()
+        self.repository_indexes = {}
+        self.repository_indexes_lock = threading.Lock()
+
+    @cached_property
+    def prs(self):
+        """
+        The open pull requests against the main branch, requested on first access.
+        """
+        return list(
+            self.paginate(
+                self.repo.get_pulls(state="open", sort="created", base=self.main_branch)
+            )
+        )
+
+    @cached_property
+    def bot_login(self) -> Optional[str]:
+        """
+        The login of the account posting the reviews: GPTsettings.BOT_LOGIN, or the user of the
+        token. None if the token can't read its own user.
+        """
+        if GPTsettings.BOT_LOGIN:
+            return GPTsettings.BOT_LOGIN
+        try:
+            return self.request(lambda: self.g.get_user().login)
+        except GithubException:
+            logging.warning(
+                "Could not get the login of the token, set BOT_LOGIN for incremental reviews"
+            )
+            return None
+
+    @cached_property
+    def prs_nums(self) -> list:
+        """
+        The numbers of the open pull requests against the main branch.
+        """
+        return list(self.prs_dict)
+
+    @cached_property
+    def prs_dict(self) -> dict:
+        """
+        The open pull requests against the main branch keyed by number.
+        """
+        prs_dict = {}
+        for pr in self.prs:
+            prs_dict[pr.number] = pr
+            self.cache_pr(pr)
+        return prs_dict
+
+    def cache_pr(self, pr) -> None:
+        """
+        Adds a pull request to the bounded cache of pull requests, evicting the least recently used one if full.
+
+        Args:
+            pr (PullRequest): The pull request to cache.
+        """
+        with self.pr_cache_lock:
+            self.pr_cache[pr.number] = pr
+            self.pr_cache.move_to_end(pr.number)
+            while len(self.pr_cache) > GPTsettings.PR_CACHE_SIZE:
+                self.pr_cache.popitem(last=False)
+
+    def evict_pr(self, pr_id: int) -> None:
+        """
+        Removes a pull request from the cache, e.g. when it was updated.
+
+        Args:
+            pr_id (int): The ID of the pull request.
+        """
+        with self.pr_cache_lock:
+            self.pr_cache.pop(pr_id, None)
+
+    def get_pr_snapshot(self, pr) -> PRSnapshot:
+        """
+        Fetches the files, patches and comments of a pull request once.
+
+        Args:
+            pr (PullRequest | PRSnapshot): The pull request, or an already fetched snapshot which is returned as is.
+
+        Returns:
+            PRSnapshot: The snapshot of the pull request.
+        """
+        if isinstance(pr, PRSnapshot):
+            return pr
+        return PRSnapshot.from_pr(pr, self.file_source, credential=self.auth_token)
+
+    def get_last_review(self, pr) -> Optional[Tuple[str, str]]:
+        """
+        Finds the last review of the agent on a pull request, by the marker it leaves in the review
+        body. Only the reviews posted by the agent's own account are considered, so the marker can't
+        be copied by someone else to skip commits.
+
+        Args:
+            pr (PullRequest): The pull request.
+
+        Returns:
+            Optional[Tuple[str, str]]: The head SHA the review was made at and the review body without
+                the marker, or None if the pull request wasn't reviewed by the agent.
+        """
+        bot_login = self.bot_login
+        if bot_login is None:
+            return None
+        reviews = list(self.paginate(pr.get_reviews()))
+        for review in reversed(reviews):
+            if review.user is None or review.user.login != bot_login:
                 continue
-            file_full_content = self.get_file_contents(file.filename, ref=pr.head.sha)
-            file_contents[file.filename] = file_full_content
+            match = REVIEW_MARKER_PATTERN.search(review.body or "")
+            if match:
+                return (
+                    match.group(1),
+                    REVIEW_MARKER_PATTERN.sub("", review.body).strip(),
+                )
+        return None
+
+    @staticmethod
+    def add_review_marker(body: str, sha: str) -> str:
+        """
+        Adds the hidden marker of the reviewed commit to a review body.
+
+        Args:
+            body (str): The review body.
+            sha (str): The reviewed head SHA.
+
+        Returns:
+            str: The review body with the marker.
+        """
+        return f"{body}\n\n{REVIEW_MARKER.format(sha=sha)}"
+
+    def get_incremental_snapshot(
+        self, snapshot: PRSnapshot, reviewed_sha: str
+    ) -> Optional[PRSnapshot]:
+        """
+        Narrows a pull request to the changes made after an already reviewed commit.
+
+        Args:
+            snapshot (PRSnapshot): The pull request.
+            reviewed_sha (str): The head SHA of the last review.
+
+        Returns:
+            Optional[PRSnapshot]: The pull request with only the files changed since the reviewed
+                commit and their patches against it, or None if the head doesn't descend from the
+                reviewed commit (e.g. after a force push).
+        """
+        comparison = self.request(self.repo.compare, reviewed_sha, snapshot.head_sha)
+        if comparison.status != "ahead":
+            return None
+        # Files changed by merges of the base branch are not part of the pull request
+        pr_files = {file.filename for file in snapshot.files}
+        files = tuple(
+            DiffFile(
+                filename=file.filename,
+                status=file.status,
+                sha=file.sha,
+                patch=file.patch,
+                previous_filename=file.previous_filename,
+            )
+            for file in self.request(lambda: list(comparison.files))
+            if file.filename in pr_files
+        )
+        return snapshot._replace(files=files)
+
+    def index_pr(self, pr) -> FilesIndex:
+        """
+        Builds the index used to retrieve the context of the files of a pull request.
+
+        The index is also kept in `self.index` for the single pull request helpers (e.g. `get_file_context`),
+        callers sharing the handler between threads must use the returned index instead.
+
+        Args:
+            pr (PullRequest | PRSnapshot): The pull request.
+
+        Returns:
+            FilesIndex: The index of the pull request.
+        """
+        snapshot = self.get_pr_snapshot(pr)
+        files = [
+            file
+            for file in snapshot.files
+            if any([file.filename.endswith(ext) for ext in self.FILE_EXTENSIONS])
+        ]
+        file_contents = self.file_source.fetch_pr_files(files, ref=snapshot.head_sha)
+
+        if GPTsettings.REPO_INDEX:
+            repository_index = self.get_repository_index(
+                snapshot.base_ref, snapshot.base_sha
+            )
+            index = repository_index.get_pr_index(
+                {
+                    filename: content
+                    for filename, content in file_contents.items()
+                    if content != "Could not retrieve file contents."
+                },
+                removed=[
+                    file.previous_filename or file.filename
+                    for file in snapshot.files
+                    if file.status in ("removed", "renamed")
+                ],
+            )
+        else:
+            index = FilesIndex(file_contents, embeddings_cache=self.embeddings_cache)
+        self.index = index
+        return index
+
+    def get_repository_index(self, base_ref: str, base_sha: str) -> RepositoryIndex:
+        """
+        Gets the whole-repository index of a base branch, updated to a commit.
+
+        Args:
+            base_ref (str): The name of the base branch.
+            base_sha (str): The SHA of the base commit.
 
-        self.index = FilesIndex(file_contents)
+        Returns:
+            RepositoryIndex: The repository index at the base commit.
+        """
+        with self.repository_indexes_lock:
+            repository_index = self.repository_indexes.get(base_ref)
+            if repository_index is None:
+                repository_index = RepositoryIndex(
+                    self.file_source,
+                    os.path.join(
+                        GPTsettings.REPO_INDEX_DIR, base_ref.replace("/", "_")
+                    ),
+                    file_extensions=self.FILE_EXTENSIONS,
+                    embeddings_cache=self.embeddings_cache,
+                )
+                self.repository_indexes[base_ref] = repository_index
+        repository_index.update(base_sha)
+        return repository_index
 
     def get_commits(self):
         """
@@ -54,11 +294,11 @@ class GithubHandler:
         """
         for pr_num in self.prs_dict:
             pr = self.prs_dict[pr_num]["pr"]
-            commits = pr.get_commits()
+            commits = list(self.paginate(pr.get_commits()))
             commit_list = []
 
             for commit in commits:
-                commit_obj = self.repo.get_commit(commit.sha)
+                commit_obj = self.request(self.repo.get_commit, commit.sha)
                 commit_data = {"sha": commit.sha, "files": []}
 
                 for file in commit_obj.files:
@@ -84,8 +324,44 @@ class GithubHandler:
         if not auth_token:
             raise AuthException("No github authentication token provided.")
 
+        self.auth_token = auth_token
         self.auth = Auth.Token(auth_token)
-        self.g = Github(auth=self.auth)
+        # Throttling and retries are done by the request scheduler
+        self.g = Github(
+            auth=self.auth,
+            base_url=GPTsettings.GITHUB_BASE_URL,
+            retry=None,
+            seconds_between_requests=None,
+            seconds_between_writes=None,
+            per_page=GPTsettings.GITHUB_PER_PAGE,
+        )
+
+    def request(self, function, *args, endpoint: str = "github", **kwargs):
+        """
+        Makes a GitHub request through the request scheduler, under the rate limits of the token.
+
+        Args:
+            function (Callable): The function making the request.
+            *args: The positional arguments of the function.
+            endpoint (str, optional): The endpoint name, "github.write" for content-creating requests. Defaults to "github".
+            **kwargs: The keyword arguments of the function.
+
+        Returns:
+            Any: The result of the function.
+        """
+        return scheduler.call(endpoint, self.auth_token, function, *args, **kwargs)
+
+    def paginate(self, paginated_list):
+        """
+        Iterates over a paginated listing, fetching each page through the request scheduler.
+
+        Args:
+            paginated_list (PaginatedList): The listing.
+
+        Returns:
+            Iterator: The items of the listing.
+        """
+        return scheduler.paginate("github", self.auth_token, paginated_list)
 
     def get_latest_pr_from_branch(self, branch: str, downstream_branch: str = None):
         """
@@ -102,10 +378,13 @@ class GithubHandler:
             state="open", sort="created", base=branch, direction="desc"
         )
         if downstream_branch:
-            for pr in prs:
-                if pr.head.ref == downstream_branch:
-                    return pr
-        return prs[0]
+            pr = next(
+                (pr for pr in self.paginate(prs) if pr.head.ref == downstream_branch),
+                None,
+            )
+            if pr is not None:
+                return pr
+        return self.request(prs.get_page, 0)[0]
 
     def get_pr_from_id(self, pr_id: int):
         """
@@ -117,21 +396,20 @@ class GithubHandler:
         Returns:
             PullRequest: The pull request with the specified ID.
         """
-        pr = self.repo.get_pull(pr_id)
+        with self.pr_cache_lock:
+            pr = self.pr_cache.get(pr_id)
+            if pr is not None:
+                self.pr_cache.move_to_end(pr_id)
+                return pr
+        pr = self.request(self.repo.get_pull, pr_id)
+        self.cache_pr(pr)
         return pr
 
     def get_all_files(self):
         """
         Gets all files in the repository.
         """
-        contents = self.repo.get_contents("")
-
-        while contents:
-            file_content = contents.pop(0)
-            if file_content.type == "dir":
-                contents.extend(self.repo.get_contents(file_content.path))
-
-        self.all_files = contents
+        self.all_files = self.file_source.list_files()
 
     def get_file_contents(self, filepath: str, ref=None):
         """
@@ -144,34 +422,101 @@ class GithubHandler:
         Returns:
             str: The contents of the file.
         """
-        try:
-            file_contents = self.repo.get_contents(filepath, ref=ref)
-            return file_contents.decoded_content.decode()
-        except:
-            traceback.print_exc()
-            return "Could not retrieve file contents."
+        return self.file_source.get_file_contents(filepath, ref=ref)
 
     def get_pr_deltas(self, pr) -> str:
         """
         Gets the deltas for a pull request.
 
         Args:
-            pr (PullRequest): The pull request to get deltas for.
+            pr (PullRequest | PRSnapshot): The pull request to get deltas for.
 
         Returns:
             str: The deltas for the pull request plus additional code context.
         """
-        self.index_pr(pr)
-        delta_query = ""
-        file_changes = pr.get_files()
-        for f in file_changes:
-            if not any([f.filename.endswith(ext) for ext in self.FILE_EXTENSIONS]):
-                continue
+        return self.format_pr_deltas(self.get_pr_delta_items(pr))
+
+    def get_pr_delta_items(self, pr, k=10) -> list:
+        """
+        Gets the deltas of the files of a pull request with the context retrieved for each of them.
+
+        Args:
+            pr (PullRequest | PRSnapshot): The pull request to get deltas for.
+            k (int, optional): The number of context chunks per file. Defaults to 10.
+
+        Returns:
+            list[FileDelta]: The formatted delta and scored context chunks of each file.
+        """
+        snapshot = self.get_pr_snapshot(pr)
+        index = self.index_pr(snapshot)
+        files = [
+            f
+            for f in snapshot.files
+            if any([f.filename.endswith(ext) for ext in self.FILE_EXTENSIONS])
+        ]
+        file_delta_strs = [self.get_file_delta(f.patch, f.filename) for f in files]
+        symbol_contexts = [
+            (
+                index.get_symbol_context(f.filename, f.patch, top_k=k)
+                if GPTsettings.SYMBOL_CONTEXT
+                else []
+            )
+            for f in files
+        ]
+        contexts = [
+            {idx: score for idx, score in context if score > UNVERIFIED_SCORE}
+            for context in symbol_contexts
+        ]
+        # Embedding search only completes the context of the files with too few resolved symbol
+        # matches, the matches by name only fill the slots left after it
+        incomplete = [i for i, context in enumerate(contexts) if len(context) < k]
+        results = index.search_docs_batch(
+            [file_delta_strs[i] for i in incomplete],
+            top_k=k,
+            sorted_by="score",
+            with_scores=True,
+        )
+        for i, (idxs, _, scores) in zip(incomplete, results):
+            for idx, score in zip(idxs, scores):
+                if len(contexts[i]) >= k:
+                    break
+                contexts[i].setdefault(int(idx), score)
+        for context, symbol_context in zip(contexts, symbol_contexts):
+            for idx, score in symbol_context:
+                if len(context) >= k:
+                    break
+                context.setdefault(idx, score)
+        return [
+            FileDelta(
+                filename=f.filename,
+                delta=file_delta_str,
+                context=tuple(
+                    ContextChunk(
+                        idx=idx,
+                        filename=index.get_filename(idx),
+                        text=index.docs[idx],
+                        score=score,
+                    )
+                    for idx, score in sorted(context.items())
+                ),
+            )
+            for f, file_delta_str, context in zip(files, file_delta_strs, contexts)
+        ]
+
+    def format_pr_deltas(self, deltas: list) -> str:
+        """
+        Formats file deltas and their context for the review prompt.
+
+        Args:
+            deltas (list[FileDelta]): The file deltas.
 
-            file_delta_str = self.get_file_delta(f.patch, f.filename)
-            file_delta_context = self.get_file_context(file_delta_str)
+        Returns:
+            str: The deltas for the pull request plus additional code context.
+        """
+        delta_query = ""
+        for file_delta in deltas:
             delta_query_block = self.get_delta_query_block(
-                file_delta_str, file_delta_context
+                file_delta.delta, self.format_context_chunks(file_delta.context)
             )
             delta_query += delta_query_block
 
@@ -187,24 +532,55 @@ class GithubHandler:
 
     def get_file_context(self, code_str, k=10):
         idxs, docs = self.index.search_docs(code_str, top_k=k, sorted_by="file")
+        return self.format_context(idxs, docs)
+
+    def format_context(self, idxs, docs) -> str:
+        """
+        Formats context chunks from the index, grouping consecutive chunks of the same file.
+
+        Args:
+            idxs (list[int]): The indices of the chunks in the index.
+            docs (list[str]): The contents of the chunks.
+
+        Returns:
+            str: The formatted context.
+        """
+        return self.format_context_chunks(
+            [
+                ContextChunk(
+                    idx=idx, filename=self.index.get_filename(idx), text=doc, score=0.0
+                )
+                for idx, doc in zip(idxs, docs)
+            ]
+        )
+
+    def format_context_chunks(self, chunks) -> str:
+        """
+        Formats context chunks, grouping consecutive chunks of the same file.
+
+        Args:
+            chunks (Iterable[ContextChunk]): The chunks, sorted by position in the index.
+
+        Returns:
+            str: The formatted context.
+        """
         context = "```"
         current_file = ""
-        for idx, doc in zip(idxs, docs):
-            if self.index.get_filename(idx) != current_file:
-                current_file = self.index.get_filename(idx)
+        for chunk in chunks:
+            if chunk.filename != current_file:
+                current_file = chunk.filename
                 context += f"###{current_file}\n"
             else:
                 context += "...\n"
 
-            context += f"{doc}\n"
+            context += f"{chunk.text}\n"
         context += "```"
         return context
 
     def get_pr_deltas_in_list(self, pr):
-        file_changes = pr.get_files()
         blocks = []
         current_block = ""
-        for file in file_changes:
+        for file in self.get_pr_snapshot(pr).files:
             file_deltas = file.patch
             for line in file_deltas.split("\n"):
                 if line.startswith("@@"):
@@ -285,6 +661,24 @@ class GithubHandler:
 
         return f"{filename}\n{deltas}\n" + "-" * 30 + "\n"
 
+    def split_patch(self, patch: str) -> list:
+        """
+        Splits a patch into its hunks.
+
+        Args:
+            patch (str): The patch for a file.
+
+        Returns:
+            list[str]: The hunks of the patch, each one starting with its "@@" header.
+        """
+        hunks = []
+        for line in patch.split("\n"):
+            if line.startswith("@@") or not hunks:
+                hunks.append(line)
+            else:
+                hunks[-1] += "\n" + line
+        return hunks
+
     def get_chunk_header(self, line):
         """
         Gets the header for a chunk of code.
@@ -316,14 +710,13 @@ class GithubHandler:
         Gets the deltas for a pull request, formatted for position reviews.
 
         Args:
-            pr (PullRequest): The pull request to get deltas for.
+            pr (PullRequest | PRSnapshot): The pull request to get deltas for.
 
         Returns:
             str: The deltas for the pull request.
         """
         files_and_deltas = ""
-        file_changes = pr.get_files()
-        for f in file_changes:
+        for f in self.get_pr_snapshot(pr).files:
             lines = f.patch.split("\n")
             deltas = ""
             files_and_deltas += f"{f.filename} - (deltas)\n"
@@ -348,15 +741,14 @@ class GithubHandler:
         Gets the comments for a pull request.
 
         Args:
-            pr (PullRequest): The pull request to get comments for.
+            pr (PullRequest | PRSnapshot): The pull request to get comments for.
 
         Returns:
             str: The comments for the pull request.
         """
         comments = ""
-        issue_comments = pr.get_issue_comments()
-        for c in issue_comments:
-            comments += c.user.login + ": " + c.body + "\n"
+        for c in self.get_pr_snapshot(pr).comments:
+            comments += c.user + ": " + c.body + "\n"
         return comments
 
     def modify_pr(self, pr_num: int):
@@ -379,5 +771,12 @@ class GithubHandler:
             new_contents (str): The new contents of the file.
             commit_message (str): The commit message.
         """
-        file = self.repo.get_contents(filepath)
-        self.repo.update_file(file.path, commit_message, new_contents, file.sha)
+        file = self.request(self.repo.get_contents, filepath)
+        self.request(
+            self.repo.update_file,
+            file.path,
+            commit_message,
+            new_contents,
+            file.sha,
+            endpoint="github.write",
+        )
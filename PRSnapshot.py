@@ -0,0 +1,86 @@
+from typing import NamedTuple, Optional, Tuple
+
+from FileSources import DiffFile, FileSource
+from RequestScheduler import scheduler
+
+
+class PRComment(NamedTuple):
+    """
+    An issue comment of a pull request.
+    """
+
+    user: str
+    body: str
+
+
+class PRSnapshot(NamedTuple):
+    """
+    An immutable view of a pull request, fetched once and shared by every GithubHandler
+    method that needs its files, patches or comments.
+    """
+
+    number: int
+    title: str
+    user: str
+    head_sha: str
+    base_sha: str
+    base_ref: str
+    files: Tuple[DiffFile, ...]
+    comments: Tuple[PRComment, ...]
+
+    @classmethod
+    def from_pr(
+        cls, pr, file_source: FileSource, credential: str = None
+    ) -> "PRSnapshot":
+        """
+        Fetches the files, patches and comments of a pull request.
+
+        Args:
+            pr (PullRequest): The pull request.
+            file_source (FileSource): The backend used to get the changed files and their patches.
+            credential (str, optional): The GitHub token, used to rate limit the requests. Defaults to None.
+
+        Returns:
+            PRSnapshot: The snapshot of the pull request.
+        """
+        files = tuple(
+            DiffFile(
+                filename=file.filename,
+                status=file.status,
+                sha=file.sha,
+                patch=file.patch,
+                previous_filename=getattr(file, "previous_filename", None),
+            )
+            for file in file_source.get_pr_files(pr)
+        )
+        comments = tuple(
+            PRComment(user=comment.user.login, body=comment.body)
+            for comment in scheduler.paginate(
+                "github", credential, pr.get_issue_comments()
+            )
+        )
+        return cls(
+            number=pr.number,
+            title=pr.title,
+            user=pr.user.login,
+            head_sha=pr.head.sha,
+            base_sha=pr.base.sha,
+            base_ref=pr.base.ref,
+            files=files,
+            comments=comments,
+        )
+
+    def get_file(self, filename: str) -> Optional[DiffFile]:
+        """
+        Gets a changed file by name.
+
+        Args:
+            filename (str): The path to the file.
+
+        Returns:
+            Optional[DiffFile]: The changed file, or None if the pull request doesn't change it.
+        """
+        for file in self.files:
+            if file.filename == filename:
+                return file
+        return None
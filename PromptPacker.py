@@ -0,0 +1,163 @@
+from typing import List, NamedTuple, Tuple
+import logging
+
+from GPTsettings import GPTsettings
+from GPTutils import get_encoding
+
+
+class ContextChunk(NamedTuple):
+    """
+    A chunk of repository code retrieved as context for a file delta.
+    """
+
+    idx: int
+    filename: str
+    text: str
+    score: float
+
+
+class FileDelta(NamedTuple):
+    """
+    The formatted delta of a changed file and the context chunks retrieved for it.
+    """
+
+    filename: str
+    delta: str
+    context: Tuple[ContextChunk, ...]
+
+
+class PackedPrompt(NamedTuple):
+    """
+    The parts of a prompt that fit the token budget, and a description of what was left out.
+    """
+
+    deltas: List[FileDelta]
+    repo_instructions: str
+    comments: List[str]
+    dropped: List[str]
+    tokens: int
+
+
+class PromptPacker:
+    """
+    Fits the material of a review prompt into a token budget, counting tokens with tiktoken.
+
+    The budget is allocated by priority: file deltas first (in order, a delta that doesn't fit is
+    dropped whole), then the custom repository instructions, then the retrieved context chunks
+    (highest similarity first, so the lowest-score chunks are the ones trimmed), and finally the
+    existing comments (most recent first).
+    """
+
+    def __init__(
+        self,
+        budget: int = GPTsettings.PROMPT_TOKEN_BUDGET,
+        model: str = GPTsettings.MODEL,
+    ) -> None:
+        """
+        Initializes a new instance of the PromptPacker class.
+
+        Args:
+            budget (int, optional): The number of tokens available for the packed material. Defaults to GPTsettings.PROMPT_TOKEN_BUDGET.
+            model (str, optional): The model whose tokenizer is used to count tokens. Defaults to GPTsettings.MODEL.
+        """
+        self.budget = budget
+        self.encoding = get_encoding(model)
+
+    def count_tokens(self, text: str) -> int:
+        """
+        Counts the tokens of a text.
+
+        Args:
+            text (str): The text.
+
+        Returns:
+            int: The number of tokens.
+        """
+        return len(self.encoding.encode_ordinary(text))
+
+    def pack(
+        self,
+        deltas: List[FileDelta],
+        repo_instructions: str = "",
+        comments: List[str] = (),
+        reserved_tokens: int = 0,
+    ) -> PackedPrompt:
+        """
+        Selects the material that fits the budget.
+
+        Args:
+            deltas (List[FileDelta]): The file deltas with their retrieved context.
+            repo_instructions (str, optional): The custom instructions of the repository. Defaults to "".
+            comments (List[str], optional): The existing comments, oldest first. Defaults to ().
+            reserved_tokens (int, optional): Tokens of the budget already used by the rest of the prompt
+                and the expected answer. Defaults to 0.
+
+        Returns:
+            PackedPrompt: The material that fits, with the context of each delta sorted by position in the index.
+        """
+        remaining = self.budget - reserved_tokens
+        dropped = []
+
+        kept_deltas = []
+        for file_delta in deltas:
+            tokens = self.count_tokens(file_delta.delta)
+            if tokens <= remaining:
+                remaining -= tokens
+                kept_deltas.append(file_delta)
+            else:
+                dropped.append(f"delta of {file_delta.filename} ({tokens} tokens)")
+
+        tokens = self.count_tokens(repo_instructions)
+        if tokens <= remaining:
+            remaining -= tokens
+        else:
+            dropped.append(f"repository instructions ({tokens} tokens)")
+            repo_instructions = ""
+
+        candidates = sorted(
+            (
+                (chunk.score, delta_position, chunk)
+                for delta_position, file_delta in enumerate(kept_deltas)
+                for chunk in file_delta.context
+            ),
+            key=lambda candidate: candidate[0],
+            reverse=True,
+        )
+        kept_chunks = [[] for _ in kept_deltas]
+        for score, delta_position, chunk in candidates:
+            # Chunks are rendered with a file header or a "..." separator
+            tokens = self.count_tokens(chunk.text) + self.count_tokens(chunk.filename)
+            if tokens <= remaining:
+                remaining -= tokens
+                kept_chunks[delta_position].append(chunk)
+            else:
+                dropped.append(
+                    f"context chunk {chunk.idx} of {chunk.filename} (score {score:.3f}, {tokens} tokens)"
+                )
+        kept_deltas = [
+            file_delta._replace(context=tuple(sorted(chunks, key=lambda c: c.idx)))
+            for file_delta, chunks in zip(kept_deltas, kept_chunks)
+        ]
+
+        kept_comments = []
+        for comment in reversed(comments):
+            tokens = self.count_tokens(comment)
+            if tokens <= remaining:
+                remaining -= tokens
+                kept_comments.insert(0, comment)
+            else:
+                dropped.append(f"comment ({tokens} tokens)")
+
+        if dropped:
+            logging.warning(
+                "Prompt over budget of %s tokens, dropped:\n%s",
+                self.budget,
+                "\n".join(dropped),
+            )
+        return PackedPrompt(
+            deltas=kept_deltas,
+            repo_instructions=repo_instructions,
+            comments=kept_comments,
+            dropped=dropped,
+            tokens=self.budget - remaining,
+        )
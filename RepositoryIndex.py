@@ -0,0 +1,170 @@
+import json
+import os
+import threading
+from typing import Dict, Iterable
+
+from GPTutils import FilesIndex
+from GPTsettings import GPTsettings
+from EmbeddingCache import EmbeddingCache
+from FileSources import DiffFile, FileSource
+from SymbolIndex import SymbolIndex
+from VectorStore import VectorStore
+
+
+class RepositoryIndex(FilesIndex):
+    """
+    A FilesIndex over every file of a repository at a base commit. It is stored on disk and
+    updated incrementally: moving to a new commit only re-chunks and re-embeds the blobs that
+    changed since the indexed commit, and drops the chunks of deleted files. The symbol index of
+    the files is updated and stored along with the chunks.
+    """
+
+    MANIFEST_FILE = "manifest.json"
+    # Indexes written with another version of the on-disk format are rebuilt
+    FORMAT_VERSION = 4
+    SYMBOLS_FILE = "symbols.json"
+
+    def __init__(
+        self,
+        file_source: FileSource,
+        path: str,
+        file_extensions: Iterable[str] = GPTsettings.FILE_EXTENSIONS,
+        embeddings_cache: EmbeddingCache = None,
+    ) -> None:
+        """
+        Initializes a new instance of the RepositoryIndex class, loading it from disk if it was saved before.
+
+        Args:
+            file_source (FileSource): The backend used to list and read the repository files.
+            path (str): The directory where the index is stored.
+            file_extensions (Iterable[str], optional): The extensions of the files to index. Defaults to GPTsettings.FILE_EXTENSIONS.
+            embeddings_cache (EmbeddingCache, optional): A cache of already computed chunk embeddings. Defaults to None.
+        """
+        super().__init__({}, embeddings_cache=embeddings_cache)
+        self.file_source = file_source
+        self.path = path
+        self.file_extensions = tuple(file_extensions)
+        self.commit: str = None
+        self.blob_shas: Dict[str, str] = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def update(self, commit: str) -> None:
+        """
+        Brings the index to a commit, re-indexing only the files whose blob changed, and saves it.
+
+        Args:
+            commit (str): The SHA of the commit to index.
+        """
+        with self.lock:
+            if commit == self.commit:
+                return
+
+            blob_shas = {
+                path: sha
+                for path, sha in self.file_source.list_blobs(ref=commit).items()
+                if path.endswith(self.file_extensions)
+            }
+            changed = [
+                DiffFile(filename=path, status="modified", sha=sha, patch=None)
+                for path, sha in blob_shas.items()
+                if self.blob_shas.get(path) != sha
+            ]
+            changed_paths = {file.filename for file in changed}
+            self.remove_files(
+                [
+                    path
+                    for path in self.index
+                    if path not in blob_shas or path in changed_paths
+                ]
+            )
+            contents = self.file_source.fetch_pr_files(changed, ref=commit)
+            failed = {
+                file.filename
+                for file in changed
+                if contents.get(file.filename)
+                in (None, "Could not retrieve file contents.")
+            }
+            self.add_files(
+                {
+                    path: content
+                    for path, content in contents.items()
+                    if path not in failed
+                }
+            )
+            # Files that couldn't be fetched are not recorded, so the next update retries them,
+            # even for the same commit
+            for path in failed:
+                del blob_shas[path]
+            # Only the blobs of the last update are kept in memory
+            self.files = {}
+            self.blob_shas = blob_shas
+            self.commit = None if failed else commit
+            self.save()
+
+    def get_pr_index(self, files: Dict[str, str], removed=()) -> FilesIndex:
+        """
+        Builds an index of the repository as seen by a pull request, without changing this one.
+
+        Args:
+            files (Dict[str, str]): The contents of the files changed by the pull request. {Filename: FileContent}
+            removed (Iterable[str], optional): The files deleted by the pull request. Defaults to ().
+
+        Returns:
+            FilesIndex: A copy of this index with the pull request files replaced.
+        """
+        with self.lock:
+            index = self.copy()
+        index.remove_files(list(removed))
+        index.add_files(files)
+        return index
+
+    def load(self) -> None:
+        """
+        Loads the index from disk. Indexes built with another format version, embeddings model,
+        chunk size or retrieval backend are ignored, as are stores that can't be read.
+        """
+        try:
+            store = VectorStore(self.path)
+        except (FileNotFoundError, ValueError):
+            return
+        manifest_path = os.path.join(store.directory, self.MANIFEST_FILE)
+        symbols_path = os.path.join(store.directory, self.SYMBOLS_FILE)
+        if not os.path.exists(manifest_path) or not os.path.exists(symbols_path):
+            return
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+        if (
+            manifest.get("format_version") != self.FORMAT_VERSION
+            or manifest["model"] != GPTsettings.EMBEDDINGS_MODEL
+            or manifest.get("chunk_max_tokens") != GPTsettings.CHUNK_MAX_TOKENS
+            or manifest.get("retrieval_backend") != self.backend
+        ):
+            return
+
+        self.load_vector_store(store)
+        self.symbols = SymbolIndex.load(symbols_path)
+        self.blob_shas = manifest["blob_shas"]
+        self.commit = manifest["commit"]
+
+    def save(self) -> None:
+        """
+        Saves the index to disk. The manifest and the symbols are written to the generation of the
+        vector store, so they are published along with the chunks in a single step.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        manifest = {
+            "commit": self.commit,
+            "format_version": self.FORMAT_VERSION,
+            "model": GPTsettings.EMBEDDINGS_MODEL,
+            "chunk_max_tokens": GPTsettings.CHUNK_MAX_TOKENS,
+            "retrieval_backend": self.backend,
+            "blob_shas": self.blob_shas,
+        }
+
+        def write_files(directory: str) -> None:
+            self.symbols.save(os.path.join(directory, self.SYMBOLS_FILE))
+            with open(os.path.join(directory, self.MANIFEST_FILE), "w") as file:
+                json.dump(manifest, file)
+
+        self.save_vector_store(self.path, write_files)
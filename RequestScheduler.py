@@ -0,0 +1,560 @@
+from collections import defaultdict, deque
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Iterator, Optional
+import asyncio
+import contextlib
+import hashlib
+import logging
+import random
+import re
+import threading
+import time
+
+from GPTsettings import GPTsettings
+
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+# The transport errors of the GitHub (requests) and OpenAI (httpx) clients
+RETRYABLE_ERROR_NAMES = (
+    "ConnectionError",
+    "Timeout",
+    "ReadTimeout",
+    "ConnectTimeout",
+    "APIConnectionError",
+    "APITimeoutError",
+)
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket. Callers reserve a token and wait the returned delay, so
+    waiting can be done with time.sleep or asyncio.sleep.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        """
+        Initializes a new instance of the TokenBucket class.
+
+        Args:
+            rate (float): The number of tokens added per second.
+            capacity (float): The maximum number of tokens, i.e. the allowed burst.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Takes a token, going into debt when the bucket is empty.
+
+        Returns:
+            float: The number of seconds to wait before using the token.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(delay, self.paused_until - now)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Holds every token for a number of seconds, e.g. until a rate limit window resets.
+
+        Args:
+            seconds (float): The number of seconds to pause for.
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class ConcurrencyLimit:
+    """
+    A counting semaphore shared by threads and event loops. Threads wait on a condition, and
+    coroutines await a future that the release freeing their slot resolves in their own loop,
+    so a coroutine never blocks its loop and a cancelled one never keeps a slot.
+    """
+
+    def __init__(self, limit: int) -> None:
+        """
+        Initializes a new instance of the ConcurrencyLimit class.
+
+        Args:
+            limit (int): The number of slots.
+        """
+        self.available = limit
+        self.condition = threading.Condition()
+        # The (loop, future) of every waiting coroutine, served before the waiting threads
+        self.waiters = deque()
+
+    def acquire(self) -> None:
+        """
+        Takes a slot, blocking the thread until one is free.
+        """
+        with self.condition:
+            while self.available <= 0:
+                self.condition.wait()
+            self.available -= 1
+
+    async def aacquire(self) -> None:
+        """
+        Takes a slot, waiting without blocking the event loop until one is free.
+        """
+        loop = asyncio.get_running_loop()
+        with self.condition:
+            if self.available > 0 and not self.waiters:
+                self.available -= 1
+                return
+            future = loop.create_future()
+            self.waiters.append((loop, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self.condition:
+                try:
+                    self.waiters.remove((loop, future))
+                except ValueError:
+                    # The slot was handed over, if the future got it before the cancellation it
+                    # is released here, otherwise by grant
+                    if future.done() and not future.cancelled():
+                        self.release()
+            raise
+
+    def release(self) -> None:
+        """
+        Frees a slot, handing it over to the first waiting coroutine if there is one.
+        """
+        with self.condition:
+            while self.waiters:
+                loop, future = self.waiters.popleft()
+                try:
+                    loop.call_soon_threadsafe(self.grant, future)
+                    return
+                except RuntimeError:
+                    continue  # The loop is closed
+            self.available += 1
+            self.condition.notify()
+
+    def grant(self, future: asyncio.Future) -> None:
+        """
+        Resolves the future of a waiting coroutine, in its loop, or frees the slot if it was cancelled.
+
+        Args:
+            future (asyncio.Future): The future of the coroutine.
+        """
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+
+def get_status(error: Exception) -> Optional[int]:
+    """
+    Gets the HTTP status of a GitHub or OpenAI client error.
+
+    Args:
+        error (Exception): The error raised by the client.
+
+    Returns:
+        Optional[int]: The HTTP status, or None if the request got no response.
+    """
+    return getattr(error, "status", None) or getattr(error, "status_code", None)
+
+
+def get_headers(error: Exception) -> Dict[str, str]:
+    """
+    Gets the response headers of a GitHub or OpenAI client error, with lowercase names.
+
+    Args:
+        error (Exception): The error raised by the client.
+
+    Returns:
+        Dict[str, str]: The response headers.
+    """
+    headers = getattr(error, "headers", None)
+    if headers is None and getattr(error, "response", None) is not None:
+        headers = error.response.headers
+    return {name.lower(): value for name, value in (headers or {}).items()}
+
+
+def parse_duration(duration: str) -> float:
+    """
+    Parses the durations of the OpenAI `x-ratelimit-reset-*` headers, e.g. "20ms", "1s" or "6m0s".
+
+    Args:
+        duration (str): The duration.
+
+    Returns:
+        float: The duration in seconds.
+    """
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(
+        float(value) * units[unit]
+        for value, unit in re.findall(r"([\d.]+)(ms|s|m|h)", duration)
+    )
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """
+    Reads how long to wait before retrying from the rate limit headers of an error response.
+
+    Args:
+        error (Exception): The error raised by the client.
+
+    Returns:
+        Optional[float]: The number of seconds to wait, or None if the server gave no hint.
+    """
+    headers = get_headers(error)
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            try:
+                return float(headers["retry-after"])
+            except ValueError:
+                retry_at = parsedate_to_datetime(headers["retry-after"])
+                return retry_at.timestamp() - time.time()
+        # GitHub primary rate limit: the reset time is an epoch timestamp
+        if (
+            headers.get("x-ratelimit-remaining") == "0"
+            and "x-ratelimit-reset" in headers
+        ):
+            return float(headers["x-ratelimit-reset"]) - time.time()
+        # OpenAI: separate windows for requests and tokens
+        delays = [
+            parse_duration(headers[f"x-ratelimit-reset-{limit}"])
+            for limit in ("requests", "tokens")
+            if headers.get(f"x-ratelimit-remaining-{limit}") == "0"
+            and f"x-ratelimit-reset-{limit}" in headers
+        ]
+        if delays:
+            return max(delays)
+    except (TypeError, ValueError):
+        logging.warning("Could not parse rate limit headers: %s", headers)
+    return None
+
+
+def is_retryable(error: Exception, idempotent: bool = True) -> bool:
+    """
+    Decides whether a failed request should be retried: rate limits (including GitHub's secondary
+    rate limits, answered with a 403), server errors and transport errors.
+
+    Requests that are not idempotent, e.g. creating a review, may have been applied when they
+    fail with a server or transport error, so they are only retried when the server rejected
+    them: a 429, a rate limited 403 or an explicit `retry-after`.
+
+    Args:
+        error (Exception): The error raised by the client.
+        idempotent (bool, optional): Whether the request can safely be made twice. Defaults to True.
+
+    Returns:
+        bool: True if the request should be retried.
+    """
+    status = get_status(error)
+    headers = get_headers(error)
+    if status == 429 or (status is not None and "retry-after" in headers):
+        return True
+    if status == 403:
+        return (
+            headers.get("x-ratelimit-remaining") == "0"
+            or "rate limit" in str(error).lower()
+        )
+    if not idempotent:
+        return False
+    if status in RETRYABLE_STATUSES:
+        return True
+    return status is None and any(
+        cls.__name__ in RETRYABLE_ERROR_NAMES for cls in type(error).__mro__
+    )
+
+
+class RequestScheduler:
+    """
+    Schedules the outbound requests to GitHub and OpenAI:
+
+    - a token bucket per service and credential limits the request rate
+    - a semaphore per endpoint caps the requests in flight
+    - retryable failures are retried with jittered exponential backoff, or after the delay given by
+      the `retry-after` / `x-ratelimit-*` headers, in which case every request of the credential waits
+
+    Endpoints are named "<service>" or "<service>.<name>", e.g. "github", "github.write" or "openai.chat".
+    Requests to "<service>.write" endpoints are not idempotent and only retried when rate limited.
+    The time spent waiting is recorded per endpoint and returned by `get_metrics`.
+    """
+
+    def __init__(
+        self,
+        rate_limits: Dict[str, tuple] = GPTsettings.RATE_LIMITS,
+        concurrency: Dict[str, int] = GPTsettings.ENDPOINT_CONCURRENCY,
+        max_retries: int = GPTsettings.REQUEST_MAX_RETRIES,
+        backoff_base: float = GPTsettings.REQUEST_BACKOFF_BASE,
+        backoff_max: float = GPTsettings.REQUEST_BACKOFF_MAX,
+    ) -> None:
+        """
+        Initializes a new instance of the RequestScheduler class.
+
+        Args:
+            rate_limits (Dict[str, tuple], optional): The (requests per second, burst) of every service. Defaults to GPTsettings.RATE_LIMITS.
+            concurrency (Dict[str, int], optional): The maximum requests in flight per endpoint. Defaults to GPTsettings.ENDPOINT_CONCURRENCY.
+            max_retries (int, optional): The number of retries of a failed request. Defaults to GPTsettings.REQUEST_MAX_RETRIES.
+            backoff_base (float, optional): The backoff of the first retry in seconds. Defaults to GPTsettings.REQUEST_BACKOFF_BASE.
+            backoff_max (float, optional): The maximum backoff in seconds. Defaults to GPTsettings.REQUEST_BACKOFF_MAX.
+        """
+        self.rate_limits = rate_limits
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.buckets: Dict[tuple, TokenBucket] = {}
+        self.semaphores: Dict[str, Optional[ConcurrencyLimit]] = {}
+        self.lock = threading.Lock()
+        self.metrics = defaultdict(
+            lambda: {"requests": 0, "retries": 0, "failures": 0, "wait_seconds": 0.0}
+        )
+
+    def get_bucket(self, endpoint: str, credential: Optional[str]) -> TokenBucket:
+        """
+        Gets the token bucket of the service of an endpoint and a credential.
+
+        Args:
+            endpoint (str): The endpoint name.
+            credential (Optional[str]): The token or API key used for the request.
+
+        Returns:
+            TokenBucket: The token bucket.
+        """
+        service = endpoint.split(".")[0]
+        # Only a digest of the credential is kept
+        key = (service, hashlib.sha256((credential or "").encode()).hexdigest())
+        with self.lock:
+            if key not in self.buckets:
+                rate, capacity = self.rate_limits.get(service, (100.0, 100))
+                self.buckets[key] = TokenBucket(rate, capacity)
+            return self.buckets[key]
+
+    def get_semaphore(self, endpoint: str) -> Optional[ConcurrencyLimit]:
+        """
+        Gets the semaphore capping the requests in flight to an endpoint.
+
+        Args:
+            endpoint (str): The endpoint name.
+
+        Returns:
+            Optional[ConcurrencyLimit]: The semaphore, or None if the endpoint has no cap.
+        """
+        with self.lock:
+            if endpoint not in self.semaphores:
+                limit = self.concurrency.get(endpoint)
+                self.semaphores[endpoint] = limit and ConcurrencyLimit(limit)
+            return self.semaphores[endpoint]
+
+    def get_backoff(self, error: Exception, attempt: int, bucket: TokenBucket) -> float:
+        """
+        Computes the delay before retrying a failed request. Delays given by the server pause the
+        whole bucket, so the other requests of the credential wait as well.
+
+        Args:
+            error (Exception): The error of the failed request.
+            attempt (int): The number of the failed attempt, starting at 0.
+            bucket (TokenBucket): The token bucket of the request.
+
+        Returns:
+            float: The number of seconds to wait before retrying.
+        """
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            bucket.pause(max(retry_after, 0.0))
+            return 0.0  # Waited when reserving the next token
+        # Full jitter
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+    def record(self, endpoint: str, metric: str, value=1) -> None:
+        """
+        Adds a value to a metric of an endpoint.
+
+        Args:
+            endpoint (str): The endpoint name.
+            metric (str): The metric name.
+            value (int | float, optional): The value to add. Defaults to 1.
+        """
+        with self.lock:
+            self.metrics[endpoint][metric] += value
+
+    def get_metrics(self) -> Dict[str, dict]:
+        """
+        Gets the number of requests, retries and failures, and the seconds spent waiting for rate
+        limits, concurrency slots and backoffs, per endpoint.
+
+        Returns:
+            Dict[str, dict]: The metrics keyed by endpoint.
+        """
+        with self.lock:
+            return {
+                endpoint: dict(metrics) for endpoint, metrics in self.metrics.items()
+            }
+
+    def on_error(
+        self, endpoint: str, error: Exception, attempt: int, bucket: TokenBucket
+    ) -> float:
+        """
+        Records a failed request and decides whether it is retried.
+
+        Args:
+            endpoint (str): The endpoint name.
+            error (Exception): The error of the failed request.
+            attempt (int): The number of the failed attempt, starting at 0.
+            bucket (TokenBucket): The token bucket of the request.
+
+        Returns:
+            float: The number of seconds to wait before retrying.
+
+        Raises:
+            Exception: The error, if it is not retryable or the retries are exhausted.
+        """
+        idempotent = not endpoint.endswith(".write")
+        if not is_retryable(error, idempotent) or attempt >= self.max_retries:
+            self.record(endpoint, "failures")
+            raise error
+        delay = self.get_backoff(error, attempt, bucket)
+        self.record(endpoint, "retries")
+        logging.warning(
+            "Request to %s failed (%s), retry %s/%s",
+            endpoint,
+            error,
+            attempt + 1,
+            self.max_retries,
+        )
+        return delay
+
+    @contextlib.contextmanager
+    def slot(self, endpoint: str):
+        """
+        Holds a concurrency slot of an endpoint.
+
+        Args:
+            endpoint (str): The endpoint name.
+        """
+        semaphore = self.get_semaphore(endpoint)
+        if semaphore is None:
+            yield
+            return
+        start = time.monotonic()
+        semaphore.acquire()
+        self.record(endpoint, "wait_seconds", time.monotonic() - start)
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    def call(
+        self,
+        endpoint: str,
+        credential: Optional[str],
+        function: Callable,
+        *args,
+        **kwargs,
+    ):
+        """
+        Calls a function making a request, under the rate limits of its endpoint and credential.
+
+        Args:
+            endpoint (str): The endpoint name.
+            credential (Optional[str]): The token or API key used for the request.
+            function (Callable): The function making the request.
+            *args: The positional arguments of the function.
+            **kwargs: The keyword arguments of the function.
+
+        Returns:
+            Any: The result of the function.
+        """
+        bucket = self.get_bucket(endpoint, credential)
+        for attempt in range(self.max_retries + 1):
+            with self.slot(endpoint):
+                delay = bucket.reserve()
+                if delay > 0:
+                    self.record(endpoint, "wait_seconds", delay)
+                    time.sleep(delay)
+                self.record(endpoint, "requests")
+                try:
+                    return function(*args, **kwargs)
+                except Exception as error:
+                    delay = self.on_error(endpoint, error, attempt, bucket)
+            self.record(endpoint, "wait_seconds", delay)
+            time.sleep(delay)
+
+    async def acall(
+        self,
+        endpoint: str,
+        credential: Optional[str],
+        function: Callable,
+        *args,
+        **kwargs,
+    ):
+        """
+        Awaits a coroutine function making a request, under the rate limits of its endpoint and
+        credential, without blocking the event loop.
+
+        Args:
+            endpoint (str): The endpoint name.
+            credential (Optional[str]): The token or API key used for the request.
+            function (Callable): The coroutine function making the request.
+            *args: The positional arguments of the function.
+            **kwargs: The keyword arguments of the function.
+
+        Returns:
+            Any: The result of the function.
+        """
+        bucket = self.get_bucket(endpoint, credential)
+        semaphore = self.get_semaphore(endpoint)
+        for attempt in range(self.max_retries + 1):
+            if semaphore is not None:
+                start = time.monotonic()
+                await semaphore.aacquire()
+                self.record(endpoint, "wait_seconds", time.monotonic() - start)
+            try:
+                delay = bucket.reserve()
+                if delay > 0:
+                    self.record(endpoint, "wait_seconds", delay)
+                    await asyncio.sleep(delay)
+                self.record(endpoint, "requests")
+                try:
+                    return await function(*args, **kwargs)
+                except Exception as error:
+                    delay = self.on_error(endpoint, error, attempt, bucket)
+            finally:
+                if semaphore is not None:
+                    semaphore.release()
+            self.record(endpoint, "wait_seconds", delay)
+            await asyncio.sleep(delay)
+
+    def paginate(
+        self, endpoint: str, credential: Optional[str], paginated_list
+    ) -> Iterator:
+        """
+        Iterates over a PyGithub paginated list, fetching every page in its own request, so each
+        page counts against the rate limits and a retry only fetches its page again.
+
+        Args:
+            endpoint (str): The endpoint name.
+            credential (Optional[str]): The token used for the requests.
+            paginated_list (PaginatedList): The paginated list, created with GPTsettings.GITHUB_PER_PAGE items per page.
+
+        Returns:
+            Iterator: The items of the list, pages being fetched as the iteration reaches them.
+        """
+        page = 0
+        while True:
+            items = self.call(endpoint, credential, paginated_list.get_page, page)
+            yield from items
+            if len(items) < GPTsettings.GITHUB_PER_PAGE:
+                return
+            page += 1
+
+
+# Shared by every client of the process, so concurrent reviews share the rate limits of a credential
+scheduler = RequestScheduler()
@@ -0,0 +1,275 @@
+from abc import ABC, abstractmethod
+from typing import Callable, List, Optional
+
+import numpy as np
+
+from BM25Index import BM25Index
+from VectorStore import VectorStore
+
+RETRIEVAL_BACKENDS = ("vector", "bm25", "hybrid")
+
+
+class RetrievalBackend(ABC):
+    """
+    Scores the documents of a FilesIndex against queries. A backend keeps one entry per document
+    of the index, in the same order, and is saved to the generation directory of its vector store.
+    """
+
+    # The unit-length embedding of every document, None if the backend doesn't embed them
+    embeddings: Optional[np.ndarray] = None
+
+    @abstractmethod
+    def add(self, docs: List[str], groups: List[int]) -> None:
+        """
+        Appends documents.
+
+        Args:
+            docs (List[str]): The documents.
+            groups (List[int]): The duplicate group of every document.
+        """
+
+    @abstractmethod
+    def select(self, keep: List[int]) -> None:
+        """
+        Keeps only some documents, renumbered in the given order.
+
+        Args:
+            keep (List[int]): The indices of the documents to keep.
+        """
+
+    @abstractmethod
+    def score(self, queries: List[str]) -> np.ndarray:
+        """
+        Scores every document against every query.
+
+        Args:
+            queries (List[str]): The queries.
+
+        Returns:
+            np.ndarray: The scores, at most 1, one row per query and one column per document.
+        """
+
+    @abstractmethod
+    def copy(self) -> "RetrievalBackend":
+        """
+        Copies the backend, so documents can be added to or removed from the copy without changing this one.
+
+        Returns:
+            RetrievalBackend: The copy.
+        """
+
+    @abstractmethod
+    def save(self, directory: str) -> None:
+        """
+        Writes the files of the backend that the vector store doesn't hold.
+
+        Args:
+            directory (str): The generation directory of the vector store.
+        """
+
+    @abstractmethod
+    def load(self, store: VectorStore) -> None:
+        """
+        Replaces the documents of the backend with those of a vector store.
+
+        Args:
+            store (VectorStore): The opened vector store.
+        """
+
+
+class VectorBackend(RetrievalBackend):
+    """
+    Scores documents by the cosine similarity of their embeddings with the query embeddings.
+    Documents of the same duplicate group are embedded once.
+    """
+
+    def __init__(self, embed: Callable[[List[str]], np.ndarray]) -> None:
+        """
+        Initializes a new, empty instance of the VectorBackend class.
+
+        Args:
+            embed (Callable[[List[str]], np.ndarray]): Computes the unit-length embeddings of texts.
+        """
+        self.embed = embed
+        self.embeddings = np.zeros((0, 0), dtype=np.float32)  # Unit-length rows
+        self.groups: List[int] = []
+
+    def add(self, docs: List[str], groups: List[int]) -> None:
+        if not docs:
+            return
+        # Groups already in the index reuse the embedding of their first document
+        rows = {}
+        for idx, group in enumerate(self.groups):
+            rows.setdefault(group, idx)
+        missing = {}
+        for doc, group in zip(docs, groups):
+            if group not in rows:
+                missing.setdefault(group, doc)
+        embeddings = {}
+        if missing:
+            embeddings = dict(zip(missing, self.embed(list(missing.values()))))
+        new_embeddings = np.array(
+            [
+                (
+                    embeddings[group]
+                    if group in embeddings
+                    else self.embeddings[rows[group]]
+                )
+                for group in groups
+            ],
+            dtype=np.float32,
+        )
+        if self.groups:
+            self.embeddings = np.vstack([self.embeddings, new_embeddings])
+        else:
+            self.embeddings = new_embeddings
+        self.groups = self.groups + list(groups)
+
+    def select(self, keep: List[int]) -> None:
+        self.embeddings = self.embeddings[keep]
+        self.groups = [self.groups[idx] for idx in keep]
+
+    def score(self, queries: List[str]) -> np.ndarray:
+        return np.dot(self.embed(queries), self.embeddings.T)
+
+    def copy(self) -> "VectorBackend":
+        # The embedding matrix and the groups are replaced rather than modified
+        backend = VectorBackend(self.embed)
+        backend.embeddings = self.embeddings
+        backend.groups = self.groups
+        return backend
+
+    def save(self, directory: str) -> None:
+        pass  # The embeddings are written by the vector store
+
+    def load(self, store: VectorStore) -> None:
+        self.embeddings = store.embeddings
+        self.groups = store.groups
+
+
+class BM25Backend(RetrievalBackend):
+    """
+    Scores documents with an in-process BM25 index, scaled to the best document of each query.
+    Nothing is embedded.
+    """
+
+    def __init__(self) -> None:
+        """
+        Initializes a new, empty instance of the BM25Backend class.
+        """
+        self.index = BM25Index()
+
+    def add(self, docs: List[str], groups: List[int]) -> None:
+        self.index.add(docs)
+
+    def select(self, keep: List[int]) -> None:
+        self.index.select(keep)
+
+    def score(self, queries: List[str]) -> np.ndarray:
+        scores = self.index.score(queries)
+        return scores / np.maximum(scores.max(axis=1, keepdims=True), 1e-9)
+
+    def copy(self) -> "BM25Backend":
+        backend = BM25Backend()
+        backend.index = self.index.copy()
+        return backend
+
+    def save(self, directory: str) -> None:
+        self.index.save(directory)
+
+    def load(self, store: VectorStore) -> None:
+        if BM25Index.exists(store.directory):
+            self.index = BM25Index.load(store.directory)
+        else:
+            self.index = BM25Index()
+            self.index.add(list(store.docs))
+
+
+class HybridBackend(RetrievalBackend):
+    """
+    Blends the scores of a vector and a BM25 backend. Both are min-max normalized per query first:
+    cosine similarities sit in a narrow band, so unscaled they would barely move the BM25 ranking.
+    """
+
+    def __init__(
+        self, vector: VectorBackend, lexical: BM25Backend, weight: float
+    ) -> None:
+        """
+        Initializes a new instance of the HybridBackend class.
+
+        Args:
+            vector (VectorBackend): The embeddings backend.
+            lexical (BM25Backend): The BM25 backend.
+            weight (float): The weight of the vector scores, the BM25 scores get the rest.
+        """
+        self.vector = vector
+        self.lexical = lexical
+        self.weight = weight
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        return self.vector.embeddings
+
+    def add(self, docs: List[str], groups: List[int]) -> None:
+        self.vector.add(docs, groups)
+        self.lexical.add(docs, groups)
+
+    def select(self, keep: List[int]) -> None:
+        self.vector.select(keep)
+        self.lexical.select(keep)
+
+    def score(self, queries: List[str]) -> np.ndarray:
+        return self.weight * min_max_scale(self.vector.score(queries)) + (
+            1 - self.weight
+        ) * min_max_scale(self.lexical.score(queries))
+
+    def copy(self) -> "HybridBackend":
+        return HybridBackend(self.vector.copy(), self.lexical.copy(), self.weight)
+
+    def save(self, directory: str) -> None:
+        self.vector.save(directory)
+        self.lexical.save(directory)
+
+    def load(self, store: VectorStore) -> None:
+        self.vector.load(store)
+        self.lexical.load(store)
+
+
+def min_max_scale(scores: np.ndarray) -> np.ndarray:
+    """
+    Scales every row of scores to [0, 1]. Rows where every score is equal become 0.
+
+    Args:
+        scores (np.ndarray): The scores, one row per query.
+
+    Returns:
+        np.ndarray: The scaled scores.
+    """
+    low = scores.min(axis=1, keepdims=True)
+    spread = scores.max(axis=1, keepdims=True) - low
+    return (scores - low) / np.maximum(spread, 1e-9)
+
+
+def create_backend(
+    name: str, embed: Callable[[List[str]], np.ndarray], vector_weight: float
+) -> RetrievalBackend:
+    """
+    Creates an empty retrieval backend.
+
+    Args:
+        name (str): The backend, one of RETRIEVAL_BACKENDS.
+        embed (Callable[[List[str]], np.ndarray]): Computes the unit-length embeddings of texts.
+        vector_weight (float): The weight of the vector scores in the hybrid backend.
+
+    Returns:
+        RetrievalBackend: The backend.
+    """
+    if name == "vector":
+        return VectorBackend(embed)
+    if name == "bm25":
+        return BM25Backend()
+    if name == "hybrid":
+        return HybridBackend(VectorBackend(embed), BM25Backend(), vector_weight)
+    raise ValueError(
+        f"Unknown retrieval backend {name!r}, expected one of {RETRIEVAL_BACKENDS}"
+    )
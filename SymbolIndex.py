@@ -0,0 +1,681 @@
+from bisect import bisect_right
+from itertools import accumulate
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+import ast
+import json
+import os
+import re
+
+from Chunker import LANGUAGES, parse_python
+from DiffPositionIndex import HUNK_HEADER
+from GPTsettings import GPTsettings
+
+IDENTIFIER = re.compile(r"(?<![\w$])[A-Za-z_$][\w$]*")
+# Receivers of attributes that refer to the definitions of their own file
+SELF_RECEIVERS = frozenset(("self", "cls", "this"))
+# Definitions of the languages without a parser in the standard library, the name is the last group
+DEFINITION_PATTERNS: Dict[str, Tuple[Tuple[str, re.Pattern], ...]] = {
+    language: tuple(
+        (kind, re.compile(pattern, re.MULTILINE)) for kind, pattern in patterns
+    )
+    for language, patterns in {
+        "js": (
+            (
+                "class",
+                r"^[ \t]*(?:export\s+)?(?:default\s+)?(?:abstract\s+)?class\s+([\w$]+)",
+            ),
+            (
+                "function",
+                r"^[ \t]*(?:export\s+)?(?:default\s+)?(?:async\s+)?function\s*\*?\s*([\w$]+)",
+            ),
+            (
+                "function",
+                r"^[ \t]*(?:export\s+)?(?:const|let|var)\s+([\w$]+)\s*=\s*(?:async\s+)?(?:function\b|\([^)\n]*\)\s*=>|[\w$]+\s*=>)",
+            ),
+            (
+                "method",
+                r"^[ \t]+(?:(?:static|async|get|set)[ \t]+)*([\w$]+)[ \t]*\([^)\n]*\)[ \t]*\{",
+            ),
+        ),
+        "ts": (
+            (
+                "class",
+                r"^[ \t]*(?:export\s+)?(?:default\s+)?(?:declare\s+)?(?:abstract\s+)?(class|interface|enum|type)\s+([\w$]+)",
+            ),
+            (
+                "function",
+                r"^[ \t]*(?:export\s+)?(?:default\s+)?(?:declare\s+)?(?:async\s+)?function\s*\*?\s*([\w$]+)",
+            ),
+            (
+                "function",
+                r"^[ \t]*(?:export\s+)?(?:const|let|var)\s+([\w$]+)(?:\s*:[^=\n]+)?\s*=\s*(?:async\s+)?(?:function\b|\([^)\n]*\)[^=\n]*=>|[\w$]+\s*=>)",
+            ),
+            (
+                "method",
+                r"^[ \t]+(?:(?:public|private|protected|static|readonly|override|abstract|async|get|set)[ \t]+)*([\w$]+)[ \t]*(?:<[^>\n]*>)?\([^)\n]*\)[^;{\n]*\{",
+            ),
+        ),
+        "java": (
+            (
+                "class",
+                r"^[ \t]*(?:(?:public|private|protected|abstract|final|static|sealed)\s+)*(class|interface|enum|record|@interface)\s+(\w+)",
+            ),
+            (
+                "method",
+                r"^[ \t]+(?:@\w+\s+)*(?:(?:public|private|protected|static|final|abstract|synchronized|default|native)[ \t]+)+(?:<[^>\n]*>[ \t]+)?[\w<>\[\], ?.]+[ \t]+(\w+)[ \t]*\(",
+            ),
+        ),
+    }.items()
+}
+# Context found by resolved symbol lookups scores above any cosine similarity, so it is packed
+# first. Matches by name only, e.g. "items.update(" for every "update" method, score below any
+# retrieval score, so they only fill the slots left by embedding search
+DEFINITION_SCORE = 2.0
+CALLER_SCORE = 1.5
+UNVERIFIED_SCORE = 0.0
+CALL_PATTERN = re.compile(r"(?<![\w$])([A-Za-z_$][\w$]*)\s*\(")
+# Words followed by a parenthesis that are not calls
+NOT_CALLS = frozenset(
+    "if for while switch catch function return typeof new super this await yield "
+    "synchronized sizeof foreach elif with assert print".split()
+)
+# Imports of the languages parsed with patterns: the bound names and the imported module
+IMPORT_PATTERNS: Dict[str, Tuple[re.Pattern, ...]] = {
+    "js": (
+        re.compile(
+            r"^[ \t]*import\s+(?:type\s+)?(?:([\w$]+)\s*,?\s*)?(?:\{([^}]*)\}|\*\s*as\s+([\w$]+))?\s*from\s*['\"]([^'\"]+)['\"]",
+            re.MULTILINE,
+        ),
+        re.compile(
+            r"(?:const|let|var)\s+(?:([\w$]+)|\{([^}]*)\})\s*=\s*require\(\s*['\"]([^'\"]+)['\"]\s*\)"
+        ),
+    ),
+    "java": (
+        re.compile(
+            r"^[ \t]*import\s+(?:static\s+)?([\w.]+?)(?:\.\*)?\s*;", re.MULTILINE
+        ),
+    ),
+}
+IMPORT_PATTERNS["ts"] = IMPORT_PATTERNS["js"]
+
+
+class Symbol(NamedTuple):
+    """
+    A definition: a function, method, class or top-level variable, and the lines it spans.
+    """
+
+    name: str
+    kind: str
+    path: str
+    start_line: int
+    end_line: int
+
+
+class Reference(NamedTuple):
+    """
+    A call to a symbol, by name, and the receiver it is called on: "" for a bare call, the dotted
+    name of the receiver (e.g. "self" or "os.path") or "?" for any other expression.
+    """
+
+    name: str
+    path: str
+    line: int
+    receiver: str = ""
+
+
+class FileSymbols(NamedTuple):
+    """
+    The definitions, calls and imports of a file. The imports map the names bound by the file to
+    the last part of the imported module or name, e.g. {"np": "numpy", "FilesIndex": "FilesIndex"}.
+    """
+
+    definitions: Tuple[Symbol, ...]
+    references: Tuple[Reference, ...]
+    imports: Dict[str, str]
+
+
+class HunkSymbols(NamedTuple):
+    """
+    The symbols touched by the changes of a file. A match is resolved when the name is used in the
+    file of its definition, imported, or accessed on an imported module or class of that file;
+    other matches share the name only.
+    """
+
+    definitions: List[Symbol]
+    callers: List[Reference]
+    unverified_definitions: List[Symbol]
+    unverified_callers: List[Reference]
+
+
+NO_SYMBOLS = FileSymbols((), (), {})
+
+
+class SymbolIndex:
+    """
+    Maps identifiers to the lines where they are defined and the lines that call them, parsing
+    Python files with ast and JavaScript, TypeScript and Java files with patterns.
+
+    Symbols are looked up by name and resolved through the receivers and imports of the files:
+    the context of a hunk is the definitions of the symbols it uses and the callers of the
+    symbols it changes, without any embedding.
+    """
+
+    def __init__(self) -> None:
+        """
+        Initializes a new, empty instance of the SymbolIndex class.
+        """
+        self.files: Dict[str, FileSymbols] = {}
+        self.definitions: Dict[str, List[Symbol]] = {}
+        self.callers: Dict[str, List[Reference]] = {}
+
+    def add_files(self, files: Dict[str, str]) -> None:
+        """
+        Parses files and adds their symbols. Files that are already indexed are replaced.
+
+        Args:
+            files (Dict[str, str]): The files to add. {Filename: FileContent}
+        """
+        self.remove_files([filename for filename in files if filename in self.files])
+        for filename, content in files.items():
+            self.add_file_symbols(filename, parse_symbols(filename, content))
+
+    def add_file_symbols(self, filename: str, symbols: FileSymbols) -> None:
+        """
+        Adds the symbols of a file to the name maps.
+
+        Args:
+            filename (str): The path to the file.
+            symbols (FileSymbols): The definitions and calls of the file.
+        """
+        self.files[filename] = symbols
+        for symbol in symbols.definitions:
+            self.definitions.setdefault(symbol.name, []).append(symbol)
+        for reference in symbols.references:
+            self.callers.setdefault(reference.name, []).append(reference)
+
+    def remove_files(self, filenames: Iterable[str]) -> None:
+        """
+        Drops the symbols of files. Files that are not indexed are ignored.
+
+        Args:
+            filenames (Iterable[str]): The files to remove.
+        """
+        for filename in filenames:
+            symbols = self.files.pop(filename, None)
+            if symbols is None:
+                continue
+            for names, entries in (
+                ({symbol.name for symbol in symbols.definitions}, self.definitions),
+                ({reference.name for reference in symbols.references}, self.callers),
+            ):
+                for name in names:
+                    kept = [entry for entry in entries[name] if entry.path != filename]
+                    if kept:
+                        entries[name] = kept
+                    else:
+                        del entries[name]
+
+    def copy(self) -> "SymbolIndex":
+        """
+        Copies the index so files can be added to or removed from the copy without changing this one.
+
+        Returns:
+            SymbolIndex: The copy of the index.
+        """
+        index = SymbolIndex()
+        index.files = dict(self.files)
+        index.definitions = {
+            name: list(symbols) for name, symbols in self.definitions.items()
+        }
+        index.callers = {
+            name: list(references) for name, references in self.callers.items()
+        }
+        return index
+
+    def get_hunk_symbols(self, filename: str, patch: str) -> HunkSymbols:
+        """
+        Looks up the symbols touched by the changes of a file.
+
+        Args:
+            filename (str): The path to the changed file.
+            patch (str): The patch of the file.
+
+        Returns:
+            HunkSymbols: The definitions of the symbols used by the changed lines, in order of use, and the calls
+                to the symbols defined by the changed lines, resolved or not. Names with more than
+                GPTsettings.SYMBOL_MAX_DEFINITIONS definitions are too ambiguous and left out.
+        """
+        changed_lines, changed_text = parse_patch(patch)
+
+        def overlaps(start_line: int, end_line: int) -> bool:
+            i = bisect_right(changed_lines, end_line)
+            return i > 0 and changed_lines[i - 1] >= start_line
+
+        hunk = HunkSymbols([], [], [], [])
+        for name, receiver in dict.fromkeys(get_used_symbols(changed_text)):
+            symbols = self.definitions.get(name, [])
+            if len(symbols) > GPTsettings.SYMBOL_MAX_DEFINITIONS:
+                continue
+            for symbol in symbols:
+                # The definitions changed by the patch are already in the delta
+                if symbol.path == filename and overlaps(
+                    symbol.start_line, symbol.end_line
+                ):
+                    continue
+                if self.resolves(filename, receiver, symbol):
+                    hunk.definitions.append(symbol)
+                else:
+                    hunk.unverified_definitions.append(symbol)
+
+        for symbol in self.files.get(filename, NO_SYMBOLS).definitions:
+            if not overlaps(symbol.start_line, symbol.end_line) or len(
+                self.definitions.get(symbol.name, [])
+            ) > (GPTsettings.SYMBOL_MAX_DEFINITIONS):
+                continue
+            for reference in self.callers.get(symbol.name, []):
+                if reference.path == filename and overlaps(
+                    reference.line, reference.line
+                ):
+                    continue
+                if self.resolves(reference.path, reference.receiver, symbol):
+                    hunk.callers.append(reference)
+                else:
+                    hunk.unverified_callers.append(reference)
+        return hunk
+
+    def resolves(self, path: str, receiver: str, symbol: Symbol) -> bool:
+        """
+        Checks whether a name used in a file can refer to a definition: a bare name or an attribute
+        of self, cls or this in the file of the definition, a bare name the file imports, or an
+        attribute of an imported module or of a class defined next to the definition.
+
+        Args:
+            path (str): The path to the file using the name.
+            receiver (str): The receiver the name is used on, "" for a bare name.
+            symbol (Symbol): The definition with the same name.
+
+        Returns:
+            bool: True if the use resolves to the definition.
+        """
+        if symbol.path == path and (not receiver or receiver in SELF_RECEIVERS):
+            return True
+        imports = self.files.get(path, NO_SYMBOLS).imports
+        if not receiver:
+            return symbol.name in imports
+        if receiver == "?":
+            return False
+        module = imports.get(receiver)
+        if module is not None and get_module_name(symbol.path) == module:
+            return True
+        # e.g. "GPTsettings.REPO_INDEX", with the class imported or defined in the file
+        return (receiver in imports or symbol.path == path) and any(
+            definition.kind == "class" and definition.path == symbol.path
+            for definition in self.definitions.get(receiver, ())
+        )
+
+    def save(self, path: str) -> None:
+        """
+        Writes the symbols of every file to a JSON file.
+
+        Args:
+            path (str): The path to the file.
+        """
+        with open(path + ".tmp", "w") as file:
+            json.dump(
+                {
+                    filename: {
+                        "definitions": [
+                            [
+                                symbol.name,
+                                symbol.kind,
+                                symbol.start_line,
+                                symbol.end_line,
+                            ]
+                            for symbol in symbols.definitions
+                        ],
+                        "references": [
+                            [reference.name, reference.line, reference.receiver]
+                            for reference in symbols.references
+                        ],
+                        "imports": symbols.imports,
+                    }
+                    for filename, symbols in self.files.items()
+                },
+                file,
+            )
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path: str) -> "SymbolIndex":
+        """
+        Reads an index written with save.
+
+        Args:
+            path (str): The path to the file.
+
+        Returns:
+            SymbolIndex: The index.
+        """
+        index = cls()
+        with open(path) as file:
+            files = json.load(file)
+        for filename, symbols in files.items():
+            index.add_file_symbols(
+                filename,
+                FileSymbols(
+                    tuple(
+                        Symbol(name, kind, filename, start_line, end_line)
+                        for name, kind, start_line, end_line in symbols["definitions"]
+                    ),
+                    tuple(
+                        Reference(name, filename, line, receiver)
+                        for name, line, receiver in symbols["references"]
+                    ),
+                    symbols["imports"],
+                ),
+            )
+        return index
+
+
+def parse_patch(patch: Optional[str]) -> Tuple[List[int], str]:
+    """
+    Reads the changed lines of a patch.
+
+    Args:
+        patch (Optional[str]): The patch of a file.
+
+    Returns:
+        Tuple[List[int], str]: The sorted numbers of the added lines in the new file, and the text of the added and
+            removed lines.
+    """
+    changed_lines = []
+    changed_text = []
+    line_number = 0
+    for line in (patch or "").split("\n"):
+        match = HUNK_HEADER.match(line)
+        if match:
+            line_number = int(match.group(2))
+        elif line.startswith("+"):
+            changed_lines.append(line_number)
+            changed_text.append(line[1:])
+            line_number += 1
+        elif line.startswith("-"):
+            changed_text.append(line[1:])
+        elif not line.startswith("\\"):
+            line_number += 1
+    return changed_lines, "\n".join(changed_text)
+
+
+def get_receiver(text: str, position: int) -> str:
+    """
+    Reads the receiver of the identifier starting at a position, e.g. "os.path" for "os.path.join".
+
+    Args:
+        text (str): The code.
+        position (int): The start of the identifier.
+
+    Returns:
+        str: The dotted name of the receiver, "" if the identifier is not an attribute, or "?" if
+            the receiver is another expression, e.g. a call.
+    """
+    end = position
+    while end > 0 and text[end - 1].isspace():
+        end -= 1
+    if end == 0 or text[end - 1] != ".":
+        return ""
+    end -= 1
+    while end > 0 and text[end - 1].isspace():
+        end -= 1
+    start = end
+    while start > 0 and (text[start - 1].isalnum() or text[start - 1] in "_$"):
+        start -= 1
+    if start == end or text[start].isdigit():
+        return "?"
+    outer = get_receiver(text, start)
+    if outer == "?":
+        return "?"
+    return f"{outer}.{text[start:end]}" if outer else text[start:end]
+
+
+def get_used_symbols(text: str) -> Iterable[Tuple[str, str]]:
+    """
+    Finds the identifiers of changed lines that are looked up: called, accessed as attributes or
+    capitalized, as bare lowercase names are mostly local variables.
+
+    Args:
+        text (str): The changed lines.
+
+    Returns:
+        Iterable[Tuple[str, str]]: The name and receiver of every use, as returned by get_receiver.
+    """
+    for match in IDENTIFIER.finditer(text):
+        name = match.group()
+        receiver = get_receiver(text, match.start())
+        if (
+            receiver
+            or name[0].isupper()
+            or text[match.end() : match.end() + 1] == "("
+            or text[match.end() :].lstrip(" \t")[:1] == "("
+        ):
+            yield name, receiver
+
+
+def get_module_name(path: str) -> str:
+    """
+    Gets the name a file is imported by, e.g. "utils" for "src/utils.ts" or "src/utils/index.ts".
+
+    Args:
+        path (str): The path to the file.
+
+    Returns:
+        str: The name of the module.
+    """
+    parts = path.replace("\\", "/").split("/")
+    name = parts[-1].split(".")[0]
+    if name in ("__init__", "index") and len(parts) > 1:
+        return parts[-2]
+    return name
+
+
+def parse_symbols(filename: str, content: str) -> FileSymbols:
+    """
+    Finds the definitions and calls of a file.
+
+    Args:
+        filename (str): The path to the file.
+        content (str): The content of the file.
+
+    Returns:
+        FileSymbols: The definitions, calls and imports, empty for unsupported languages.
+    """
+    language = LANGUAGES.get(filename.split(".")[-1])
+    if language == "python":
+        return parse_python_symbols(filename, content)
+    if language in DEFINITION_PATTERNS:
+        return parse_pattern_symbols(filename, content, language)
+    return NO_SYMBOLS
+
+
+def parse_python_symbols(filename: str, content: str) -> FileSymbols:
+    """
+    Finds the functions, classes, module and class variables, calls and imports of a Python file
+    with ast.
+
+    Args:
+        filename (str): The path to the file.
+        content (str): The content of the file.
+
+    Returns:
+        FileSymbols: The definitions, calls and imports, empty if the file can't be parsed.
+    """
+    tree = parse_python(content)
+    if tree is None:
+        return NO_SYMBOLS
+
+    definitions = []
+    references = []
+    imports = {}
+
+    def visit(node: ast.AST, scope: Optional[str]) -> None:
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                start_line = min(
+                    [child.lineno]
+                    + [decorator.lineno for decorator in child.decorator_list]
+                )
+                kind = "class" if isinstance(child, ast.ClassDef) else "function"
+                if kind == "function" and scope == "class":
+                    kind = "method"
+                definitions.append(
+                    Symbol(child.name, kind, filename, start_line, child.end_lineno)
+                )
+                visit(child, kind)
+                continue
+            if scope in (None, "class") and isinstance(
+                child, (ast.Assign, ast.AnnAssign)
+            ):
+                targets = (
+                    child.targets if isinstance(child, ast.Assign) else [child.target]
+                )
+                definitions.extend(
+                    Symbol(
+                        target.id, "variable", filename, child.lineno, child.end_lineno
+                    )
+                    for target in targets
+                    if isinstance(target, ast.Name)
+                )
+            elif isinstance(child, ast.Call):
+                function = child.func
+                if isinstance(function, ast.Name):
+                    references.append(Reference(function.id, filename, child.lineno))
+                elif isinstance(function, ast.Attribute):
+                    references.append(
+                        Reference(
+                            function.attr,
+                            filename,
+                            child.lineno,
+                            get_dotted_name(function.value) or "?",
+                        )
+                    )
+            elif isinstance(child, ast.Import):
+                for alias in child.names:
+                    if alias.asname:
+                        imports[alias.asname] = alias.name.split(".")[-1]
+                        continue
+                    # "import a.b" binds "a", and "a.b" is used as a receiver
+                    parts = alias.name.split(".")
+                    for i in range(1, len(parts) + 1):
+                        imports[".".join(parts[:i])] = parts[i - 1]
+            elif isinstance(child, ast.ImportFrom):
+                for alias in child.names:
+                    if alias.name != "*":
+                        imports[alias.asname or alias.name] = alias.name
+            visit(child, scope)
+
+    visit(tree, None)
+    return FileSymbols(tuple(definitions), tuple(references), imports)
+
+
+def get_dotted_name(node: ast.expr) -> Optional[str]:
+    """
+    Gets the dotted name of a chain of attributes, e.g. "os.path" for the receiver of os.path.join.
+
+    Args:
+        node (ast.expr): The expression.
+
+    Returns:
+        Optional[str]: The dotted name, or None if the expression is not a chain of names.
+    """
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        outer = get_dotted_name(node.value)
+        return outer and f"{outer}.{node.attr}"
+    return None
+
+
+def parse_pattern_symbols(filename: str, content: str, language: str) -> FileSymbols:
+    """
+    Finds the definitions, calls and imports of a JavaScript, TypeScript or Java file with
+    patterns. A definition ends where the braces opened on its first lines are closed.
+
+    Args:
+        filename (str): The path to the file.
+        content (str): The content of the file.
+        language (str): The language of the file.
+
+    Returns:
+        FileSymbols: The definitions, calls and imports.
+    """
+    lines = content.split("\n")
+    line_starts = [0, *accumulate(len(line) + 1 for line in lines)]
+    depths = [0, *accumulate(line.count("{") - line.count("}") for line in lines)]
+
+    def line_of(position: int) -> int:
+        return bisect_right(line_starts, position)
+
+    def block_end(start_line: int) -> int:
+        depth = depths[start_line - 1]
+        opened = False
+        for line in range(start_line, len(lines) + 1):
+            opened = opened or depths[line] > depth or "{" in lines[line - 1]
+            if opened and depths[line] <= depth:
+                return line
+            if not opened and line - start_line >= 2:
+                return start_line  # A declaration without a body
+        return len(lines)
+
+    definitions = {}
+    for kind, pattern in DEFINITION_PATTERNS[language]:
+        for match in pattern.finditer(content):
+            name = match.group(match.lastindex)
+            if name in NOT_CALLS:
+                continue
+            start_line = line_of(match.start(match.lastindex))
+            definitions.setdefault(
+                (name, start_line),
+                Symbol(name, kind, filename, start_line, block_end(start_line)),
+            )
+    references = []
+    for match in CALL_PATTERN.finditer(content):
+        name, line = match.group(1), line_of(match.start())
+        # The parenthesis of a definition is not a call
+        if name not in NOT_CALLS and (name, line) not in definitions:
+            references.append(
+                Reference(name, filename, line, get_receiver(content, match.start()))
+            )
+    return FileSymbols(
+        tuple(definitions.values()),
+        tuple(references),
+        parse_pattern_imports(content, language),
+    )
+
+
+def parse_pattern_imports(content: str, language: str) -> Dict[str, str]:
+    """
+    Finds the imports of a JavaScript, TypeScript or Java file with patterns.
+
+    Args:
+        content (str): The content of the file.
+        language (str): The language of the file.
+
+    Returns:
+        Dict[str, str]: The bound names and the last part of what they import.
+    """
+    imports = {}
+    for pattern in IMPORT_PATTERNS.get(language, ()):
+        for match in pattern.finditer(content):
+            if language == "java":
+                imports[match.group(1).split(".")[-1]] = match.group(1).split(".")[-1]
+                continue
+            *names, module = match.groups()
+            module = get_module_name(module)
+            for group in names:
+                if group is None:
+                    continue
+                for name in group.split(","):
+                    # "a as b" and "a: b" bind b
+                    alias = re.split(r"\s+as\s+|\s*:\s*|^type\s+", name.strip())[-1]
+                    if alias:
+                        imports[alias] = module
+    return imports
@@ -0,0 +1,332 @@
+from collections.abc import Sequence
+from functools import cached_property
+from typing import Callable, Dict, List, Optional, Tuple
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+import numpy as np
+
+# One row per chunk: the file it comes from, its byte range in the texts file, its content hash,
+# the lines of the file it spans, and its duplicate group with the fingerprint of the group
+CHUNK_DTYPE = np.dtype(
+    [
+        ("file_id", "<i4"),
+        ("start", "<i8"),
+        ("end", "<i8"),
+        ("hash", "S16"),
+        ("start_line", "<i4"),
+        ("end_line", "<i4"),
+        ("group", "<i8"),
+        ("simhash", "<u8"),
+    ]
+)
+
+
+def chunk_hash(text: str) -> bytes:
+    """
+    Computes the content hash stored for a chunk.
+
+    Args:
+        text (str): The chunk content.
+
+    Returns:
+        bytes: A 16 bytes blake2b digest of the chunk.
+    """
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+class ChunkTexts(Sequence):
+    """
+    A read-only list of chunk contents, decoded on access from a memory-mapped texts file. Adding
+    chunks or taking a subset returns a new list that still reads the mapped chunks lazily.
+    """
+
+    def __init__(
+        self, data, chunks: np.ndarray, appended: Tuple[str, ...] = ()
+    ) -> None:
+        """
+        Initializes a new instance of the ChunkTexts class.
+
+        Args:
+            data (np.memmap | bytes): The concatenated UTF-8 encoded chunks.
+            chunks (np.ndarray): The chunks side table, with CHUNK_DTYPE rows.
+            appended (Tuple[str, ...], optional): Chunks added after the mapped ones. Defaults to ().
+        """
+        self.data = data
+        self.chunks = chunks
+        self.appended = appended
+
+    def __len__(self) -> int:
+        return len(self.chunks) + len(self.appended)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx >= len(self.chunks):
+            return self.appended[idx - len(self.chunks)]
+        chunk = self.chunks[idx]
+        return bytes(self.data[chunk["start"] : chunk["end"]]).decode()
+
+    def __add__(self, other) -> "ChunkTexts":
+        return ChunkTexts(self.data, self.chunks, self.appended + tuple(other))
+
+    def take(self, idxs: List[int]) -> "ChunkTexts":
+        """
+        Selects chunks without decoding them.
+
+        Args:
+            idxs (List[int]): The indices of the chunks to keep, in ascending order.
+
+        Returns:
+            ChunkTexts: The selected chunks.
+        """
+        mapped = [idx for idx in idxs if idx < len(self.chunks)]
+        appended = tuple(
+            self.appended[idx - len(self.chunks)]
+            for idx in idxs
+            if idx >= len(self.chunks)
+        )
+        return ChunkTexts(
+            self.data, self.chunks[np.asarray(mapped, dtype=np.int64)], appended
+        )
+
+
+class VectorStore:
+    """
+    On-disk format of a FilesIndex, made to be opened near-instantly and shared between processes:
+
+    - embeddings.npy: the float32 embedding matrix, opened with np.memmap
+    - chunks.bin: the UTF-8 encoded chunk contents, concatenated and memory-mapped
+    - chunks.npy: a side table with the file id, byte range, content hash, lines and duplicate group of every chunk
+    - filenames.json: the file names, indexed by file id
+
+    Every write goes to a new generation directory, and the CURRENT file naming the generation
+    to read is replaced last. Readers resolve CURRENT once, so they never mix files of two writes.
+    """
+
+    EMBEDDINGS_FILE = "embeddings.npy"
+    TEXTS_FILE = "chunks.bin"
+    CHUNKS_FILE = "chunks.npy"
+    FILENAMES_FILE = "filenames.json"
+    CURRENT_FILE = "CURRENT"
+    GENERATION_PREFIX = "generation-"
+
+    def __init__(self, path: str) -> None:
+        """
+        Opens a vector store. Nothing but the file names is read into memory.
+
+        Args:
+            path (str): The directory of the vector store.
+
+        Raises:
+            FileNotFoundError: If no vector store was written to the directory.
+            ValueError: If the vector store has another format or its files don't match each other.
+        """
+        self.path = path
+        self.directory = self.resolve(path)
+        if self.directory is None:
+            if os.path.exists(os.path.join(path, self.CHUNKS_FILE)):
+                raise ValueError(
+                    f"The vector store in {path} was written with an older format"
+                )
+            raise FileNotFoundError(f"No vector store in {path}")
+        self.embeddings = np.load(
+            os.path.join(self.directory, self.EMBEDDINGS_FILE), mmap_mode="r"
+        )
+        self.chunks = np.load(
+            os.path.join(self.directory, self.CHUNKS_FILE), mmap_mode="r"
+        )
+        texts_path = os.path.join(self.directory, self.TEXTS_FILE)
+        if os.path.getsize(texts_path):
+            texts = np.memmap(texts_path, dtype=np.uint8, mode="r")
+        else:
+            texts = b""  # Empty files can't be memory-mapped
+        self.docs = ChunkTexts(texts, self.chunks)
+        with open(os.path.join(self.directory, self.FILENAMES_FILE)) as file:
+            self.filenames: List[str] = json.load(file)
+        self.check(len(texts))
+
+    def check(self, texts_size: int) -> None:
+        """
+        Checks that the side table has the current format, and that the embeddings, the side table,
+        the texts and the file names describe the same chunks.
+
+        Args:
+            texts_size (int): The size of the texts file in bytes.
+
+        Raises:
+            ValueError: If the vector store has another format or its files don't match each other.
+        """
+        if self.chunks.dtype != CHUNK_DTYPE:
+            raise ValueError(
+                f"The vector store in {self.directory} was written with another format"
+            )
+        if len(self.chunks) and (
+            len(self.embeddings) != len(self.chunks)
+            or int(self.chunks["end"].max()) > texts_size
+            or int(self.chunks["file_id"].max()) >= len(self.filenames)
+        ):
+            raise ValueError(f"Inconsistent vector store in {self.directory}")
+
+    @staticmethod
+    def resolve(path: str) -> Optional[str]:
+        """
+        Finds the generation directory of the last complete write of a vector store.
+
+        Args:
+            path (str): The directory of the vector store.
+
+        Returns:
+            Optional[str]: The generation directory, or None if no complete vector store was written.
+        """
+        try:
+            with open(os.path.join(path, VectorStore.CURRENT_FILE)) as file:
+                directory = os.path.join(path, file.read().strip())
+        except FileNotFoundError:
+            return None
+        if not all(
+            os.path.exists(os.path.join(directory, filename))
+            for filename in (
+                VectorStore.EMBEDDINGS_FILE,
+                VectorStore.TEXTS_FILE,
+                VectorStore.CHUNKS_FILE,
+                VectorStore.FILENAMES_FILE,
+            )
+        ):
+            return None
+        return directory
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        """
+        Checks whether a complete vector store was written to a directory.
+
+        Args:
+            path (str): The directory of the vector store.
+
+        Returns:
+            bool: True if every file of the current generation exists.
+        """
+        return VectorStore.resolve(path) is not None
+
+    @cached_property
+    def idx_to_filename(self) -> Dict[int, str]:
+        """
+        The file name of every chunk, keyed by chunk index.
+        """
+        return {
+            idx: self.filenames[file_id]
+            for idx, file_id in enumerate(self.chunks["file_id"].tolist())
+        }
+
+    @property
+    def doc_lines(self) -> List[Tuple[int, int]]:
+        """
+        The (start_line, end_line) of every chunk, keyed by chunk index.
+        """
+        return list(
+            zip(self.chunks["start_line"].tolist(), self.chunks["end_line"].tolist())
+        )
+
+    @property
+    def groups(self) -> List[int]:
+        """
+        The duplicate group of every chunk, keyed by chunk index.
+        """
+        return self.chunks["group"].tolist()
+
+    @cached_property
+    def index(self) -> Dict[str, List[int]]:
+        """
+        The chunk indices of every file, keyed by file name.
+        """
+        index = {}
+        for idx, filename in self.idx_to_filename.items():
+            index.setdefault(filename, []).append(idx)
+        return index
+
+    @staticmethod
+    def write(
+        path: str,
+        docs: List[str],
+        embeddings: np.ndarray,
+        idx_to_filename: Dict[int, str],
+        doc_lines: List[Tuple[int, int]] = None,
+        groups: List[int] = None,
+        simhashes: Dict[int, int] = None,
+        write_files: Callable[[str], None] = None,
+    ) -> None:
+        """
+        Writes a vector store to a new generation directory and then points CURRENT to it, so
+        processes that have the previous version open keep reading it. Only the previous
+        generation is kept along with the new one.
+
+        Args:
+            path (str): The directory of the vector store.
+            docs (List[str]): The chunk contents.
+            embeddings (np.ndarray): The embedding matrix, one row per chunk. None if the chunks aren't embedded.
+            idx_to_filename (Dict[int, str]): The file name of every chunk.
+            doc_lines (List[Tuple[int, int]], optional): The lines spanned by every chunk. Defaults to None, stored as (0, 0).
+            groups (List[int], optional): The duplicate group of every chunk. Defaults to None, one group per chunk.
+            simhashes (Dict[int, int], optional): The fingerprint of every group. Defaults to None, stored as 0.
+            write_files (Callable[[str], None], optional): Writes more files to the generation directory before it becomes current. Defaults to None.
+        """
+        file_ids = {}
+        chunks = np.zeros(len(docs), dtype=CHUNK_DTYPE)
+        texts = []
+        offset = 0
+        for idx, doc in enumerate(docs):
+            text = doc.encode()
+            filename = idx_to_filename[idx]
+            group = groups[idx] if groups else idx
+            chunks[idx] = (
+                file_ids.setdefault(filename, len(file_ids)),
+                offset,
+                offset + len(text),
+                chunk_hash(doc),
+                *(doc_lines[idx] if doc_lines else (0, 0)),
+                group,
+                simhashes[group] if simhashes else 0,
+            )
+            texts.append(text)
+            offset += len(text)
+        if embeddings is None:
+            # Nothing is embedded, the embedding matrix only keeps an empty row per chunk
+            embeddings = np.zeros((len(docs), 0), dtype=np.float32)
+        elif len(docs):
+            embeddings = np.asarray(embeddings, dtype=np.float32)
+        else:
+            embeddings = np.zeros((0, 0), dtype=np.float32)
+
+        # Generations sort in the order they were started
+        generation = f"{VectorStore.GENERATION_PREFIX}{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+        directory = os.path.join(path, generation)
+        os.makedirs(directory)
+        with open(os.path.join(directory, VectorStore.EMBEDDINGS_FILE), "wb") as file:
+            np.save(file, embeddings)
+        with open(os.path.join(directory, VectorStore.TEXTS_FILE), "wb") as file:
+            file.write(b"".join(texts))
+        with open(os.path.join(directory, VectorStore.CHUNKS_FILE), "wb") as file:
+            np.save(file, chunks)
+        with open(os.path.join(directory, VectorStore.FILENAMES_FILE), "w") as file:
+            json.dump(list(file_ids), file)
+        if write_files is not None:
+            write_files(directory)
+
+        previous = VectorStore.resolve(path)
+        current_path = os.path.join(path, VectorStore.CURRENT_FILE)
+        with open(current_path + ".tmp", "w") as file:
+            file.write(generation)
+        os.replace(current_path + ".tmp", current_path)
+
+        # Generations older than the previous one are no longer opened by anyone who read CURRENT
+        oldest = min(os.path.basename(previous), generation) if previous else generation
+        for name in os.listdir(path):
+            if name.startswith(VectorStore.GENERATION_PREFIX) and name < oldest:
+                shutil.rmtree(os.path.join(path, name), ignore_errors=True)
@@ -0,0 +1,63 @@
+"""
+Fails if a cold import of the entry point modules goes over its time budget, or loads a
+dependency that should only be imported on first use. Measured with `python -X importtime`.
+"""
+
+import os
+import subprocess
+import sys
+
+# Cumulative import time budget of each module, in milliseconds
+BUDGETS_MS = {
+    "CommentAgent": int(os.environ.get("COMMENT_AGENT_IMPORT_BUDGET_MS", 600)),
+    "server": int(os.environ.get("SERVER_IMPORT_BUDGET_MS", 150)),
+}
+# Imported on first use only
+LAZY_MODULES = ("langchain", "openai", "tiktoken")
+
+
+def measure_import(module: str) -> dict:
+    """
+    Imports a module in a fresh interpreter and reads the `-X importtime` report.
+
+    Args:
+        module (str): The name of the module.
+
+    Returns:
+        dict: The cumulative import time of every imported module in microseconds, keyed by module name.
+    """
+    env = dict(os.environ)
+    env.setdefault("GH_ACCESSTOKEN", "import-time-check")  # Read by server.py at import
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        env=env,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if process.returncode != 0:
+        raise RuntimeError(f"Could not import {module}:\n{process.stderr}")
+
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+if __name__ == "__main__":
+    failed = False
+    for module, budget_ms in BUDGETS_MS.items():
+        times = measure_import(module)
+        elapsed_ms = times[module] / 1000
+        eager = sorted(name for name in times if name.split(".")[0] in LAZY_MODULES)
+        print(f"{module}: {elapsed_ms:.0f} ms (budget {budget_ms} ms)")
+        if elapsed_ms > budget_ms:
+            print(f"  over budget by {elapsed_ms - budget_ms:.0f} ms")
+            failed = True
+        if eager:
+            print(f"  imports {', '.join(eager[:5])}... at startup")
+            failed = True
+    sys.exit(1 if failed else 0)
@@ -1,20 +1,93 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import sys
+import traceback
+
 from CommentAgent import CommentAgent
-import openai
+from GithubHandlers import GithubHandler
+from GPTsettings import GPTsettings
 import os
 
 ACCESS_TOKEN = os.environ["GH_ACCESSTOKEN"]
-BRANCH_OR_PR_NUMBER = os.environ[
+BRANCH_OR_PR_NUMBER = os.environ.get(
     "PR_NUMBER"
-]  # On pull request open (number), on push (branch name)
+)  # On pull request open (number), on push (branch name)
+# Batch mode: comma separated PR numbers, or "all" for every open PR against MAIN_BRANCH
+PR_NUMBERS = os.environ.get("PR_NUMBERS")
 REPO_NAME = os.environ["REPO_NAME"]
-openai.api_key = os.environ["OPENAI_API_KEY"]
 MAIN_BRANCH = os.environ["MAIN_BRANCH"].split("/")[-1]
 
-if __name__ == "__main__":
-    agent = CommentAgent(
-        repo_name=REPO_NAME,
-        branch_or_prnum=BRANCH_OR_PR_NUMBER,
-        main_branch=MAIN_BRANCH,
-        github_auth_token=ACCESS_TOKEN,
+
+def review_pr(github_handler: GithubHandler, pr_number: int) -> str:
+    """
+    Reviews a pull request with a handler shared by the whole batch.
+
+    Args:
+        github_handler (GithubHandler): The shared handler.
+        pr_number (int): The number of the pull request.
+
+    Returns:
+        str: The outcome of the review, or "failed: <error>".
+    """
+    try:
+        agent = CommentAgent(
+            repo_name=REPO_NAME,
+            branch_or_prnum=str(pr_number),
+            main_branch=MAIN_BRANCH,
+            github_handler=github_handler,
+        )
+        return agent.run()
+    except Exception as error:
+        logging.error(f"PR #{pr_number} failed:\n{traceback.format_exc()}")
+        return f"failed: {type(error).__name__}: {error}"
+
+
+def review_prs(pr_numbers: str) -> dict:
+    """
+    Reviews several pull requests in one process, sharing the GitHub client, the embeddings cache
+    and the repository indexes, with at most GPTsettings.BATCH_MAX_WORKERS reviews at a time.
+
+    Args:
+        pr_numbers (str): Comma separated pull request numbers, or "all" for every open pull request.
+
+    Returns:
+        dict: The outcome of every review keyed by pull request number.
+    """
+    github_handler = GithubHandler(
+        repo_name=REPO_NAME, main_branch=MAIN_BRANCH, auth_token=ACCESS_TOKEN
     )
-    agent.run()
+    if pr_numbers.strip().lower() == "all":
+        numbers = github_handler.prs_nums
+    else:
+        numbers = [int(number) for number in pr_numbers.split(",") if number.strip()]
+
+    with ThreadPoolExecutor(max_workers=GPTsettings.BATCH_MAX_WORKERS) as executor:
+        outcomes = executor.map(
+            lambda number: review_pr(github_handler, number), numbers
+        )
+        return dict(zip(numbers, outcomes))
+
+
+if __name__ == "__main__":
+    # The key is read by the OpenAI clients, which are only created once the review starts
+    if not os.environ.get("OPENAI_API_KEY"):
+        sys.exit("Set OPENAI_API_KEY")
+    if not PR_NUMBERS and not BRANCH_OR_PR_NUMBER:
+        sys.exit(
+            "Set PR_NUMBER (a PR number or a branch name) or PR_NUMBERS "
+            '(comma separated PR numbers, or "all")'
+        )
+    if PR_NUMBERS:
+        results = review_prs(PR_NUMBERS)
+        for pr_number, outcome in results.items():
+            print(f"PR #{pr_number}: {outcome}")
+        if any(outcome.startswith("failed") for outcome in results.values()):
+            sys.exit(1)
+    else:
+        agent = CommentAgent(
+            repo_name=REPO_NAME,
+            branch_or_prnum=BRANCH_OR_PR_NUMBER,
+            main_branch=MAIN_BRANCH,
+            github_auth_token=ACCESS_TOKEN,
+        )
+        agent.run()
@@ -0,0 +1,324 @@
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterable
+import hashlib
+import hmac
+import importlib
+import json
+import logging
+import os
+import queue
+import threading
+import traceback
+
+from GPTsettings import GPTsettings
+from RequestScheduler import scheduler
+
+# CommentAgent and GithubHandlers are imported by the workers, so the server starts listening
+# right away, and warmed up in the background
+ACCESS_TOKEN = os.environ["GH_ACCESSTOKEN"]
+# pull_request actions that trigger a review
+REVIEWED_ACTIONS = (
+    "opened",
+    "reopened",
+    "synchronize",
+    "ready_for_review",
+    "review_requested",
+)
+
+
+def verify_signature(secret: str, body: bytes, signature: str) -> bool:
+    """
+    Verifies the X-Hub-Signature-256 header of a webhook delivery.
+
+    Args:
+        secret (str): The secret of the webhook.
+        body (bytes): The payload of the delivery.
+        signature (str): The value of the header, "sha256=<hex digest>".
+
+    Returns:
+        bool: True if the payload was signed with the secret.
+    """
+    expected = "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature or "")
+
+
+class RepoWorkers:
+    """
+    The review queue of a repository. A fixed number of worker threads share a GithubHandler,
+    so the client, embeddings cache and repository indexes stay warm between reviews.
+    """
+
+    def __init__(self, repo_name: str, main_branch: str, concurrency: int) -> None:
+        """
+        Initializes a new instance of the RepoWorkers class and starts its workers.
+
+        Args:
+            repo_name (str): The full name of the repository.
+            main_branch (str): The default branch of the repository.
+            concurrency (int): The number of reviews running at a time.
+        """
+        self.repo_name = repo_name
+        self.main_branch = main_branch
+        self.github_handler = None
+        self.queue = queue.Queue()
+        self.pending = set()
+        # The lock of every pull request being reviewed or waiting for its lock, and the number
+        # of workers using it, so locks are dropped once their reviews finish
+        self.pr_locks = {}
+        self.pr_lock_users = Counter()
+        self.results = {}
+        self.lock = threading.Lock()
+        for _ in range(concurrency):
+            threading.Thread(target=self.work, daemon=True).start()
+
+    def submit(self, pr_number: int) -> bool:
+        """
+        Queues the review of a pull request, unless it is already waiting in the queue.
+
+        Args:
+            pr_number (int): The number of the pull request.
+
+        Returns:
+            bool: True if the review was queued.
+        """
+        with self.lock:
+            if pr_number in self.pending:
+                return False
+            self.pending.add(pr_number)
+        self.queue.put(pr_number)
+        return True
+
+    def get_github_handler(self):
+        """
+        Gets the handler shared by the workers, created on first use.
+
+        Returns:
+            GithubHandler: The handler of the repository.
+        """
+        from GithubHandlers import GithubHandler
+
+        with self.lock:
+            if self.github_handler is None:
+                self.github_handler = GithubHandler(
+                    repo_name=self.repo_name,
+                    main_branch=self.main_branch,
+                    auth_token=ACCESS_TOKEN,
+                )
+            return self.github_handler
+
+    def work(self) -> None:
+        """
+        Reviews the queued pull requests, one at a time per pull request.
+        """
+        from CommentAgent import CommentAgent
+
+        while True:
+            pr_number = self.queue.get()
+            with self.lock:
+                # Events received from now on queue a new review
+                self.pending.discard(pr_number)
+                pr_lock = self.pr_locks.setdefault(pr_number, threading.Lock())
+                self.pr_lock_users[pr_number] += 1
+            with pr_lock:
+                try:
+                    github_handler = self.get_github_handler()
+                    github_handler.evict_pr(pr_number)
+                    agent = CommentAgent(
+                        repo_name=self.repo_name,
+                        branch_or_prnum=str(pr_number),
+                        main_branch=self.main_branch,
+                        github_handler=github_handler,
+                    )
+                    outcome = agent.run()
+                except Exception as error:
+                    logging.error(
+                        f"{self.repo_name}#{pr_number} failed:\n{traceback.format_exc()}"
+                    )
+                    outcome = f"failed: {type(error).__name__}: {error}"
+            logging.info(f"{self.repo_name}#{pr_number}: {outcome}")
+            with self.lock:
+                self.results[pr_number] = outcome
+                self.pr_lock_users[pr_number] -= 1
+                if not self.pr_lock_users[pr_number]:
+                    del self.pr_lock_users[pr_number]
+                    del self.pr_locks[pr_number]
+
+    def get_status(self) -> dict:
+        """
+        Gets the queued reviews and the outcome of the last review of every pull request.
+
+        Returns:
+            dict: The status of the queue.
+        """
+        with self.lock:
+            return {"queued": sorted(self.pending), "results": dict(self.results)}
+
+
+class ReviewServer(ThreadingHTTPServer):
+    """
+    An HTTP server receiving the pull_request webhook events of GitHub and reviewing the pull
+    requests in per-repository queues.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: tuple,
+        secret: str = GPTsettings.WEBHOOK_SECRET,
+        allowed_repos: Iterable[str] = GPTsettings.SERVER_REPOS,
+        repo_concurrency: int = GPTsettings.SERVER_REPO_CONCURRENCY,
+        insecure: bool = GPTsettings.WEBHOOK_INSECURE,
+    ) -> None:
+        """
+        Initializes a new instance of the ReviewServer class.
+
+        Args:
+            address (tuple): The (host, port) to listen on.
+            secret (str, optional): The secret of the webhook. Defaults to GPTsettings.WEBHOOK_SECRET.
+            allowed_repos (Iterable[str], optional): The full names of the reviewed repositories. Defaults to GPTsettings.SERVER_REPOS.
+            repo_concurrency (int, optional): The number of reviews running at a time per repository. Defaults to GPTsettings.SERVER_REPO_CONCURRENCY.
+            insecure (bool, optional): Whether unsigned deliveries are accepted when there is no secret. Defaults to GPTsettings.WEBHOOK_INSECURE.
+
+        Raises:
+            ValueError: If there is no secret and insecure is False, or no allowed repository.
+        """
+        if not secret and not insecure:
+            raise ValueError(
+                "WEBHOOK_SECRET is not set, set WEBHOOK_INSECURE=true to accept unsigned deliveries"
+            )
+        allowed_repos = set(allowed_repos)
+        if not allowed_repos:
+            raise ValueError("SERVER_REPOS is not set, no repository would be reviewed")
+        super().__init__(address, WebhookHandler)
+        self.secret = secret
+        self.allowed_repos = allowed_repos
+        self.repo_concurrency = repo_concurrency
+        self.repos = {}
+        self.repos_lock = threading.Lock()
+        if not secret:
+            logging.warning("WEBHOOK_SECRET is not set, deliveries are not verified")
+
+    def enqueue(self, repo_name: str, main_branch: str, pr_number: int) -> bool:
+        """
+        Queues the review of a pull request in the queue of its repository.
+
+        Args:
+            repo_name (str): The full name of the repository.
+            main_branch (str): The default branch of the repository.
+            pr_number (int): The number of the pull request.
+
+        Returns:
+            bool: True if the review was queued, False if it was already waiting.
+        """
+        with self.repos_lock:
+            repo = self.repos.get(repo_name)
+            if repo is None:
+                repo = self.repos[repo_name] = RepoWorkers(
+                    repo_name, main_branch, self.repo_concurrency
+                )
+        return repo.submit(pr_number)
+
+    def get_status(self) -> dict:
+        """
+        Gets the status of every repository queue and the request scheduler metrics.
+
+        Returns:
+            dict: The status of the server.
+        """
+        with self.repos_lock:
+            repos = dict(self.repos)
+        return {
+            "repos": {name: repo.get_status() for name, repo in repos.items()},
+            "requests": scheduler.get_metrics(),
+        }
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """
+    Handles the requests of the review server: webhook deliveries on POST, status on GET /health.
+    """
+
+    server: ReviewServer
+
+    def send_json(self, status: int, data: dict) -> None:
+        """
+        Sends a JSON response.
+
+        Args:
+            status (int): The HTTP status.
+            data (dict): The body of the response.
+        """
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        if self.path == "/health":
+            self.send_json(200, self.server.get_status())
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.server.secret and not verify_signature(
+            self.server.secret, body, self.headers.get("X-Hub-Signature-256")
+        ):
+            self.send_json(401, {"error": "invalid signature"})
+            return
+
+        event = self.headers.get("X-GitHub-Event")
+        try:
+            payload = json.loads(body)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            self.send_json(400, {"error": "invalid payload"})
+            return
+        if not isinstance(payload, dict):
+            self.send_json(400, {"error": "invalid payload"})
+            return
+        if event == "ping":
+            self.send_json(200, {"status": "pong"})
+            return
+        if event != "pull_request" or payload.get("action") not in REVIEWED_ACTIONS:
+            self.send_json(200, {"status": "ignored"})
+            return
+
+        try:
+            pull_request = payload["pull_request"]
+            repository = payload["repository"]
+            repo_name = repository["full_name"]
+            main_branch = repository.get("default_branch", "main")
+            pr_number = pull_request["number"]
+            draft = pull_request.get("draft")
+            state = pull_request.get("state")
+        except (KeyError, TypeError, AttributeError):
+            self.send_json(400, {"error": "invalid payload"})
+            return
+        if not isinstance(pr_number, int) or not isinstance(repo_name, str):
+            self.send_json(400, {"error": "invalid payload"})
+            return
+        if repo_name not in self.server.allowed_repos:
+            self.send_json(403, {"error": "repository not allowed"})
+            return
+        if draft or state != "open":
+            self.send_json(200, {"status": "ignored"})
+            return
+        queued = self.server.enqueue(repo_name, main_branch, pr_number)
+        self.send_json(202, {"status": "queued" if queued else "already queued"})
+
+    def log_message(self, format: str, *args) -> None:
+        logging.info("%s - %s", self.address_string(), format % args)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    server = ReviewServer((GPTsettings.SERVER_HOST, GPTsettings.SERVER_PORT))
+    threading.Thread(target=importlib.import_module, args=("CommentAgent",)).start()
+    logging.info(
+        f"Listening for webhooks on {GPTsettings.SERVER_HOST}:{GPTsettings.SERVER_PORT}"
+    )
+    server.serve_forever()
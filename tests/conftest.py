@@ -0,0 +1,51 @@
+import os
+import re
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeEncoding:
+    """
+    A tokenizer counting words, punctuation and runs of whitespace as tokens, so the tests don't
+    download a tiktoken encoding.
+    """
+
+    TOKEN = re.compile(r"\w+|[^\w\s]|\s+")
+
+    def encode_ordinary(self, text: str) -> list:
+        return self.TOKEN.findall(text)
+
+    def encode_ordinary_batch(self, texts: list) -> list:
+        return [self.encode_ordinary(text) for text in texts]
+
+    def decode(self, tokens: list) -> str:
+        return "".join(tokens)
+
+
+@pytest.fixture
+def encoding() -> FakeEncoding:
+    return FakeEncoding()
+
+
+@pytest.fixture
+def fake_chunker(monkeypatch, encoding):
+    """
+    Chunks the files of FilesIndex with the fake encoding.
+    """
+    import GPTutils
+    from Chunker import Chunker
+
+    monkeypatch.setattr(GPTutils, "get_chunker", lambda: Chunker(encoding))
+
+
+@pytest.fixture
+def fake_packer(monkeypatch, encoding):
+    """
+    Counts the tokens of PromptPacker with the fake encoding.
+    """
+    import PromptPacker
+
+    monkeypatch.setattr(PromptPacker, "get_encoding", lambda model: encoding)
@@ -0,0 +1,76 @@
+import pytest
+
+from Chunker import Chunk, Chunker
+
+# 107 tokens with the fake encoding
+PYTHON = '''import os
+
+
+class Config:
+    """Settings."""
+
+    def load(self, path):
+        with open(path) as file:
+            return file.read()
+
+    def save(self, path, data):
+        with open(path, "w") as file:
+            file.write(data)
+
+
+def main():
+    return Config().load("a")
+'''
+
+
+def lines(chunks) -> list:
+    return [(chunk.start_line, chunk.end_line) for chunk in chunks]
+
+
+def test_empty_and_blank_files(encoding):
+    chunker = Chunker(encoding, max_tokens=10)
+    assert chunker.chunk("", "py") == []
+    assert chunker.chunk("\n  \n\n", "py") == []
+
+
+def test_small_files_are_one_chunk(encoding):
+    chunks = Chunker(encoding, max_tokens=200).chunk("\na = 1\n\nb = 2\n\n", "py")
+    assert chunks == [Chunk("a = 1\n\nb = 2", 2, 4)]
+
+
+@pytest.mark.parametrize(
+    "max_tokens, expected",
+    [
+        # The class header joins the import, each method is its own chunk
+        (45, [(1, 5), (7, 9), (11, 13), (16, 17)]),
+        # The first method fits with the header and the import
+        (60, [(1, 9), (11, 13), (16, 17)]),
+    ],
+)
+def test_python_is_split_at_definitions(encoding, max_tokens, expected):
+    chunks = Chunker(encoding, max_tokens=max_tokens).chunk(PYTHON, "py")
+    assert lines(chunks) == expected
+    assert all(len(encoding.encode_ordinary(c.text)) <= max_tokens for c in chunks)
+
+
+def test_unparsable_python_falls_back_to_patterns(encoding):
+    broken = PYTHON.replace("def main():", "def main(:")
+    chunks = Chunker(encoding, max_tokens=45).chunk(broken, "py")
+    assert lines(chunks) == [(1, 5), (7, 9), (11, 13), (16, 17)]
+
+
+def test_lines_are_split_at_blank_lines_then_single_lines(encoding):
+    text = "a b c d\ne f g h\n\ni j k l\n"
+    chunks = Chunker(encoding, max_tokens=8).chunk(text, "txt")
+    assert lines(chunks) == [(1, 1), (2, 2), (4, 4)]
+    chunks = Chunker(encoding, max_tokens=16).chunk(text, "txt")
+    assert lines(chunks) == [(1, 2), (4, 4)]
+
+
+def test_long_lines_are_split_at_token_boundaries(encoding):
+    line = "var a=" + ",".join(f"x{i}" for i in range(40)) + ";"
+    chunks = Chunker(encoding, max_tokens=20).chunk(f"{line}\n", "js")
+    assert len(chunks) == 5
+    assert "".join(chunk.text for chunk in chunks) == line
+    assert all(len(encoding.encode_ordinary(c.text)) <= 20 for c in chunks)
+    assert {(chunk.start_line, chunk.end_line) for chunk in chunks} == {(1, 1)}
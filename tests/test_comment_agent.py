@@ -0,0 +1,262 @@
+import github
+import pytest
+
+import CommentAgent as comment_agent
+from CommentAgent import CommentAgent
+from FileSources import DiffFile
+from GithubHandlers import GithubHandler
+from GPTsettings import GPTsettings
+from PRSnapshot import PRSnapshot
+from PromptPacker import ContextChunk, FileDelta
+
+PATCH = "@@ -1,2 +1,2 @@\n def run():\n-    return 1\n+    return 2"
+REVIEW = '{"body": "Looks good", "event": "COMMENT", "comments": [%s]}'
+COMMENT = '{"path": "a.py", "line": 2, "side": "RIGHT", "body": "Why 2?"}'
+SUMMARY = '{"body": "Summary", "event": "REQUEST_CHANGES"}'
+# Six hunks changing "value = i" on line 10 * i + 2
+BIG_PATCH = "\n".join(
+    f"@@ -{10 * i + 1},2 +{10 * i + 1},2 @@\n def f{i}():\n-    value = {i}\n+    value = {i + 1}"
+    for i in range(6)
+)
+CONTEXT = (ContextChunk(0, "helpers.py", "def helper():\n    return 42", 0.5),)
+
+
+class FakeGPT:
+    """
+    Answers every conversation with the next of the scripted answers.
+    """
+
+    answers = []
+    conversations = []
+
+    def __init__(self, model=None, async_client=None) -> None:
+        self.conversation = []
+        FakeGPT.conversations.append(self.conversation)
+
+    def add_message(self, role: str, content: str) -> None:
+        self.conversation.append({"role": role, "content": content})
+
+    def truncate(self, length: int) -> None:
+        del self.conversation[length:]
+
+    def get_response(self, max_tokens=1000, response_format=None) -> str:
+        return FakeGPT.answers.pop(0)
+
+    async def aget_response(self, max_tokens=1000, response_format=None) -> str:
+        return self.get_response(max_tokens, response_format)
+
+
+class FakePR:
+    number = 1
+    title = "Change run"
+
+    def __init__(self, errors) -> None:
+        self.user = type("User", (), {"login": "author"})()
+        self.errors = list(errors)
+        self.reviews = []
+        self.issue_comments = []
+
+    def create_review(self, body, event, comments) -> None:
+        if self.errors:
+            raise github.GithubException(self.errors.pop(0))
+        self.reviews.append((body, event, comments))
+
+    def create_issue_comment(self, body) -> None:
+        self.issue_comments.append(body)
+
+
+class FakeGithubHandler(GithubHandler):
+    """
+    Serves a pull request from memory, without GitHub requests.
+    """
+
+    def __init__(
+        self, snapshot, errors=(), last_review=None, incremental=None, context=None
+    ):
+        self.auth_token = None
+        self.context = context or {}
+        self.snapshot = snapshot
+        self.pr = FakePR(errors)
+        self.last_review = last_review
+        self.incremental = incremental
+        self.instruction_requests = 0
+
+    def request(self, function, *args, endpoint="github", **kwargs):
+        return function(*args, **kwargs)
+
+    def get_pr_from_id(self, pr_id):
+        return self.pr
+
+    def get_pr_snapshot(self, pr):
+        return self.snapshot
+
+    def get_last_review(self, pr):
+        return self.last_review
+
+    def get_incremental_snapshot(self, snapshot, reviewed_sha):
+        return self.incremental
+
+    def get_pr_delta_items(self, pr, k=10):
+        return [
+            FileDelta(
+                f.filename,
+                self.get_file_delta(f.patch, f.filename),
+                self.context.get(f.filename, ()),
+            )
+            for f in self.get_pr_snapshot(pr).files
+        ]
+
+    def get_file_contents(self, filepath, ref=None):
+        self.instruction_requests += 1
+        return "Be nice."
+
+
+def snapshot(*files) -> PRSnapshot:
+    return PRSnapshot(
+        number=1,
+        title="Change run",
+        user="author",
+        head_sha="head",
+        base_sha="base",
+        base_ref="main",
+        files=files or (DiffFile("a.py", "modified", "sha", PATCH),),
+        comments=(),
+    )
+
+
+@pytest.fixture
+def gpt(monkeypatch, fake_packer):
+    monkeypatch.setattr(comment_agent, "GPTWrapper", FakeGPT)
+    monkeypatch.setattr(GPTsettings, "REVIEW_MODE", "single")
+    monkeypatch.setattr(GPTsettings, "INCREMENTAL_REVIEW", False)
+    FakeGPT.answers = []
+    FakeGPT.conversations = []
+    return FakeGPT
+
+
+class FakeAsyncOpenAI:
+    def __init__(self, **kwargs) -> None:
+        pass
+
+    async def __aenter__(self) -> "FakeAsyncOpenAI":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        pass
+
+
+@pytest.fixture
+def map_reduce(gpt, monkeypatch):
+    import openai
+
+    monkeypatch.setattr(openai, "AsyncOpenAI", FakeAsyncOpenAI)
+    monkeypatch.setattr(GPTsettings, "REVIEW_MODE", "map_reduce")
+    monkeypatch.setattr(GPTsettings, "SHARD_TOKEN_BUDGET", 500)
+    return FakeGithubHandler(
+        snapshot(
+            DiffFile("big.py", "modified", "sha1", BIG_PATCH),
+            DiffFile("a.py", "modified", "sha2", PATCH),
+        ),
+        context={"big.py": CONTEXT},
+    )
+
+
+def agent(handler: FakeGithubHandler) -> CommentAgent:
+    return CommentAgent("owner/repo", "1", github_handler=handler)
+
+
+def test_review_is_posted(gpt):
+    handler = FakeGithubHandler(snapshot())
+    gpt.answers = [REVIEW % COMMENT]
+    assert agent(handler).run() == "reviewed"
+    [(body, event, comments)] = handler.pr.reviews
+    assert body.startswith("Looks good") and event == "COMMENT"
+    assert comments == [{"path": "a.py", "line": 2, "side": "RIGHT", "body": "Why 2?"}]
+
+
+def test_rejected_comments_are_asked_again(gpt):
+    handler = FakeGithubHandler(snapshot(), errors=[422])
+    gpt.answers = [REVIEW % COMMENT, REVIEW % ""]
+    assert agent(handler).run() == "reviewed"
+    assert len(handler.pr.reviews) == 1 and not handler.pr.issue_comments
+
+
+@pytest.mark.parametrize("status", [500, 502])
+def test_reviews_that_may_exist_are_not_posted_again(gpt, status):
+    handler = FakeGithubHandler(snapshot(), errors=[status])
+    gpt.answers = [REVIEW % COMMENT]
+    assert agent(handler).run() == "unconfirmed"
+    assert gpt.answers == [] and not handler.pr.issue_comments
+
+
+def test_failed_reviews_fall_back_to_a_comment(gpt):
+    handler = FakeGithubHandler(snapshot())
+    gpt.answers = ["not json"] * 3 + ["A comment"]
+    assert agent(handler).run() == "commented"
+    assert handler.pr.issue_comments == ["A comment"] and not handler.pr.reviews
+
+
+def test_incremental_reviews_add_left_comments_to_the_body(gpt, monkeypatch):
+    monkeypatch.setattr(GPTsettings, "INCREMENTAL_REVIEW", True)
+    # Line 2 of the reviewed commit is not line 2 of the base, valid on the left of the PR diff
+    later = "@@ -2,1 +2,1 @@\n-    return 3\n+    return 2"
+    handler = FakeGithubHandler(
+        snapshot(),
+        last_review=("reviewed", "Old review"),
+        incremental=snapshot(DiffFile("a.py", "modified", "sha", later)),
+    )
+    left = '{"path": "a.py", "line": 2, "side": "LEFT", "body": "Was 3"}'
+    ranged = (
+        '{"path": "a.py", "start_line": 1, "start_side": "LEFT", '
+        '"line": 2, "side": "RIGHT", "body": "Why 2?"}'
+    )
+    gpt.answers = [REVIEW % f"{left}, {ranged}"]
+    assert agent(handler).run() == "reviewed"
+    [(body, _, comments)] = handler.pr.reviews
+    assert "**a.py** (line 2):\nWas 3" in body
+    assert comments == [{"path": "a.py", "line": 2, "side": "RIGHT", "body": "Why 2?"}]
+
+
+def test_shards_stay_within_budget(map_reduce, encoding):
+    shards = agent(map_reduce).get_review_shards()
+    rendered = [map_reduce.format_pr_deltas(shard) for shard in shards]
+    assert len(shards) > 1
+    assert all(len(encoding.encode_ordinary(text)) <= 500 for text in rendered)
+    for i in range(6):
+        line = f"Line {10 * i + 2} Side RIGHT:     value = {i + 1}"
+        assert sum(line in text for text in rendered) == 1
+    # Every piece of the split file carries its context
+    big = [d for shard in shards for d in shard if d.filename == "big.py"]
+    assert len(big) > 1 and all(d.context == CONTEXT for d in big)
+
+
+def test_shard_reviews_are_merged(map_reduce, gpt):
+    shards = agent(map_reduce).get_review_shards()
+    gpt.answers = [REVIEW % COMMENT] + [REVIEW % ""] * (len(shards) - 1) + [SUMMARY]
+    assert agent(map_reduce).run() == "reviewed"
+    [(body, event, comments)] = map_reduce.pr.reviews
+    assert body.startswith("Summary") and event == "REQUEST_CHANGES"
+    assert comments == [{"path": "a.py", "line": 2, "side": "RIGHT", "body": "Why 2?"}]
+    shard_conversations = gpt.conversations[: len(shards)]
+    assert all(
+        any("Be nice." in message["content"] for message in conversation)
+        for conversation in shard_conversations
+    )
+
+
+def test_shard_reviews_are_posted_without_a_summary(map_reduce, gpt):
+    shards = agent(map_reduce).get_review_shards()
+    gpt.answers = [REVIEW % ""] * len(shards) + ["not json"] * 3
+    assert agent(map_reduce).run() == "reviewed"
+    [(body, event, _)] = map_reduce.pr.reviews
+    assert body.startswith("Partial review 1 (COMMENT):\nLooks good")
+    assert event == "COMMENT"
+
+
+def test_failed_shard_reviews_fall_back_to_a_comment(map_reduce, gpt):
+    shards = agent(map_reduce).get_review_shards()
+    gpt.answers = ["not json"] * 3 * len(shards) + ["A comment"]
+    map_reduce.instruction_requests = 0
+    assert agent(map_reduce).run() == "commented"
+    assert map_reduce.pr.issue_comments == ["A comment"]
+    assert map_reduce.instruction_requests == 1
@@ -0,0 +1,52 @@
+from DiffPositionIndex import DiffPositionIndex
+
+# Lines 10-13 on the left, 10-14 on the right: line 11 is changed and line 13 is added
+PATCH = """@@ -10,4 +10,5 @@
+ def run(items):
+-    items.pop()
++    items.clear()
+     return items
++
+ # end"""
+
+
+def comment(line: int, side: str = "RIGHT", body: str = "Nit", **fields) -> dict:
+    return {"path": "a.py", "line": line, "side": side, "body": body, **fields}
+
+
+def suggestion(code: str) -> str:
+    return f"Use this instead:\n```suggestion\n{code}\n```"
+
+
+def place(*comments) -> tuple:
+    return DiffPositionIndex({"a.py": PATCH}).place_comments(comments, max_distance=3)
+
+
+def test_comments_are_snapped_on_their_side():
+    placed, demoted = place(comment(16), comment(8, side="LEFT"))
+    assert [(c["line"], c["side"]) for c in placed] == [(14, "RIGHT"), (10, "LEFT")]
+    assert demoted == []
+
+
+def test_comments_never_change_sides():
+    index = DiffPositionIndex({"a.py": "@@ -0,0 +1,2 @@\n+a\n+b"})
+    placed, demoted = index.place_comments([comment(1, side="LEFT")], max_distance=3)
+    assert placed == []
+    assert demoted == [comment(1, side="LEFT")]
+
+
+def test_suggestions_are_not_snapped():
+    misplaced = comment(16, body=suggestion("    items.clear()"))
+    placed, demoted = place(misplaced, comment(11, body=suggestion("    x")))
+    assert [c["line"] for c in placed] == [11]
+    assert demoted == [misplaced]
+
+
+def test_invalid_suggestion_ranges_are_not_reduced():
+    valid = comment(14, start_line=11, start_side="RIGHT", body=suggestion("x"))
+    invalid = {**valid, "start_line": 20}
+    placed, demoted = place(
+        valid, invalid, comment(14, start_line=20, start_side="RIGHT")
+    )
+    assert placed == [valid, comment(14)]
+    assert demoted == [invalid]
@@ -0,0 +1,35 @@
+from DuplicateIndex import DuplicateIndex, hash_feature, simhash
+
+# Ten small functions: changing one constant changes a few token pairs out of about 140
+FUNCTIONS = "\n".join(
+    f"def function_{i}(value, other):\n    return value + other * {i}"
+    for i in range(10)
+)
+
+
+def test_feature_hash_halves_are_independent():
+    # The halves of two crc32 differed by a constant for features of the same length
+    halves = {
+        (hash_feature(feature) >> 32) ^ (hash_feature(feature) & 0xFFFFFFFF)
+        for feature in ("a b", "c d", "e f", "g h")
+    }
+    assert len(halves) == 4
+
+
+def test_near_duplicates_are_grouped():
+    index = DuplicateIndex(max_distance=3)
+    group = index.assign(FUNCTIONS)
+    assert index.assign(FUNCTIONS.replace("other * 3", "other * 30")) == group
+    assert index.assign(FUNCTIONS) == group
+
+
+def test_operators_are_features():
+    assert simhash("if a < b:\n    return a") != simhash("if a > b:\n    return a")
+    index = DuplicateIndex(max_distance=3)
+    assert index.assign("if a < b:") != index.assign("if a > b:")
+
+
+def test_punctuation_and_blank_chunks_are_not_grouped():
+    index = DuplicateIndex(max_distance=3)
+    groups = [index.assign(text) for text in ("});", "]]", "\n\n", "  \n")]
+    assert len(set(groups)) == 4
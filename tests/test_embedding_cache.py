@@ -0,0 +1,71 @@
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+import EmbeddingCache as embedding_cache
+from EmbeddingCache import EmbeddingCache
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch) -> EmbeddingCache:
+    # Every call is a later use, so the eviction order doesn't depend on the clock resolution
+    clock = itertools.count()
+    time = SimpleNamespace(time=lambda: float(next(clock)))
+    monkeypatch.setattr(embedding_cache, "time", time)
+    return EmbeddingCache(str(tmp_path / "cache" / "embeddings.sqlite3"), 3)
+
+
+def test_hits_and_misses(cache):
+    cache.put_many("model", ["a", "b"], [[0.5, 1.0], [2.0, 0.25]])
+    assert cache.get_many("model", ["a", "b", "c"]) == {
+        "a": [0.5, 1.0],
+        "b": [2.0, 0.25],
+    }
+    assert cache.get_many("model", []) == {}
+
+
+def test_keys_include_the_model(cache):
+    cache.put_many("small", ["a"], [[1.0]])
+    cache.put_many("large", ["a"], [[2.0]])
+    assert cache.get_many("small", ["a"]) == {"a": [1.0]}
+    assert cache.get_many("large", ["a"]) == {"a": [2.0]}
+    assert cache.get_many("other", ["a"]) == {}
+
+
+def test_least_recently_used_entries_are_evicted(cache):
+    cache.put_many("model", ["a", "b", "c"], [[1.0], [2.0], [3.0]])
+    cache.get_many("model", ["a"])
+    cache.put_many("model", ["d"], [[4.0]])
+    assert len(cache) == 3
+    assert sorted(cache.get_many("model", ["a", "b", "c", "d"])) == ["a", "c", "d"]
+
+
+def test_entries_survive_reopening(cache):
+    cache.put_many("model", ["a"], [[1.0]])
+    reopened = EmbeddingCache(cache.path, cache.max_entries)
+    assert reopened.get_many("model", ["a"]) == {"a": [1.0]}
+
+
+def test_lookups_larger_than_a_query_batch(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "embeddings.sqlite3"), 10_000)
+    texts = [str(i) for i in range(EmbeddingCache.QUERY_BATCH_SIZE * 2 + 1)]
+    cache.put_many("model", texts, [[float(i)] for i in range(len(texts))])
+    found = cache.get_many("model", texts)
+    assert len(found) == len(texts) and found["1000"] == [1000.0]
+
+
+def test_threads_share_the_cache(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "embeddings.sqlite3"), 10_000)
+
+    def work(thread: int) -> dict:
+        texts = [f"{thread}-{i}" for i in range(50)]
+        cache.put_many("model", texts, [[float(thread)]] * len(texts))
+        return cache.get_many("model", texts)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(work, range(16)))
+    assert all(len(found) == 50 for found in results)
+    assert results[3]["3-0"] == [3.0]
+    assert len(cache) == 16 * 50
@@ -0,0 +1,96 @@
+import subprocess
+from types import SimpleNamespace
+
+import pytest
+
+from FileSources import FileSource, GithubAPIFileSource, LocalGitFileSource
+
+
+def git(path, *args: str) -> str:
+    return subprocess.run(
+        [
+            "git",
+            "-C",
+            str(path),
+            "-c",
+            "user.name=test",
+            "-c",
+            "user.email=test@example.com",
+            *args,
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+
+
+@pytest.fixture
+def source(tmp_path) -> LocalGitFileSource:
+    (tmp_path / "a b.py").write_text("x = 1\n")
+    git(tmp_path, "init", "-q")
+    git(tmp_path, "add", "a b.py")
+    git(tmp_path, "commit", "-qm", "init")
+    return LocalGitFileSource(str(tmp_path))
+
+
+def test_paths_with_spaces(source):
+    assert source.get_file_contents("a b.py", ref="HEAD") == "x = 1\n"
+    # The missing "HEAD:a b" is answered with the 3 fields header "HEAD:a b missing"
+    assert source.cat_file("HEAD:a b") is None
+    assert source.get_file_contents("a b", ref="HEAD") == (
+        "Could not retrieve file contents."
+    )
+    assert source.get_file_contents("a b.py", ref="HEAD") == "x = 1\n"
+
+
+def test_file_source_is_abstract():
+    with pytest.raises(TypeError):
+        FileSource()
+
+
+def test_files_that_are_not_utf8(source, tmp_path):
+    base = git(tmp_path, "rev-parse", "HEAD")
+    (tmp_path / "caf\xe9.txt").write_bytes(b"caf\xe9\r\n")
+    (tmp_path / b"latin\xe9.txt".decode(errors="surrogateescape")).write_bytes(b"x\n")
+    (tmp_path / "a b.py").write_text("x = 2\n")
+    git(tmp_path, "add", "-A")
+    git(tmp_path, "commit", "-qm", "latin-1")
+
+    files = {file.filename: file for file in source.get_diff_files(base, "HEAD")}
+    assert files["caf\xe9.txt"].patch.endswith("+caf\ufffd\r")
+    assert files["a b.py"].patch.endswith("-x = 1\n+x = 2")
+    latin = b"latin\xe9.txt".decode(errors="surrogateescape")
+    assert files[latin].status == "added"
+    assert source.get_file_contents(latin, ref="HEAD") == "x\n"
+    assert latin in source.list_blobs() and latin in source.list_files()
+
+
+class TreeRepo:
+    """
+    Lists the git trees of a repository whose recursive listing is truncated.
+    """
+
+    default_branch = "main"
+
+    def __init__(self) -> None:
+        self.trees = {
+            "root": [("a.py", "blob", "1"), ("src", "tree", "src")],
+            "src": [("b.py", "blob", "2"), ("lib", "tree", "lib")],
+            "lib": [("c.py", "blob", "3")],
+        }
+
+    def get_git_tree(self, sha: str, recursive: bool = False) -> SimpleNamespace:
+        if recursive:
+            # Only some of the entries, like GitHub past 100,000 entries
+            elements = [SimpleNamespace(path="a.py", type="blob", sha="1")]
+            return SimpleNamespace(sha="root", tree=elements, truncated=True)
+        elements = [
+            SimpleNamespace(path=path, type=object_type, sha=object_sha)
+            for path, object_type, object_sha in self.trees[sha]
+        ]
+        return SimpleNamespace(sha=sha, tree=elements, truncated=False)
+
+
+def test_truncated_trees_are_listed_by_level():
+    source = GithubAPIFileSource(TreeRepo())
+    assert source.list_blobs() == {"a.py": "1", "src/b.py": "2", "src/lib/c.py": "3"}
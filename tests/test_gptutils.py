@@ -0,0 +1,11 @@
+import numpy as np
+import pytest
+
+from GPTutils import top_k_indices
+
+
+@pytest.mark.parametrize("k", [0, 1, 3, 5, 8, 12])
+def test_top_k_indices_orders_ties_like_a_stable_sort(k):
+    scores = np.array([0.5, 0.9, 0.5, 0.1, 0.9, 0.5, 0.5, 0.3], dtype=np.float32)
+    expected = np.argsort(scores, kind="stable")[::-1][:k]
+    assert top_k_indices(scores, k).tolist() == expected.tolist()
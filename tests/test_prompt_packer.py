@@ -0,0 +1,74 @@
+import logging
+
+import pytest
+
+from PromptPacker import ContextChunk, FileDelta, PromptPacker
+
+
+def text(tokens: int) -> str:
+    # Every punctuation character is a token of the fake encoding
+    return "." * tokens
+
+
+def delta(filename: str, tokens: int, *context: ContextChunk) -> FileDelta:
+    return FileDelta(filename, text(tokens), tuple(context))
+
+
+def chunk(idx: int, tokens: int, score: float) -> ContextChunk:
+    # Chunks also count their one token filename
+    return ContextChunk(idx, "c", text(tokens - 1), score)
+
+
+@pytest.fixture
+def packer(fake_packer) -> PromptPacker:
+    return PromptPacker(budget=20)
+
+
+def test_material_is_kept_by_priority(packer, caplog):
+    deltas = [
+        delta("a.py", 5, chunk(7, 3, 0.9), chunk(3, 5, 0.2), chunk(1, 1, 0.4)),
+        delta("b.py", 20),
+        delta("c.py", 3, chunk(5, 2, 0.5)),
+    ]
+    with caplog.at_level(logging.WARNING):
+        packed = packer.pack(
+            deltas,
+            repo_instructions=text(3),
+            comments=["old", "new"],
+            reserved_tokens=2,
+        )
+
+    # Deltas in order, dropped whole, then the instructions
+    assert [d.filename for d in packed.deltas] == ["a.py", "c.py"]
+    assert packed.repo_instructions == text(3)
+    # Context by score, kept in index order
+    assert [c.idx for c in packed.deltas[0].context] == [1, 7]
+    assert [c.idx for c in packed.deltas[1].context] == [5]
+    # Comments newest first
+    assert packed.comments == ["new"]
+    assert packed.tokens == 20
+    assert packed.dropped == [
+        "delta of b.py (20 tokens)",
+        "context chunk 3 of c (score 0.200, 5 tokens)",
+        "comment (1 tokens)",
+    ]
+    assert "delta of b.py (20 tokens)" in caplog.text
+
+
+def test_instructions_are_dropped_before_context(packer):
+    packed = packer.pack(
+        [delta("a.py", 10, chunk(0, 4, 0.1))],
+        repo_instructions=text(12),
+        comments=[text(2), text(4)],
+    )
+    assert packed.repo_instructions == ""
+    assert packed.dropped == ["repository instructions (12 tokens)"]
+    assert [c.idx for c in packed.deltas[0].context] == [0]
+    assert packed.comments == [text(2), text(4)]
+
+
+def test_nothing_is_logged_under_budget(packer, caplog):
+    with caplog.at_level(logging.WARNING):
+        packed = packer.pack([delta("a.py", 3, chunk(0, 2, 0.5))], "x", ["y"])
+    assert packed.dropped == [] and packed.tokens == 7
+    assert caplog.text == ""
@@ -0,0 +1,89 @@
+import pytest
+
+from CommentAgent import CommentAgent, ParsingError, ResponseParser
+from GPTutils import GPTWrapper
+
+VALID = """{
+    "body": "Two issues",
+    "event": "REQUEST_CHANGES",
+    "comments": [
+        {"path": "/a.py", "line": "12", "side": "right", "body": "Use a set"},
+        {"path": "a.py", "start_line": 3, "line": 5, "side": "LEFT", "body": "Dead code"}
+    ]
+}"""
+
+
+def parse(answer: str) -> tuple:
+    return ResponseParser(answer).get_body_event_and_comments()
+
+
+def test_valid_answers():
+    body, event, comments = parse(VALID)
+    assert (body, event) == ("Two issues", "REQUEST_CHANGES")
+    assert comments == [
+        {"path": "a.py", "line": 12, "side": "RIGHT", "body": "Use a set"},
+        {
+            "path": "a.py",
+            "line": 5,
+            "side": "LEFT",
+            "start_line": 3,
+            "start_side": "LEFT",
+            "body": "Dead code",
+        },
+    ]
+
+
+def test_fenced_answers():
+    assert parse(f"Here is my review:\n```json\n{VALID}\n```") == parse(VALID)
+
+
+def test_trailing_commas_are_removed_outside_strings():
+    answer = '{"body": "Keep [a, ] and {b, }", "event": "APPROVE", "comments": [],}'
+    assert parse(answer) == ("Keep [a, ] and {b, }", "APPROVE", [])
+    assert parse(VALID.replace('"Dead code"}', '"Dead code"},\n')) == parse(VALID)
+
+
+@pytest.mark.parametrize(
+    "answer", ["no json", '{"event": "APPROVE"}', '{"body": " "}', "[1, 2]"]
+)
+def test_answers_without_body_are_refused(answer):
+    with pytest.raises(ParsingError):
+        parse(answer)
+
+
+def test_missing_keys_and_invalid_values_are_repaired():
+    answer = """{"body": "Ok", "event": "approved", "comments": [
+        {"path": "a.py", "line": 4, "side": "MIDDLE", "body": "Nit"},
+        {"path": "a.py", "line": 6, "start_line": 9, "body": "Backwards"},
+        {"path": "a.py", "body": "No line"},
+        {"line": 2, "body": "No path"},
+        "not a comment"
+    ]}"""
+    body, event, comments = parse(answer)
+    assert (body, event) == ("Ok", "COMMENT")
+    assert comments == [
+        {"path": "a.py", "line": 4, "side": "RIGHT", "body": "Nit"},
+        {"path": "a.py", "line": 6, "side": "RIGHT", "body": "Backwards"},
+    ]
+    assert parse('{"body": "Ok"}') == ("Ok", "COMMENT", [])
+
+
+def test_repairs_replace_the_previous_attempt():
+    # The wrapper is built without its OpenAI client, only the conversation is used
+    GPT = GPTWrapper.__new__(GPTWrapper)
+    GPT.conversation = []
+    GPT.add_message("system", "Review")
+    GPT.add_message("user", "The PR")
+    base_length = len(GPT.conversation)
+    for attempt in range(3):
+        CommentAgent.add_repair_messages(
+            GPT, base_length, f"answer {attempt}", ParsingError("x" * 1000)
+        )
+    assert [message["role"] for message in GPT.conversation] == [
+        "system",
+        "user",
+        "assistant",
+        "user",
+    ]
+    assert GPT.conversation[2]["content"] == "answer 2"
+    assert "ParsingError: " + "x" * 486 + "..." in GPT.conversation[3]["content"]
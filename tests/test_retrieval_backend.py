@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from BM25Index import BM25Index
+from RetrievalBackend import (
+    BM25Backend,
+    HybridBackend,
+    VectorBackend,
+    create_backend,
+    min_max_scale,
+)
+
+# Embeddings of the texts used below: cosine similarities to the query sit in a narrow band
+VECTORS = {
+    "query parse_config": [1.0, 0.0],
+    "def parse_config(path):": [0.7, 0.71],
+    "config = parse(path)": [0.85, 0.53],
+}
+
+
+class FakeEmbedder:
+    def __init__(self) -> None:
+        self.calls = []
+
+    def __call__(self, texts: list) -> np.ndarray:
+        self.calls.append(list(texts))
+        return np.array([VECTORS[text] for text in texts], dtype=np.float32)
+
+
+def test_min_max_scale():
+    scores = np.array([[0.7, 0.85, 0.8], [0.2, 0.2, 0.2]], dtype=np.float32)
+    assert np.allclose(min_max_scale(scores), [[0, 1, 2 / 3], [0, 0, 0]])
+
+
+def test_hybrid_scales_cosine_similarities():
+    docs = list(VECTORS)[1:]
+    backend = HybridBackend(VectorBackend(FakeEmbedder()), BM25Backend(), 0.5)
+    backend.add(docs, [0, 1])
+    (scores,) = backend.score(["query parse_config"])
+    # BM25 prefers the definition, the embeddings prefer the call: both count as much
+    assert backend.lexical.score(["query parse_config"])[0].argmax() == 0
+    assert np.allclose(scores, [0.5, 0.5])
+
+
+def test_vector_backend_embeds_groups_once():
+    embed = FakeEmbedder()
+    backend = VectorBackend(embed)
+    docs = list(VECTORS)[1:]
+    backend.add(docs, [0, 1])
+    backend.add([docs[1]], [1])
+    assert embed.calls == [docs]
+    assert np.array_equal(backend.embeddings[2], backend.embeddings[1])
+
+    copy = backend.copy()
+    copy.select([2])
+    assert copy.groups == [1] and len(backend.embeddings) == 3
+
+
+def test_select_prunes_bm25_vocabulary():
+    index = BM25Index()
+    index.add(["alpha beta", "gamma delta epsilon", "alpha"])
+    index.select([2, 0])
+    assert sorted(index.vocabulary) == ["alpha", "beta"]
+    (scores,) = index.score(["beta"])
+    assert scores[0] == 0 and scores[1] > 0
+
+
+def test_create_backend():
+    assert isinstance(create_backend("bm25", FakeEmbedder(), 0.5), BM25Backend)
+    with pytest.raises(ValueError):
+        create_backend("dense", FakeEmbedder(), 0.5)
+
+
+def test_bm25_files_index_round_trip(fake_chunker, tmp_path):
+    from GPTutils import FilesIndex
+
+    files = {"a.py": "def parse_config(path):\n    return path\n", "b.py": "x = 1\n"}
+    index = FilesIndex(dict(files), backend="bm25")
+    index.save_vector_store(str(tmp_path))
+    loaded = FilesIndex.from_vector_store(str(tmp_path), backend="bm25")
+    queries = ["parse config", "x"]
+    assert np.allclose(loaded.score_docs(queries), index.score_docs(queries))
+    assert np.allclose(index.copy().score_docs(queries), index.score_docs(queries))
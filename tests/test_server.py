@@ -0,0 +1,157 @@
+import hashlib
+import hmac
+import io
+import json
+import sys
+import threading
+import time
+from email.message import Message
+from types import SimpleNamespace
+
+import pytest
+
+SECRET = "s3cret"
+
+
+@pytest.fixture
+def server_module(monkeypatch):
+    monkeypatch.setenv("GH_ACCESSTOKEN", "token")
+    import server
+
+    return server
+
+
+@pytest.fixture
+def review_server(server_module):
+    # No workers, so the queued reviews stay pending
+    review_server = server_module.ReviewServer(
+        ("127.0.0.1", 0),
+        secret=SECRET,
+        allowed_repos=["owner/repo"],
+        repo_concurrency=0,
+    )
+    yield review_server
+    review_server.server_close()
+
+
+def sign(body: bytes, secret: str = SECRET) -> str:
+    return "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def deliver(
+    server_module, review_server, payload, signature=None, event="pull_request"
+):
+    body = json.dumps(payload).encode()
+    headers = Message()
+    headers["Content-Length"] = str(len(body))
+    headers["X-GitHub-Event"] = event
+    headers["X-Hub-Signature-256"] = signature or sign(body)
+    # The handler is run on the request without a connection
+    handler = server_module.WebhookHandler.__new__(server_module.WebhookHandler)
+    handler.server = review_server
+    handler.headers = headers
+    handler.rfile = io.BytesIO(body)
+    handler.wfile = io.BytesIO()
+    handler.client_address = ("127.0.0.1", 0)
+    handler.request_version = "HTTP/1.1"
+    handler.requestline = "POST / HTTP/1.1"
+    handler.command = "POST"
+    handler.do_POST()
+    status_line, _, response = handler.wfile.getvalue().partition(b"\r\n\r\n")
+    return int(status_line.split()[1]), json.loads(response)
+
+
+def pull_request(number: int = 7, repo: str = "owner/repo") -> dict:
+    return {
+        "action": "synchronize",
+        "pull_request": {"number": number, "state": "open", "draft": False},
+        "repository": {"full_name": repo, "default_branch": "main"},
+    }
+
+
+def test_bad_signatures_are_refused(server_module, review_server):
+    response = deliver(
+        server_module, review_server, pull_request(), signature=sign(b"{}")
+    )
+    assert response == (401, {"error": "invalid signature"})
+    response = deliver(
+        server_module,
+        review_server,
+        pull_request(),
+        signature=sign(json.dumps(pull_request()).encode(), "other"),
+    )
+    assert response == (401, {"error": "invalid signature"})
+    assert review_server.repos == {}
+
+
+def test_unknown_repositories_are_refused(server_module, review_server):
+    response = deliver(server_module, review_server, pull_request(repo="evil/repo"))
+    assert response == (403, {"error": "repository not allowed"})
+    assert review_server.repos == {}
+
+
+def test_duplicate_deliveries_are_queued_once(server_module, review_server):
+    assert deliver(server_module, review_server, pull_request()) == (
+        202,
+        {"status": "queued"},
+    )
+    assert deliver(server_module, review_server, pull_request()) == (
+        202,
+        {"status": "already queued"},
+    )
+    assert deliver(server_module, review_server, pull_request(8))[0] == 202
+    repo = review_server.get_status()["repos"]["owner/repo"]
+    assert repo["queued"] == [7, 8]
+
+
+def test_servers_need_a_secret_and_repositories(server_module):
+    with pytest.raises(ValueError):
+        server_module.ReviewServer(("127.0.0.1", 0), secret="", allowed_repos=["a/b"])
+    with pytest.raises(ValueError):
+        server_module.ReviewServer(("127.0.0.1", 0), secret=SECRET, allowed_repos=[])
+
+
+def wait_for(condition) -> None:
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_reviews_of_a_pull_request_run_one_at_a_time(server_module, monkeypatch):
+    release = threading.Event()
+    running = []
+    overlaps = []
+
+    class FakeAgent:
+        def __init__(self, branch_or_prnum, **kwargs) -> None:
+            self.pr_number = int(branch_or_prnum)
+
+        def run(self) -> str:
+            overlaps.append(self.pr_number in running)
+            running.append(self.pr_number)
+            release.wait(5)
+            running.remove(self.pr_number)
+            return "reviewed"
+
+    monkeypatch.setitem(
+        sys.modules,
+        "CommentAgent",
+        SimpleNamespace(CommentAgent=FakeAgent),
+    )
+    monkeypatch.setattr(
+        server_module.RepoWorkers,
+        "get_github_handler",
+        lambda self: SimpleNamespace(evict_pr=lambda pr_number: None),
+    )
+    workers = server_module.RepoWorkers("owner/repo", "main", 2)
+    assert workers.submit(1)
+    wait_for(lambda: running == [1])
+    # A new event while the review runs queues another one, which waits for the first
+    assert workers.submit(1)
+    wait_for(lambda: workers.pr_lock_users[1] == 2)
+    assert running == [1]
+    release.set()
+    wait_for(lambda: not workers.pr_locks)
+    assert overlaps == [False, False]
+    assert workers.get_status() == {"queued": [], "results": {1: "reviewed"}}
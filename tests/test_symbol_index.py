@@ -0,0 +1,158 @@
+import pytest
+
+from FileSources import DiffFile
+from SymbolIndex import (
+    CALLER_SCORE,
+    Reference,
+    SymbolIndex,
+    UNVERIFIED_SCORE,
+    get_receiver,
+    parse_symbols,
+)
+
+FILES = {
+    "indexer.py": """class RepositoryIndex:
+    def update(self, sha):
+        return sha
+
+    def save(self):
+        self.update(None)
+""",
+    "settings.py": """class Settings:
+    LIMIT = 3
+""",
+    "utils.py": """def helper(value):
+    return value + 1
+""",
+    "agent.py": """import utils as u
+from indexer import RepositoryIndex
+from settings import Settings
+
+
+def run(items, data):
+    items.update(data)
+    return u.helper(Settings.LIMIT)
+""",
+}
+
+
+@pytest.fixture
+def index() -> SymbolIndex:
+    index = SymbolIndex()
+    index.add_files(FILES)
+    return index
+
+
+def names(symbols) -> list:
+    return [(symbol.name, symbol.path) for symbol in symbols]
+
+
+@pytest.mark.parametrize(
+    "text, receiver",
+    [
+        ("join(a)", ""),
+        ("os.path.join(a)", "os.path"),
+        ("self . index.update(a)", "self.index"),
+        ("load().update(a)", "?"),
+        ("items[0].update(a)", "?"),
+    ],
+)
+def test_get_receiver(text, receiver):
+    position = text.rindex("join" if "join" in text else "update")
+    assert get_receiver(text, position) == receiver
+
+
+def test_attribute_of_a_variable_is_unverified(index):
+    patch = "@@ -7,1 +7,1 @@\n-    items.pop(data)\n+    items.update(data)"
+    hunk = index.get_hunk_symbols("agent.py", patch)
+    assert hunk.definitions == []
+    assert names(hunk.unverified_definitions) == [("update", "indexer.py")]
+
+
+def test_imports_resolve_definitions(index):
+    patch = "@@ -8,1 +8,1 @@\n-    return 0\n+    return u.helper(Settings.LIMIT)"
+    hunk = index.get_hunk_symbols("agent.py", patch)
+    assert names(hunk.definitions) == [
+        ("helper", "utils.py"),
+        ("Settings", "settings.py"),
+        ("LIMIT", "settings.py"),
+    ]
+    assert hunk.unverified_definitions == []
+
+
+def test_callers_are_resolved_by_receiver(index):
+    patch = "@@ -2,2 +2,2 @@\n-    def update(self):\n+    def update(self, sha):\n         return sha"
+    hunk = index.get_hunk_symbols("indexer.py", patch)
+    assert hunk.callers == [Reference("update", "indexer.py", 6, "self")]
+    assert hunk.unverified_callers == [Reference("update", "agent.py", 7, "items")]
+
+
+def test_pattern_imports():
+    symbols = parse_symbols(
+        "src/app.ts",
+        "import { helper as h, type Options } from './lib/utils';\n"
+        "import * as api from '../api';\n"
+        'import Client, { connect } from "client";\n'
+        "const { readFile: read } = require('fs');\n",
+    )
+    assert symbols.imports == {
+        "h": "utils",
+        "Options": "utils",
+        "api": "api",
+        "Client": "client",
+        "connect": "client",
+        "read": "fs",
+    }
+    java = parse_symbols("Foo.java", "import com.example.Bar;\nimport static a.B.c;\n")
+    assert java.imports == {"Bar": "Bar", "c": "c"}
+
+
+def test_pattern_receivers_resolve_modules():
+    index = SymbolIndex()
+    index.add_files(
+        {
+            "src/api/index.js": "export function fetchUser(id) {\n  return id;\n}\n",
+            "src/store.js": "export function fetchUser(id) {\n  return null;\n}\n",
+            "src/app.js": "import * as api from './api';\nfunction load() {\n  return api.fetchUser(1);\n}\n",
+        }
+    )
+    patch = "@@ -3,1 +3,1 @@\n-  return 1;\n+  return api.fetchUser(1);"
+    hunk = index.get_hunk_symbols("src/app.js", patch)
+    assert names(hunk.definitions) == [("fetchUser", "src/api/index.js")]
+    assert names(hunk.unverified_definitions) == [("fetchUser", "src/store.js")]
+
+
+def test_save_and_load(index, tmp_path):
+    index.save(str(tmp_path / "symbols.json"))
+    loaded = SymbolIndex.load(str(tmp_path / "symbols.json"))
+    assert loaded.files == index.files
+    assert loaded.definitions == index.definitions
+    assert loaded.callers == index.callers
+
+
+def test_unverified_matches_do_not_replace_retrieval(fake_chunker, monkeypatch):
+    from GithubHandlers import GithubHandler
+    from GPTutils import FilesIndex
+    from PRSnapshot import PRSnapshot
+
+    files_index = FilesIndex(dict(FILES), backend="bm25")
+    handler = GithubHandler.__new__(GithubHandler)
+    handler.FILE_EXTENSIONS = {".py"}
+    monkeypatch.setattr(handler, "index_pr", lambda snapshot: files_index)
+    patch = "@@ -7,1 +7,1 @@\n-    items.pop(data)\n+    items.update(data)"
+    snapshot = PRSnapshot(
+        number=1,
+        title="",
+        user="",
+        head_sha="",
+        base_sha="",
+        base_ref="main",
+        files=(DiffFile("agent.py", "modified", "", patch, None),),
+        comments=(),
+    )
+
+    (file_delta,) = handler.get_pr_delta_items(snapshot, k=1)
+
+    # The name-only match to RepositoryIndex.update doesn't fill the only slot, retrieval does
+    (chunk,) = file_delta.context
+    assert UNVERIFIED_SCORE < chunk.score < CALLER_SCORE
@@ -0,0 +1,92 @@
+import os
+
+import numpy as np
+import pytest
+
+from VectorStore import ChunkTexts, VectorStore
+
+DOCS = ["def a():\n", "    return 1\n", "class B:\n"]
+FILENAMES = {0: "a.py", 1: "a.py", 2: "b.py"}
+
+
+def write(path, docs=DOCS, write_files=None) -> None:
+    embeddings = np.eye(len(docs), dtype=np.float32)
+    VectorStore.write(str(path), docs, embeddings, FILENAMES, write_files=write_files)
+
+
+def generations(path) -> list:
+    return sorted(
+        name
+        for name in os.listdir(path)
+        if name.startswith(VectorStore.GENERATION_PREFIX)
+    )
+
+
+def touch(directory: str) -> None:
+    open(os.path.join(directory, "extra.json"), "w").close()
+
+
+def test_write_and_open(tmp_path):
+    write(tmp_path, write_files=touch)
+    store = VectorStore(str(tmp_path))
+    assert list(store.docs) == DOCS
+    assert store.index == {"a.py": [0, 1], "b.py": [2]}
+    assert store.idx_to_filename is store.idx_to_filename
+    assert os.path.exists(os.path.join(store.directory, "extra.json"))
+
+
+def test_readers_keep_their_generation(tmp_path):
+    write(tmp_path)
+    store = VectorStore(str(tmp_path))
+    write(tmp_path, ["x\n", "y\n", "z\n"])
+    assert list(store.docs) == DOCS
+    assert list(VectorStore(str(tmp_path)).docs) == ["x\n", "y\n", "z\n"]
+
+    # Only the current and the previous generation are kept
+    write(tmp_path)
+    assert len(generations(tmp_path)) == 2
+    assert not os.path.exists(store.directory)
+
+
+def test_incomplete_stores_are_not_opened(tmp_path):
+    assert not VectorStore.exists(str(tmp_path))
+    with pytest.raises(FileNotFoundError):
+        VectorStore(str(tmp_path))
+
+    write(tmp_path)
+    directory = VectorStore.resolve(str(tmp_path))
+    np.save(
+        os.path.join(directory, VectorStore.EMBEDDINGS_FILE),
+        np.zeros((1, 3), dtype=np.float32),
+    )
+    with pytest.raises(ValueError):
+        VectorStore(str(tmp_path))
+
+
+def test_chunk_texts_stay_lazy(tmp_path):
+    write(tmp_path)
+    docs = VectorStore(str(tmp_path)).docs + ["new\n"]
+    assert isinstance(docs, ChunkTexts)
+    taken = docs.take([1, 3])
+    assert isinstance(taken, ChunkTexts)
+    assert list(taken) == ["    return 1\n", "new\n"]
+    assert taken[-1] == "new\n"
+    assert len(docs.take([])) == 0
+
+
+def test_older_formats_are_refused(tmp_path):
+    # Flat stores, written before generations
+    np.save(str(tmp_path / VectorStore.CHUNKS_FILE), np.zeros(0))
+    with pytest.raises(ValueError):
+        VectorStore(str(tmp_path))
+
+    # Side tables without the lines of the chunks
+    write(tmp_path / "store")
+    directory = VectorStore.resolve(str(tmp_path / "store"))
+    chunks = np.load(os.path.join(directory, VectorStore.CHUNKS_FILE))
+    np.save(
+        os.path.join(directory, VectorStore.CHUNKS_FILE),
+        chunks[["file_id", "start", "end", "hash"]],
+    )
+    with pytest.raises(ValueError):
+        VectorStore(str(tmp_path / "store"))